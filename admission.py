@@ -0,0 +1,163 @@
+# admission.py
+import os
+import time
+import random
+import asyncio
+import statistics
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from redis_conn import redis_async
+from job_queue import get_piapi_durations
+from metrics import ADMISSION_LEASE_EVENTS
+
+# --- Ограничение числа одновременных задач в PiAPI ---
+# Общий для всех воркеров семафор в Redis: задача получает аренду (lease) на время
+# отправки и опроса PiAPI. Остальные ждут в честной очереди по номеру билета.
+# Аренды и ожидающие без heartbeat (упавший воркер) вычищаются автоматически.
+PIAPI_MAX_CONCURRENCY = int(os.getenv("PIAPI_MAX_CONCURRENCY", 10))
+ADMISSION_LEASE_TTL = int(os.getenv("ADMISSION_LEASE_TTL", 60))
+ADMISSION_POLL_INTERVAL = float(os.getenv("ADMISSION_POLL_INTERVAL", 1.0))
+# Сколько задач может ждать (в очереди воркеров и перед PiAPI), прежде чем API начнет отказывать с 503
+ADMISSION_MAX_BACKLOG = int(os.getenv("ADMISSION_MAX_BACKLOG", 200))
+# Время выполнения задачи PiAPI по умолчанию, пока статистики нет
+DEFAULT_PIAPI_DURATION = 30.0
+TYPICAL_DURATION_CACHE_TTL = 60
+
+ADMISSION_LEASES = "piapi:admission:leases"
+ADMISSION_WAITING = "piapi:admission:waiting"
+ADMISSION_HEARTBEATS = "piapi:admission:heartbeats"
+ADMISSION_TICKET = "piapi:admission:ticket"
+
+# 0 — слот получен (или аренда продлена), N > 0 — позиция в очереди,
+# -1 — аренды нет, а встать в очередь не просили (ARGV[4] = 0, только продление)
+ADMISSION_ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local ttl = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local stale = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now - ttl)
+for _, member in ipairs(stale) do
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZREM', KEYS[3], member)
+end
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+    return 0
+end
+local rank = redis.call('ZRANK', KEYS[2], ARGV[1])
+if not rank then
+    if ARGV[4] == '0' then
+        return -1
+    end
+    redis.call('ZADD', KEYS[2], redis.call('INCR', KEYS[4]), ARGV[1])
+    rank = redis.call('ZRANK', KEYS[2], ARGV[1])
+end
+local free = tonumber(ARGV[3]) - redis.call('ZCARD', KEYS[1])
+if rank < free then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+    return 0
+end
+redis.call('ZADD', KEYS[3], now, ARGV[1])
+return rank - math.max(free, 0) + 1
+"""
+
+_acquire_script = redis_async.register_script(ADMISSION_ACQUIRE_SCRIPT)
+
+
+async def _try_acquire(job_id: str, join: bool = True) -> int:
+    """Берет слот или встает в очередь. Задача, уже стоящая в очереди, сохраняет свой билет."""
+    return await _acquire_script(
+        keys=[ADMISSION_LEASES, ADMISSION_WAITING, ADMISSION_HEARTBEATS, ADMISSION_TICKET],
+        args=[job_id, ADMISSION_LEASE_TTL, PIAPI_MAX_CONCURRENCY, int(join)]
+    )
+
+async def _release(job_id: str):
+    async with redis_async.pipeline(transaction=True) as pipe:
+        pipe.zrem(ADMISSION_LEASES, job_id)
+        pipe.zrem(ADMISSION_WAITING, job_id)
+        pipe.zrem(ADMISSION_HEARTBEATS, job_id)
+        await pipe.execute()
+
+async def _renew_lease(job_id: str):
+    """
+    Продлевает аренду, пока выполняется задача. Если аренда успела истечь (например, event loop
+    надолго завис) и слот забрала другая задача, встает в очередь и берет слот, как только
+    он освободится; пока слота нет, превышение лимита видно в ADMISSION_LEASE_EVENTS.
+    """
+    holding = True
+    while True:
+        await asyncio.sleep(ADMISSION_LEASE_TTL / 3 if holding else ADMISSION_POLL_INTERVAL)
+        try:
+            position = await _try_acquire(job_id, join=False)
+            if position < 0:
+                print(f"⚠️ [Job: {job_id}] Аренда слота PiAPI истекла до продления, беру слот заново.")
+                ADMISSION_LEASE_EVENTS.labels(event="lost").inc()
+                holding = False
+                position = await _try_acquire(job_id)
+            if position > 0:
+                ADMISSION_LEASE_EVENTS.labels(event="over_limit").inc()
+            elif not holding:
+                ADMISSION_LEASE_EVENTS.labels(event="reacquired").inc()
+            holding = position == 0
+        except Exception as e:
+            print(f"⚠️ [Job: {job_id}] Не удалось продлить слот PiAPI: {e}")
+
+
+# --- Оценка ожидания ---
+_typical_duration = {"value": DEFAULT_PIAPI_DURATION, "loaded_at": 0.0}
+
+async def get_typical_piapi_duration() -> float:
+    """Медианное время выполнения задачи PiAPI (обновляется раз в минуту)."""
+    if time.monotonic() - _typical_duration["loaded_at"] > TYPICAL_DURATION_CACHE_TTL:
+        try:
+            durations = await get_piapi_durations()
+            if durations:
+                _typical_duration["value"] = statistics.median(durations)
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить статистику PiAPI: {e}")
+        _typical_duration["loaded_at"] = time.monotonic()
+    return _typical_duration["value"]
+
+async def estimate_wait(position: int) -> int:
+    """Примерное ожидание в секундах для задачи на позиции position: слоты освобождаются волнами."""
+    typical = await get_typical_piapi_duration()
+    return int(round(position / PIAPI_MAX_CONCURRENCY * typical))
+
+async def get_admission_stats() -> Dict[str, int]:
+    async with redis_async.pipeline(transaction=False) as pipe:
+        pipe.zcard(ADMISSION_LEASES)
+        pipe.zcard(ADMISSION_WAITING)
+        active, waiting = await pipe.execute()
+    return {"active": active, "waiting": waiting, "limit": PIAPI_MAX_CONCURRENCY}
+
+
+@asynccontextmanager
+async def piapi_slot(job_id: str, on_wait: Optional[Callable[[int, int], Awaitable[None]]] = None) -> AsyncIterator[None]:
+    """
+    Ждет свободный слот PiAPI и держит его, пока выполняется блок.
+    on_wait(позиция, ожидание_сек) вызывается при каждом изменении позиции в очереди.
+    """
+    last_position = None
+    try:
+        while True:
+            position = await _try_acquire(job_id)
+            if position == 0:
+                break
+            if position != last_position and on_wait is not None:
+                await on_wait(position, await estimate_wait(position))
+            last_position = position
+            await asyncio.sleep(ADMISSION_POLL_INTERVAL * random.uniform(0.8, 1.2))
+    except BaseException:
+        await _release(job_id)
+        raise
+
+    renew_task = asyncio.create_task(_renew_lease(job_id))
+    try:
+        yield
+    finally:
+        renew_task.cancel()
+        # Слот отдаем и при остановке воркера: после возобновления задача встанет в очередь снова
+        await _release(job_id)
@@ -1,23 +1,28 @@
 # assistant.py
 import os
-import io
+import re
 import json
+import time
 import base64
+import asyncio
 import logging
-import datetime
-import hmac
-import hashlib
-from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Security
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
 import azure.cognitiveservices.speech as speechsdk
-from openai import AzureOpenAI
-from typing import List, Dict
-from pydub import AudioSegment
+from openai import AsyncAzureOpenAI
+from typing import List, Dict, AsyncIterator, Tuple, Callable, TypeVar
 from pydantic import BaseModel, Field
 from openai import BadRequestError # <-- Добавьте этот импорт вверху файла
+from fastapi.responses import Response, StreamingResponse
+from telegram_auth import validate_init_data, InitDataError
+from speech_pool import SynthesizerPool, SpeechPoolTimeout, get_pool_stats
+from speech_audio import recognize_once
+from tts_cache import TTSCache
+from metrics import ASSISTANT_STAGE_SECONDS, ASSISTANT_OUTCOMES, observe_seconds, render_metrics
 
 
 # --- 1. Настройка логирования ---
@@ -33,6 +38,22 @@ AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 OPENAI_API_VERSION = os.getenv("OPENAI_API_VERSION")
 AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+# Потоковый ответ: текст режется на фразы не короче STREAM_MIN_CHUNK_CHARS, каждая озвучивается сразу
+STREAM_MIN_CHUNK_CHARS = int(os.getenv("ASSISTANT_STREAM_MIN_CHUNK_CHARS", 20))
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…;:])\s+')
+CONTENT_FILTER_REPLY = "Кешіріңіз, сұранысыңыз мазмұн саясатына байланысты өңделмеді. Басқаша сұрап көріңізші."
+# Озвучка кэшируется только для готовых ответов — только они повторяются
+CACHED_REPLIES = frozenset({CONTENT_FILTER_REPLY})
+# --- Асинхронное выполнение ---
+# Speech SDK и декодирование аудио через ffmpeg блокирующие: выполняются в ограниченном пуле потоков, а не в event loop.
+# Одновременно обрабатывается не больше ASSISTANT_MAX_CONCURRENCY вопросов на процесс,
+# остальные ждут до ASSISTANT_QUEUE_TIMEOUT секунд и получают 503.
+ASSISTANT_SPEECH_THREADS = int(os.getenv("ASSISTANT_SPEECH_THREADS", 16))
+ASSISTANT_MAX_CONCURRENCY = int(os.getenv("ASSISTANT_MAX_CONCURRENCY", 8))
+ASSISTANT_QUEUE_TIMEOUT = float(os.getenv("ASSISTANT_QUEUE_TIMEOUT", 10))
+# Сколько фраз одного потокового ответа озвучивается одновременно; пул синтезаторов
+# рассчитан на все слоты сразу, чтобы вопросы не ждали синтезатора друг за другом
+ASSISTANT_STREAM_TTS_PARALLEL = int(os.getenv("ASSISTANT_STREAM_TTS_PARALLEL", 2))
 SYSTEM_PROMPT = "Сен – тарих пәнінің сарапшысы, Батыр атты AI-көмекшісің. Қысқа, құрметпен және мәні бойынша жауап бер. Отвечай 1-2 предложениями. Сенің міндетің – білім беру."
 
 # --- 3. Проверки и инициализация клиентов ---
@@ -40,7 +61,8 @@ if not all([SPEECH_KEY, SPEECH_REGION, AZURE_OPENAI_KEY, AZURE_OPENAI_ENDPOINT,
     raise RuntimeError("Одна или несколько переменных окружения Azure не заданы.")
 
 try:
-    AZURE_OPENAI_CLIENT = AzureOpenAI(api_key=AZURE_OPENAI_KEY, api_version=OPENAI_API_VERSION, azure_endpoint=AZURE_OPENAI_ENDPOINT)
+    # Асинхронный клиент: ожидание ответа LLM не блокирует event loop
+    AZURE_OPENAI_CLIENT = AsyncAzureOpenAI(api_key=AZURE_OPENAI_KEY, api_version=OPENAI_API_VERSION, azure_endpoint=AZURE_OPENAI_ENDPOINT)
     logging.info("Клиент Azure OpenAI успешно инициализирован.")
 except Exception as e:
     logging.error(f"Не удалось инициализировать клиент Azure OpenAI: {e}")
@@ -75,49 +97,49 @@ async def get_validated_telegram_data(init_data: str = Security(telegram_init_da
     if not init_data:
         raise HTTPException(status_code=401, detail="X-Telegram-Init-Data header is missing")
     try:
-        unquoted_init_data = unquote(init_data)
-        data_check_string, hash_from_telegram = [], ''
-        for item in sorted(unquoted_init_data.split('&')):
-            key, value = item.split('=', 1)
-            if key == 'hash':
-                hash_from_telegram = value
-            else:
-                data_check_string.append(f"{key}={value}")
-        data_check_string = "\n".join(data_check_string)
-        secret_key = hmac.new("WebAppData".encode(), BOT_TOKEN.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        if calculated_hash != hash_from_telegram:
-            raise HTTPException(status_code=403, detail="Invalid data signature")
-        user_data_str = dict(kv.split('=') for kv in unquoted_init_data.split('&')).get('user', '{}')
-        return json.loads(user_data_str)
-    except Exception as e:
+        return validate_init_data(init_data)
+    except InitDataError as e:
         logging.warning(f"Ошибка валидации Telegram initData: {e}")
         raise HTTPException(status_code=403, detail="Could not validate Telegram credentials.")
 
-# --- 6. Вспомогательные функции ---
-def recognize_speech_from_bytes(audio_bytes: bytes, original_filename: str) -> str:
-    logging.info(f"Начало распознавания речи. Получено байтов: {len(audio_bytes)}")
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    temp_audio_dir = "temp_audio"
-    os.makedirs(temp_audio_dir, exist_ok=True)
+# --- 6. Пул потоков и ограничение параллельных вопросов ---
+SYNTHESIZER_POOL = SynthesizerPool(service="assistant", voice=SPEECH_VOICE_NAME, size=ASSISTANT_MAX_CONCURRENCY * ASSISTANT_STREAM_TTS_PARALLEL)
+# Готовые фразы (CACHED_REPLIES) озвучиваются один раз; диск общий с сервисом карты
+TTS_CACHE = TTSCache(service="assistant")
+SPEECH_EXECUTOR = ThreadPoolExecutor(max_workers=ASSISTANT_SPEECH_THREADS, thread_name_prefix="speech")
+_concurrency = asyncio.Semaphore(ASSISTANT_MAX_CONCURRENCY)
+T = TypeVar("T")
+
+class AssistantBusy(Exception):
+    """Все слоты процесса заняты дольше ASSISTANT_QUEUE_TIMEOUT."""
+
+async def run_blocking(func: Callable[..., T], *args) -> T:
+    """Выполняет блокирующий вызов (Speech SDK, ffmpeg) в пуле SPEECH_EXECUTOR."""
+    return await asyncio.get_running_loop().run_in_executor(SPEECH_EXECUTOR, func, *args)
+
+@asynccontextmanager
+async def assistant_slot():
     try:
-        audio_segment = AudioSegment.from_file(io.BytesIO(audio_bytes))
-        audio_segment = audio_segment.set_channels(1).set_frame_rate(16000)
-        wav_filepath = os.path.join(temp_audio_dir, f"to_azure_{timestamp}.wav")
-        audio_segment.export(wav_filepath, format="wav")
-    except Exception as e:
-        logging.error(f"🔥 Ошибка конвертации аудио: {e}", exc_info=True)
-        raise ValueError("Не удалось обработать аудиофайл.")
+        await asyncio.wait_for(_concurrency.acquire(), timeout=ASSISTANT_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise AssistantBusy()
     try:
-        speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION, speech_recognition_language=SPEECH_RECOGNITION_LANGUAGE)
-        audio_config = speechsdk.audio.AudioConfig(filename=wav_filepath)
-        recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
-        result = recognizer.recognize_once_async().get()
+        yield
     finally:
-        try:
-            os.remove(wav_filepath)
-        except OSError as e:
-            logging.error(f"Не удалось удалить временный файл {wav_filepath}: {e}")
+        _concurrency.release()
+
+def _busy_exception() -> HTTPException:
+    ASSISTANT_OUTCOMES.labels(service="assistant", outcome="busy").inc()
+    return HTTPException(
+        status_code=503, detail="Ассистент сейчас занят, попробуйте через несколько секунд.",
+        headers={"Retry-After": str(int(ASSISTANT_QUEUE_TIMEOUT))}
+    )
+
+# --- 7. Вспомогательные функции ---
+def recognize_speech_from_bytes(audio_bytes: bytes, original_filename: str) -> str:
+    logging.info(f"Начало распознавания речи. Получено байтов: {len(audio_bytes)}")
+    # Аудио идет в распознавание из памяти: WAV 16 кГц моно — напрямую, остальное — через ffmpeg pipe
+    result = recognize_once(audio_bytes, SPEECH_RECOGNITION_LANGUAGE, service="assistant")
     if result.reason == speechsdk.ResultReason.RecognizedSpeech:
         if not result.text or result.text.isspace(): raise ValueError("Распознан пустой текст.")
         logging.info(f"✅ Распознано: '{result.text}'")
@@ -131,10 +153,10 @@ def recognize_speech_from_bytes(audio_bytes: bytes, original_filename: str) -> s
         raise RuntimeError(f"Ошибка сервиса распознавания: {cancellation_details.reason}")
     raise RuntimeError("Неизвестная ошибка при распознавании речи.")
 
-def get_answer_from_llm(question: str, history: List[Dict[str, str]]) -> str:
+async def get_answer_from_llm(question: str, history: List[Dict[str, str]]) -> str:
     messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history + [{"role": "user", "content": question}]
     try:
-        response = AZURE_OPENAI_CLIENT.chat.completions.create(model=AZURE_OPENAI_DEPLOYMENT_NAME, messages=messages, temperature=0.7, max_tokens=80)
+        response = await AZURE_OPENAI_CLIENT.chat.completions.create(model=AZURE_OPENAI_DEPLOYMENT_NAME, messages=messages, temperature=0.7, max_tokens=80)
         
         # Проверяем, не был ли ответ пустым из-за фильтрации на стороне ответа
         if not response.choices or not response.choices[0].message.content:
@@ -150,7 +172,7 @@ def get_answer_from_llm(question: str, history: List[Dict[str, str]]) -> str:
         if e.response and e.response.status_code == 400 and e.body and 'content_filter' in e.body.get('code', ''):
             logging.warning(f"Запрос заблокирован фильтром содержимого Azure: {e.body}")
             # Возвращаем вежливое сообщение пользователю на казахском
-            return "Кешіріңіз, сұранысыңыз мазмұн саясатына байланысты өңделмеді. Басқаша сұрап көріңізші."
+            return CONTENT_FILTER_REPLY
         else:
             # Если это другая 400-я ошибка, пробрасываем ее дальше
             logging.error(f"🔥 Ошибка BadRequest при обращении к Azure OpenAI: {e}", exc_info=True)
@@ -161,29 +183,200 @@ def get_answer_from_llm(question: str, history: List[Dict[str, str]]) -> str:
         raise RuntimeError("Ошибка при обращении к сервису OpenAI.")
 
 def synthesize_speech_from_text(text: str) -> bytes:
-    speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
-    speech_config.speech_synthesis_voice_name = SPEECH_VOICE_NAME
-    speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3)
-    synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-    result = synthesizer.speak_text_async(text).get()
-    if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted: return result.audio_data
-    raise RuntimeError(f"Ошибка синтеза речи: {result.cancellation_details.reason}")
-
-# --- 7. Финальный эндпоинт с новой защитой ---
+    # Готовые ответы — из кэша озвучки; свободный текст LLM не повторяется и кэш бы только вытеснял,
+    # поэтому он идет сразу в синтезатор с уже открытым соединением из пула (speech_pool.py)
+    if text in CACHED_REPLIES:
+        return TTS_CACHE.get_or_synthesize(text, SYNTHESIZER_POOL.voice, SYNTHESIZER_POOL.output_format, SYNTHESIZER_POOL.synthesize).audio
+    return SYNTHESIZER_POOL.synthesize(text)
+
+# --- Потоковый ответ: LLM -> фразы -> TTS ---
+def split_completed_sentences(buffer: str) -> Tuple[List[str], str]:
+    """Отрезает от буфера законченные фразы (не короче STREAM_MIN_CHUNK_CHARS), возвращает (фразы, остаток)."""
+    sentences = []
+    start = 0
+    for boundary in SENTENCE_BOUNDARY.finditer(buffer):
+        candidate = buffer[start:boundary.start()].strip()
+        if len(candidate) >= STREAM_MIN_CHUNK_CHARS:
+            sentences.append(candidate)
+            start = boundary.end()
+    return sentences, buffer[start:]
+
+async def stream_answer_sentences(question: str, history: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """Потоковый запрос к LLM: отдает фразы ответа по мере генерации токенов."""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history + [{"role": "user", "content": question}]
+    try:
+        stream = await AZURE_OPENAI_CLIENT.chat.completions.create(
+            model=AZURE_OPENAI_DEPLOYMENT_NAME, messages=messages, temperature=0.7, max_tokens=80, stream=True
+        )
+    except BadRequestError as e:
+        if e.body and 'content_filter' in str(e.body.get('code', '')):
+            logging.warning(f"Запрос заблокирован фильтром содержимого Azure: {e.body}")
+            yield CONTENT_FILTER_REPLY
+            return
+        logging.error(f"🔥 Ошибка BadRequest при обращении к Azure OpenAI: {e}", exc_info=True)
+        raise RuntimeError("Ошибка в запросе к сервису OpenAI.")
+
+    buffer = ""
+    produced = False
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.finish_reason == "content_filter":
+            # Ответ оборван фильтром на середине — уже озвученное оставляем, остальное заменяем
+            logging.warning("Потоковый ответ LLM остановлен content filter'ом.")
+            buffer = "" if produced else CONTENT_FILTER_REPLY
+            break
+        if choice.delta and choice.delta.content:
+            buffer += choice.delta.content
+            sentences, buffer = split_completed_sentences(buffer)
+            for sentence in sentences:
+                produced = True
+                yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+async def _synthesize_chunk(text: str) -> bytes:
+    with observe_seconds(ASSISTANT_STAGE_SECONDS, service="assistant", stage="tts"):
+        return await run_blocking(synthesize_speech_from_text, text)
+
+def _ndjson(event: dict) -> bytes:
+    return (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+
+async def stream_assistant_events(recognized_text: str, history: List[Dict[str, str]], started_at: float) -> AsyncIterator[bytes]:
+    """
+    События ответа в формате NDJSON: transcript, затем chunk (текст фразы и её MP3 в base64)
+    по порядку, и done с полным текстом. Фразы озвучиваются параллельно с генерацией следующих.
+    """
+    yield _ndjson({"type": "transcript", "userText": recognized_text})
+    try:
+        async with assistant_slot():
+            async for event in _stream_answer_events(recognized_text, history, started_at):
+                yield event
+    except AssistantBusy:
+        yield _busy_event()
+
+def _busy_event() -> bytes:
+    ASSISTANT_OUTCOMES.labels(service="assistant", outcome="busy").inc()
+    return _ndjson({"type": "error", "detail": "Ассистент сейчас занят, попробуйте через несколько секунд."})
+
+async def _stream_answer_events(recognized_text: str, history: List[Dict[str, str]], started_at: float) -> AsyncIterator[bytes]:
+    # Очередь задач синтеза в порядке фраз; None — ответ LLM закончился
+    pending: asyncio.Queue = asyncio.Queue()
+    # Один ответ не занимает больше ASSISTANT_STREAM_TTS_PARALLEL синтезаторов пула
+    synthesis_slots = asyncio.Semaphore(ASSISTANT_STREAM_TTS_PARALLEL)
+
+    async def synthesize(sentence: str) -> bytes:
+        async with synthesis_slots:
+            return await _synthesize_chunk(sentence)
+
+    async def produce():
+        try:
+            with observe_seconds(ASSISTANT_STAGE_SECONDS, service="assistant", stage="llm"):
+                async for sentence in stream_answer_sentences(recognized_text, history):
+                    await pending.put((sentence, asyncio.create_task(synthesize(sentence))))
+        finally:
+            await pending.put(None)
+
+    producer = asyncio.create_task(produce())
+    sentences = []
+    try:
+        while True:
+            item = await pending.get()
+            if item is None:
+                break
+            sentence, synthesis = item
+            audio_bytes = await synthesis
+            if not sentences:
+                ASSISTANT_STAGE_SECONDS.labels(service="assistant", stage="first_audio").observe(time.perf_counter() - started_at)
+            sentences.append(sentence)
+            yield _ndjson({"type": "chunk", "seq": len(sentences) - 1, "text": sentence, "audioBase64": base64.b64encode(audio_bytes).decode("utf-8")})
+        await producer
+        ASSISTANT_STAGE_SECONDS.labels(service="assistant", stage="total").observe(time.perf_counter() - started_at)
+        ASSISTANT_OUTCOMES.labels(service="assistant", outcome="ok").inc()
+        yield _ndjson({"type": "done", "assistantText": " ".join(sentences)})
+    except SpeechPoolTimeout:
+        # Все синтезаторы заняты — как и для обычного ответа, это "занят", а не внутренняя ошибка
+        yield _busy_event()
+    except Exception as e:
+        # Заголовки уже отправлены — ошибку сообщаем событием
+        logging.error(f"🔥 Ошибка потокового ответа ассистента: {e}", exc_info=True)
+        ASSISTANT_OUTCOMES.labels(service="assistant", outcome="error").inc()
+        yield _ndjson({"type": "error", "detail": "Произошла непредвиденная внутренняя ошибка ассистента."})
+    finally:
+        # Клиент отключился или ошибка — не тратим Azure на ненужные фразы
+        producer.cancel()
+        while not pending.empty():
+            item = pending.get_nowait()
+            if item is not None:
+                item[1].cancel()
+
+# --- Готовность воркера (для healthcheck контейнера) ---
+@app.get("/api/ready")
+async def readiness_check():
+    return {"ready": True, "pid": os.getpid(), "speech_pool": get_pool_stats(), "tts_cache": TTS_CACHE.stats()}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+# --- 8. Финальный эндпоинт с новой защитой ---
 @app.post("/api/ask-assistant", response_model=AssistantResponse, dependencies=[Depends(get_validated_telegram_data)])
 async def ask_assistant(audio_file: UploadFile = File(...), history_json: str = Form("[]")):
     try:
         history = json.loads(history_json) if isinstance(history_json, str) else []
         if not isinstance(history, list): history = []
         audio_bytes = await audio_file.read()
-        recognized_text = recognize_speech_from_bytes(audio_bytes, audio_file.filename)
-        answer_text = get_answer_from_llm(recognized_text, history)
-        answer_audio_bytes = synthesize_speech_from_text(answer_text)
+        async with assistant_slot():
+            with observe_seconds(ASSISTANT_STAGE_SECONDS, service="assistant", stage="total"):
+                recognized_text = await run_blocking(recognize_speech_from_bytes, audio_bytes, audio_file.filename)
+                with observe_seconds(ASSISTANT_STAGE_SECONDS, service="assistant", stage="llm"):
+                    answer_text = await get_answer_from_llm(recognized_text, history)
+                with observe_seconds(ASSISTANT_STAGE_SECONDS, service="assistant", stage="tts"):
+                    answer_audio_bytes = await run_blocking(synthesize_speech_from_text, answer_text)
         audio_base64 = base64.b64encode(answer_audio_bytes).decode('utf-8')
+        ASSISTANT_OUTCOMES.labels(service="assistant", outcome="ok").inc()
         return AssistantResponse(userText=recognized_text, assistantText=answer_text, audioBase64=audio_base64)
+    except (AssistantBusy, SpeechPoolTimeout):
+        raise _busy_exception()
     except ValueError as e:
         logging.warning(f"Ошибка данных от клиента (400): {e}")
+        ASSISTANT_OUTCOMES.labels(service="assistant", outcome="bad_request").inc()
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logging.error("Непредвиденная ошибка в /api/ask-assistant", exc_info=True)
-        raise HTTPException(status_code=500, detail="Произошла непредвиденная внутренняя ошибка ассистента.")
\ No newline at end of file
+        ASSISTANT_OUTCOMES.labels(service="assistant", outcome="error").inc()
+        raise HTTPException(status_code=500, detail="Произошла непредвиденная внутренняя ошибка ассистента.")
+
+@app.post("/api/ask-assistant/stream", dependencies=[Depends(get_validated_telegram_data)])
+async def ask_assistant_stream(audio_file: UploadFile = File(...), history_json: str = Form("[]")):
+    """
+    Потоковый вариант /api/ask-assistant: ответ приходит NDJSON-событиями,
+    первая фраза звучит, пока LLM еще дописывает остальные.
+    """
+    started_at = time.perf_counter()
+    try:
+        history = json.loads(history_json) if isinstance(history_json, str) else []
+        if not isinstance(history, list): history = []
+        audio_bytes = await audio_file.read()
+        # Распознавание — до начала ответа: ошибки данных возвращаем обычным 400.
+        # Слот берется на распознавание и отдельно на ответ, чтобы ни одна ветка не могла его потерять
+        async with assistant_slot():
+            recognized_text = await run_blocking(recognize_speech_from_bytes, audio_bytes, audio_file.filename)
+    except (AssistantBusy, SpeechPoolTimeout):
+        raise _busy_exception()
+    except ValueError as e:
+        logging.warning(f"Ошибка данных от клиента (400): {e}")
+        ASSISTANT_OUTCOMES.labels(service="assistant", outcome="bad_request").inc()
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception:
+        logging.error("Непредвиденная ошибка в /api/ask-assistant/stream", exc_info=True)
+        ASSISTANT_OUTCOMES.labels(service="assistant", outcome="error").inc()
+        raise HTTPException(status_code=500, detail="Произошла непредвиденная внутренняя ошибка ассистента.")
+    return StreamingResponse(
+        stream_assistant_events(recognized_text, history, started_at),
+        media_type="application/x-ndjson",
+        # Без буферизации в nginx каждая фраза уходит клиенту сразу
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
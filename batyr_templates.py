@@ -0,0 +1,188 @@
+# batyr_templates.py
+import os
+import time
+import mmap
+import shutil
+import base64
+import random
+from typing import List, Dict, Optional, Tuple
+
+from build_assets import build_assets, ASSETS_DIR, TEMPLATE_SOURCE_DIRS
+from http_clients import get_download_client
+
+# --- Публикация шаблонов по URL ---
+# В режиме "url" PiAPI получает ссылку на шаблон, который раздает nginx,
+# вместо того чтобы каждый раз загружать картинку в теле запроса.
+TARGET_IMAGE_MODE = os.getenv("TARGET_IMAGE_MODE", "data_uri")
+PUBLIC_ASSETS_DIR = os.getenv("PUBLIC_ASSETS_DIR", "/app/storage/public-templates")
+PUBLIC_ASSETS_BASE_URL = os.getenv("PUBLIC_ASSETS_BASE_URL", "https://api.batyrai.com/static/batyr-templates").rstrip("/")
+# Как часто проверяем, не изменились ли исходные директории шаблонов
+CATALOGUE_CHECK_INTERVAL = int(os.getenv("CATALOGUE_CHECK_INTERVAL", 30))
+
+
+class BatyrTemplate:
+    """
+    Один шаблон батыра из манифеста. Байты JPEG отображаются в память (mmap),
+    поэтому все процессы делят одну копию в page cache. Data URI для PiAPI
+    кодируется один раз при первом использовании.
+    """
+
+    def __init__(self, entry: Dict):
+        self.name: str = entry["name"]
+        self.file: str = entry["file"]
+        self.sha256: str = entry["sha256"]
+        self.mime_type: str = entry.get("mime_type", "image/jpeg")
+        self.size_bytes: int = entry["bytes"]
+        self.path = os.path.join(ASSETS_DIR, self.file)
+        self._mmap: Optional[mmap.mmap] = None
+        self._data_uri: Optional[str] = None
+
+    @property
+    def content(self) -> mmap.mmap:
+        if self._mmap is None:
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    @property
+    def data_uri(self) -> str:
+        if self._data_uri is None:
+            encoded_string = base64.b64encode(self.content).decode('utf-8')
+            self._data_uri = f"data:{self.mime_type};base64,{encoded_string}"
+        return self._data_uri
+
+
+# --- Каталог шаблонов по полам ---
+batyr_images_caches: Dict[str, List[BatyrTemplate]] = {
+    "male": [],
+    "female": []
+}
+# sha256 шаблона -> опубликованный URL. Сбрасывается при изменении директорий шаблонов.
+published_template_urls: Dict[str, str] = {}
+_catalogue_state = {"signature": None, "checked_at": 0.0}
+
+def _source_dirs_signature() -> Tuple:
+    signature = []
+    for source_dir in TEMPLATE_SOURCE_DIRS.values():
+        try:
+            entries = sorted((entry.name, entry.stat().st_mtime, entry.stat().st_size) for entry in os.scandir(source_dir))
+        except OSError:
+            entries = []
+        signature.append((source_dir, tuple(entries)))
+    return tuple(signature)
+
+def load_all_batyr_images_to_cache():
+    """Собирает ассеты (инкрементально) и загружает каталог шаблонов из манифеста."""
+    _catalogue_state["signature"] = _source_dirs_signature()
+    _catalogue_state["checked_at"] = time.monotonic()
+    published_template_urls.clear()
+    try:
+        manifest = build_assets()
+    except Exception as e:
+        print(f"🔥 Критическая ошибка при сборке шаблонов: {e}")
+        return
+    for gender in batyr_images_caches:
+        entries = manifest["templates"].get(gender, [])
+        batyr_images_caches[gender] = [BatyrTemplate(entry) for entry in entries]
+        if entries:
+            total_kb = sum(entry["bytes"] for entry in entries) // 1024
+            print(f"✅ Шаблонов ({gender}): {len(entries)}, {total_kb} КБ.")
+        else:
+            print(f"❌ Шаблоны ({gender}) не найдены.")
+
+def get_random_batyr_template(gender: str = "male") -> BatyrTemplate:
+    # Выбираем кэш в зависимости от пола, по умолчанию 'male'
+    cache_key = gender if gender in batyr_images_caches and batyr_images_caches[gender] else "male"
+
+    image_cache = batyr_images_caches[cache_key]
+    if not image_cache:
+        # Если для выбранного пола нет картинок, пробуем другой
+        fallback_key = "female" if cache_key == "male" else "male"
+        image_cache = batyr_images_caches.get(fallback_key, [])
+        if not image_cache:
+            raise ValueError("Кэш изображений батыров пуст для обоих полов.")
+
+    return random.choice(image_cache)
+
+def get_random_batyr_templates(gender: str = "male", count: int = 1) -> List[BatyrTemplate]:
+    """Несколько разных случайных шаблонов (не больше, чем есть в каталоге)."""
+    image_cache = batyr_images_caches.get(gender) or []
+    if not image_cache:
+        return [get_random_batyr_template(gender)]
+    return random.sample(image_cache, min(count, len(image_cache)))
+
+def find_batyr_template(template_ref: str) -> Optional[BatyrTemplate]:
+    """Ищет шаблон по sha256 или по имени исходного файла."""
+    for templates in batyr_images_caches.values():
+        for template in templates:
+            if template_ref in (template.sha256, template.name):
+                return template
+    return None
+
+def get_batyr_template(template_sha: Optional[str], gender: str = "male") -> BatyrTemplate:
+    """Шаблон, выбранный при постановке задачи. Если каталог успел измениться — случайный."""
+    for templates in batyr_images_caches.values():
+        for template in templates:
+            if template.sha256 == template_sha:
+                return template
+    return get_random_batyr_template(gender)
+
+def get_random_batyr_image_uri(gender: str = "male") -> str:
+    return get_random_batyr_template(gender).data_uri
+
+def ensure_catalogue_loaded():
+    """
+    Загружает каталог, только если его еще нет в процессе. Под gunicorn --preload каталог
+    уже загружен в мастере до fork, и воркеры используют его общую копию (copy-on-write).
+    """
+    if _catalogue_state["signature"] is None:
+        load_all_batyr_images_to_cache()
+    elif _source_dirs_signature() != _catalogue_state["signature"]:
+        print("🔄 Директории шаблонов изменились, пересобираю каталог...")
+        load_all_batyr_images_to_cache()
+
+def get_catalogue_status() -> Dict[str, int]:
+    return {gender: len(templates) for gender, templates in batyr_images_caches.items()}
+
+def refresh_catalogue_if_changed():
+    """Перезагружает каталог, если в директориях шаблонов что-то изменилось (не чаще раза в CATALOGUE_CHECK_INTERVAL)."""
+    if time.monotonic() - _catalogue_state["checked_at"] < CATALOGUE_CHECK_INTERVAL:
+        return
+    _catalogue_state["checked_at"] = time.monotonic()
+    if _source_dirs_signature() != _catalogue_state["signature"]:
+        print("🔄 Директории шаблонов изменились, пересобираю каталог...")
+        load_all_batyr_images_to_cache()
+
+
+# --- Ссылка на шаблон для PiAPI ---
+def _publish_template(template: BatyrTemplate) -> str:
+    """Кладет шаблон в публичную директорию nginx. Имя файла — хэш содержимого, поэтому ссылки неизменяемы."""
+    os.makedirs(PUBLIC_ASSETS_DIR, exist_ok=True)
+    public_path = os.path.join(PUBLIC_ASSETS_DIR, template.file)
+    if not os.path.exists(public_path):
+        try:
+            os.link(template.path, public_path)
+        except OSError:
+            shutil.copyfile(template.path, public_path)
+    return f"{PUBLIC_ASSETS_BASE_URL}/{template.file}"
+
+async def get_target_image_reference(template: BatyrTemplate) -> str:
+    """
+    Возвращает то, что отправляется в PiAPI как target_image: URL опубликованного
+    шаблона в режиме "url" или data URI. Если nginx не отдает шаблон, откатываемся на data URI.
+    """
+    if TARGET_IMAGE_MODE != "url":
+        return template.data_uri
+    url = published_template_urls.get(template.sha256)
+    if url:
+        return url
+    try:
+        url = _publish_template(template)
+        response = await get_download_client().head(url)
+        response.raise_for_status()
+    except Exception as e:
+        print(f"⚠️ Шаблон {template.name} недоступен по URL, отправляю data URI: {e}")
+        return template.data_uri
+    published_template_urls[template.sha256] = url
+    print(f"🌐 Шаблон {template.name} опубликован: {url}")
+    return url
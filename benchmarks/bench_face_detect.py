@@ -0,0 +1,64 @@
+# benchmarks/bench_face_detect.py
+"""
+Замер задержки предобработки фото и детектора лица на одно изображение.
+
+Запуск: python benchmarks/bench_face_detect.py path/to/photos [--repeat 5]
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from photo_preprocess import preprocess_photo
+from face_detect import count_faces, FACE_CHECK_ENABLED
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="Файл или директория с фото")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if not FACE_CHECK_ENABLED:
+        sys.exit("Детектор лица отключен: установите opencv-python-headless и FACE_CHECK_ENABLED=true.")
+
+    if os.path.isdir(args.path):
+        files = [os.path.join(args.path, name) for name in sorted(os.listdir(args.path))
+                 if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.heic'))]
+    else:
+        files = [args.path]
+
+    preprocess_ms, detect_ms = [], []
+    for path in files:
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        # Первый прогон прогревает каскады, в статистику не идет
+        result = preprocess_photo(image_bytes)
+        resized = Image.open(io.BytesIO(result["jpeg_bytes"]))
+        resized.load()
+        for _ in range(args.repeat):
+            result = preprocess_photo(image_bytes)
+            preprocess_ms.append(result["decode_ms"] + result["encode_ms"])
+            started = time.perf_counter()
+            faces = count_faces(resized)
+            detect_ms.append((time.perf_counter() - started) * 1000)
+        print(f"{os.path.basename(path):40s} лиц: {faces}  предобработка: {result['decode_ms'] + result['encode_ms']:.1f} мс  детектор: {detect_ms[-1]:.1f} мс")
+
+    if not detect_ms:
+        sys.exit("Фото не найдены.")
+    print()
+    for label, values in (("Предобработка", preprocess_ms), ("Детектор лица", detect_ms)):
+        print(f"{label}: p50 {statistics.median(values):.1f} мс, p95 {_percentile(values, 0.95):.1f} мс, max {max(values):.1f} мс ({len(values)} замеров)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# benchmarks/bench_quota.py
+"""
+Микробенчмарк проверки дневного лимита: сколько вызовов can_user_generate в секунду.
+
+Сравнивает старую схему (новое соединение на вызов, SELECT * + UPDATE,
+журнал по умолчанию) с текущей (постоянное соединение, WAL, один UPSERT/RETURNING).
+
+Запуск: python benchmarks/bench_quota.py [--calls 20000] [--users 1000]
+"""
+import os
+import sys
+import time
+import sqlite3
+import datetime
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+
+def legacy_can_user_generate(db_file: Path, user_id: int, daily_limit: int):
+    """Копия прежней реализации: соединение на каждый вызов, чтение и запись отдельными запросами."""
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        today_str = datetime.date.today().isoformat()
+        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        user_data = cursor.fetchone()
+        if user_data is None:
+            return False
+        current_usage = user_data['usage_count'] if user_data['last_usage_date'] == today_str else 0
+        if current_usage < daily_limit:
+            cursor.execute("UPDATE users SET usage_count = ?, last_usage_date = ? WHERE user_id = ?", (current_usage + 1, today_str, user_id))
+            conn.commit()
+            return True
+        return False
+    finally:
+        conn.close()
+
+def _prepare_db(db_file: Path, users: int, wal: bool):
+    conn = sqlite3.connect(db_file)
+    conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, usage_count INTEGER DEFAULT 0, last_usage_date TEXT NOT NULL, first_seen_date TEXT NOT NULL)")
+    conn.executemany("INSERT INTO users VALUES (?, 'bench', 'bench', 0, '1970-01-01', '1970-01-01')", [(i,) for i in range(users)])
+    conn.commit()
+    conn.close()
+
+def _run(label: str, fn, calls: int, users: int):
+    started = time.perf_counter()
+    for i in range(calls):
+        fn(i % users)
+    elapsed = time.perf_counter() - started
+    print(f"{label:45s} {calls / elapsed:10.0f} проверок/с  ({elapsed * 1e6 / calls:.0f} мкс на вызов)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+    # Лимит заведомо больше числа вызовов, чтобы каждый вызов делал запись
+    daily_limit = args.calls + 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_db = Path(tmp_dir) / "legacy.db"
+        _prepare_db(legacy_db, args.users, wal=False)
+        _run("До: соединение на вызов, SELECT + UPDATE", lambda uid: legacy_can_user_generate(legacy_db, uid, daily_limit), args.calls, args.users)
+
+        database.DB_FILE = Path(tmp_dir) / "current.db"
+        database.DAILY_LIMIT = daily_limit
+        _prepare_db(database.DB_FILE, args.users, wal=True)
+        _run("После: постоянное соединение, WAL, UPSERT", database.can_user_generate, args.calls, args.users)
+
+if __name__ == "__main__":
+    main()
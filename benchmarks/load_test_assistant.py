@@ -0,0 +1,94 @@
+# benchmarks/load_test_assistant.py
+"""
+Нагрузочный тест ассистента: N одновременных вопросов с одним и тем же аудио.
+
+Если запросы обрабатываются параллельно, общее время близко к самому долгому запросу,
+а "перекрытие" (сумма задержек / общее время) близко к N. Если event loop блокируется,
+запросы выстраиваются в очередь: общее время ≈ сумма задержек, перекрытие ≈ 1.
+
+Запуск: python benchmarks/load_test_assistant.py question.ogg --init-data "$INIT_DATA" \
+    [--url http://localhost:8001] [--concurrency 8] [--rounds 3] [--stream]
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+async def _ask(client: httpx.AsyncClient, args, audio_bytes: bytes, filename: str) -> dict:
+    files = {"audio_file": (filename, audio_bytes, "application/octet-stream")}
+    headers = {"X-Telegram-Init-Data": args.init_data}
+    started = time.perf_counter()
+    first_audio = None
+    if args.stream:
+        async with client.stream("POST", "/api/ask-assistant/stream", files=files, data={"history_json": "[]"}, headers=headers) as response:
+            status_code = response.status_code
+            async for line in response.aiter_lines():
+                if line and first_audio is None and json.loads(line).get("type") == "chunk":
+                    first_audio = time.perf_counter() - started
+    else:
+        response = await client.post("/api/ask-assistant", files=files, data={"history_json": "[]"}, headers=headers)
+        status_code = response.status_code
+    return {"status": status_code, "latency": time.perf_counter() - started, "first_audio": first_audio}
+
+async def _round(client: httpx.AsyncClient, args, audio_bytes: bytes, filename: str):
+    started = time.perf_counter()
+    results = await asyncio.gather(*[_ask(client, args, audio_bytes, filename) for _ in range(args.concurrency)])
+    wall = time.perf_counter() - started
+    latencies = [result["latency"] for result in results]
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    line = (f"запросов: {len(results)}  коды: {statuses}  общее время: {wall:.2f} с  "
+            f"p50: {statistics.median(latencies):.2f} с  max: {max(latencies):.2f} с  "
+            f"перекрытие: {sum(latencies) / wall:.1f}x")
+    first_audio = [result["first_audio"] for result in results if result["first_audio"] is not None]
+    if first_audio:
+        line += f"  первая фраза p50: {statistics.median(first_audio):.2f} с"
+    print(line)
+    return latencies, wall
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("audio", help="Аудиофайл с вопросом (ogg/webm/wav)")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--init-data", default=os.getenv("TELEGRAM_INIT_DATA"), help="Валидный X-Telegram-Init-Data")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--stream", action="store_true", help="Потоковый эндпоинт /api/ask-assistant/stream")
+    args = parser.parse_args()
+
+    if not args.init_data:
+        sys.exit("Нужен --init-data или TELEGRAM_INIT_DATA.")
+    with open(args.audio, "rb") as f:
+        audio_bytes = f.read()
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=120) as client:
+        # Один запрос — базовая задержка без конкуренции
+        baseline = await _ask(client, args, audio_bytes, os.path.basename(args.audio))
+        print(f"Один запрос: {baseline['latency']:.2f} с (код {baseline['status']})")
+        all_latencies, walls = [], []
+        for _ in range(args.rounds):
+            latencies, wall = await _round(client, args, audio_bytes, os.path.basename(args.audio))
+            all_latencies += latencies
+            walls.append(wall)
+
+    print()
+    print(f"p50: {statistics.median(all_latencies):.2f} с  p95: {_percentile(all_latencies, 0.95):.2f} с  "
+          f"среднее общее время раунда: {statistics.mean(walls):.2f} с")
+    serial = baseline["latency"] * args.concurrency
+    print(f"Последовательно {args.concurrency} запросов заняли бы ≈ {serial:.1f} с — "
+          f"{'запросы выполняются параллельно' if statistics.mean(walls) < serial / 2 else 'запросы выстраиваются в очередь'}.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
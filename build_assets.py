@@ -0,0 +1,147 @@
+# build_assets.py
+"""
+Сборка шаблонов батыров для PiAPI.
+
+Исходные картинки (многомегабайтные PNG) уменьшаются до разрешения, которое
+реально нужно PiAPI, перекодируются в JPEG и складываются в ASSETS_DIR под
+именем по хэшу содержимого. Рядом пишется manifest.json, который читает
+рантайм-каталог (batyr_templates.py).
+
+Сборка инкрементальная: неизменившиеся исходники повторно не кодируются.
+Запуск вручную: python build_assets.py
+"""
+import os
+import io
+import json
+import time
+import hashlib
+import tempfile
+from typing import Dict, List, Optional
+
+from PIL import Image, ImageOps
+
+# --- Конфигурация ---
+TEMPLATE_SOURCE_DIRS = {
+    "male": os.getenv("MALE_IMAGE_DIR", "/app/batyr-images"),
+    "female": os.getenv("FEMALE_IMAGE_DIR", "/app/batyrKyz-images"),
+}
+ASSETS_DIR = os.getenv("BATYR_ASSETS_DIR", "/app/storage/batyr-assets")
+MANIFEST_NAME = "manifest.json"
+# Сторона, до которой уменьшаем шаблон: PiAPI все равно работает примерно в таком разрешении
+TARGET_MAX_SIZE = int(os.getenv("PIAPI_TARGET_MAX_SIZE", 1024))
+TARGET_JPEG_QUALITY = int(os.getenv("PIAPI_TARGET_JPEG_QUALITY", 90))
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+MANIFEST_VERSION = 1
+# Файлы, выпавшие из манифеста, удаляем не сразу: другие процессы (воркеры API, воркер очереди)
+# держат старый каталог до своей перезагрузки и открывают файлы шаблонов лениво
+ORPHAN_GRACE_SECONDS = int(os.getenv("BATYR_ASSETS_ORPHAN_GRACE", 3600))
+
+
+def _atomic_write(path: str, data: bytes):
+    """Пишет файл атомарно, чтобы API и воркер могли собирать ассеты одновременно."""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _encode_template(source_path: str) -> Dict:
+    with Image.open(source_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((TARGET_MAX_SIZE, TARGET_MAX_SIZE), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=TARGET_JPEG_QUALITY, optimize=True)
+        width, height = img.size
+    encoded = buffer.getvalue()
+    digest = hashlib.sha256(encoded).hexdigest()
+    filename = f"{digest[:16]}.jpg"
+    target_path = os.path.join(ASSETS_DIR, filename)
+    if not os.path.exists(target_path):
+        _atomic_write(target_path, encoded)
+    return {"file": filename, "sha256": digest, "width": width, "height": height, "bytes": len(encoded), "mime_type": "image/jpeg"}
+
+def load_manifest() -> Optional[Dict]:
+    manifest_path = os.path.join(ASSETS_DIR, MANIFEST_NAME)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("max_size") != TARGET_MAX_SIZE:
+        return None
+    return manifest
+
+def build_assets() -> Dict:
+    """Собирает (или обновляет) ассеты и возвращает манифест."""
+    os.makedirs(ASSETS_DIR, exist_ok=True)
+    previous = load_manifest() or {}
+    previous_entries = {
+        (gender, entry["name"]): entry
+        for gender, entries in previous.get("templates", {}).items()
+        for entry in entries
+    }
+    templates: Dict[str, List[Dict]] = {}
+    rebuilt = 0
+    for gender, source_dir in TEMPLATE_SOURCE_DIRS.items():
+        templates[gender] = []
+        if not os.path.isdir(source_dir):
+            print(f"⚠️ Директория {source_dir} не найдена.")
+            continue
+        for filename in sorted(os.listdir(source_dir)):
+            if not filename.lower().endswith(SOURCE_EXTENSIONS):
+                continue
+            source_path = os.path.join(source_dir, filename)
+            stat = os.stat(source_path)
+            cached = previous_entries.get((gender, filename))
+            if (cached and cached["source_mtime"] == stat.st_mtime and cached["source_size"] == stat.st_size
+                    and os.path.exists(os.path.join(ASSETS_DIR, cached["file"]))):
+                templates[gender].append(cached)
+                continue
+            try:
+                entry = _encode_template(source_path)
+            except Exception as e:
+                print(f"⚠️ Не удалось обработать файл {filename}: {e}")
+                continue
+            entry.update({"name": filename, "source_mtime": stat.st_mtime, "source_size": stat.st_size})
+            templates[gender].append(entry)
+            rebuilt += 1
+            print(f"🖼️ {filename}: {stat.st_size // 1024} КБ -> {entry['bytes'] // 1024} КБ ({entry['width']}x{entry['height']})")
+
+    superseded = _remove_orphaned_files(templates, previous.get("superseded", {}))
+    manifest = {"version": MANIFEST_VERSION, "max_size": TARGET_MAX_SIZE, "templates": templates, "superseded": superseded}
+    if rebuilt or templates != previous.get("templates") or superseded != previous.get("superseded", {}):
+        _atomic_write(os.path.join(ASSETS_DIR, MANIFEST_NAME), json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+    print(f"✅ Ассеты шаблонов готовы: пересобрано {rebuilt}, всего {sum(len(v) for v in templates.values())}.")
+    return manifest
+
+def _remove_orphaned_files(templates: Dict[str, List[Dict]], superseded: Dict[str, float]) -> Dict[str, float]:
+    """
+    Удаляет файлы, которых нет в манифесте дольше ORPHAN_GRACE_SECONDS.
+    Возвращает {файл: когда выпал из манифеста} для тех, что пока оставлены.
+    """
+    used = {entry["file"] for entries in templates.values() for entry in entries}
+    now = time.time()
+    remaining = {}
+    for filename in os.listdir(ASSETS_DIR):
+        if not filename.endswith(".jpg") or filename in used:
+            continue
+        since = superseded.get(filename, now)
+        if now - since < ORPHAN_GRACE_SECONDS:
+            remaining[filename] = since
+            continue
+        try:
+            os.remove(os.path.join(ASSETS_DIR, filename))
+        except OSError:
+            remaining[filename] = since
+    return remaining
+
+
+if __name__ == "__main__":
+    build_assets()
@@ -2,22 +2,50 @@
 import sqlite3
 import datetime
 import os # ✅ Добавляем импорт os
+import threading
 from pathlib import Path
-from typing import Tuple
+from typing import Tuple, List, Iterator
 
 # --- Константы и инициализация ---
 DB_FILE = Path("storage/users.db")
-DAILY_LIMIT = 1 
+DAILY_LIMIT = 1
 # ✅ Получаем ID админа из переменных окружения
 ADMIN_ID = int(os.getenv("ADMIN_TELEGRAM_ID", "0"))
+# Сколько подготовленных выражений sqlite3 держит в кэше на соединение
+STATEMENT_CACHE_SIZE = 128
+BUSY_TIMEOUT_MS = 5000
+
+# --- Постоянные соединения ---
+# Одно соединение на поток (sqlite3 не разрешает делить соединение между потоками).
+# После fork (несколько воркеров uvicorn) соединение открывается заново.
+_local = threading.local()
+
+def _apply_pragmas(conn: sqlite3.Connection):
+    # WAL: читатели не блокируют писателя, запись не ждет fsync всего журнала
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")
+    conn.execute("PRAGMA mmap_size=67108864")
+
+def get_connection() -> sqlite3.Connection:
+    """Возвращает постоянное соединение текущего потока."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        # isolation_level=None: автокоммит, транзакции открываем явно там, где нужно
+        conn = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+        _apply_pragmas(conn)
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
 
 def init_db():
     """Инициализирует базу данных и создает таблицу, если она не существует."""
     try:
         DB_FILE.parent.mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
+        conn = get_connection()
+        conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -27,8 +55,6 @@ def init_db():
                 first_seen_date TEXT NOT NULL
             )
         ''')
-        conn.commit()
-        conn.close()
         print(f"✅ База данных инициализирована: {DB_FILE}")
         if ADMIN_ID != 0:
             print(f"👑 Пользователь с ID {ADMIN_ID} является админом.")
@@ -43,89 +69,125 @@ def get_or_create_user(user_id: int, username: str, first_name: str) -> None:
     Проверяет, существует ли пользователь. Если нет - создает его.
     Вызывается только с проверенными данными из initData.
     """
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
         today_str = datetime.date.today().isoformat()
-
-        cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-        user_exists = cursor.fetchone()
-
-        if not user_exists:
-            cursor.execute(
-                "INSERT INTO users (user_id, username, first_name, usage_count, last_usage_date, first_seen_date) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, username, first_name, 0, '1970-01-01', today_str)
-            )
-            conn.commit()
+        cursor = get_connection().execute(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, usage_count, last_usage_date, first_seen_date) VALUES (?, ?, ?, 0, '1970-01-01', ?)",
+            (user_id, username, first_name, today_str)
+        )
+        if cursor.rowcount:
             print(f"✅ Новый пользователь {user_id} ({first_name}) зарегистрирован в системе.")
-
     except Exception as e:
         print(f"🔥 Ошибка в get_or_create_user для user_id {user_id}: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
-def can_user_generate(user_id: int) -> Tuple[bool, str, int]:
+def register_users_batch(users: List[Tuple[int, str, str]]) -> None:
+    """
+    Регистрирует пачку пользователей одной транзакцией (user_id, username, first_name).
+    Уже существующие пользователи не изменяются.
     """
-    Проверяет, может ли пользователь генерировать, и списывает попытку.
+    if not users:
+        return
+    conn = get_connection()
+    today_str = datetime.date.today().isoformat()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, usage_count, last_usage_date, first_seen_date) VALUES (?, ?, ?, 0, '1970-01-01', ?)",
+            [(user_id, username, first_name, today_str) for user_id, username, first_name in users]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if cursor.rowcount:
+        print(f"✅ Зарегистрировано новых пользователей: {cursor.rowcount}")
+
+
+# Проверка и списание попытки одним атомарным выражением: новый день сбрасывает счетчик,
+# а при исчерпанном лимите WHERE не дает обновить строку и RETURNING ничего не вернет.
+# Безопасно при нескольких воркерах uvicorn — SQLite сериализует запись.
+QUOTA_UPSERT_SQL = """
+    INSERT INTO users (user_id, username, first_name, usage_count, last_usage_date, first_seen_date)
+    SELECT :user_id, 'unknown', 'unknown', :amount, :today, :today WHERE :amount <= :limit
+    ON CONFLICT(user_id) DO UPDATE SET
+        usage_count = CASE WHEN users.last_usage_date = :today THEN users.usage_count + :amount ELSE :amount END,
+        last_usage_date = :today
+    WHERE (users.last_usage_date != :today AND :amount <= :limit) OR users.usage_count + :amount <= :limit
+    RETURNING usage_count
+"""
+
+def can_user_generate(user_id: int, amount: int = 1) -> Tuple[bool, str, int]:
+    """
+    Проверяет, может ли пользователь генерировать, и списывает amount попыток.
     Админы имеют бесконечные попытки.
     """
     # ✅ Проверка на админа в самом начале
     if user_id == ADMIN_ID:
         return True, "👑 Админу можно всё!", 999 # Возвращаем условное большое число попыток
 
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
         today_str = datetime.date.today().isoformat()
-
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user_data = cursor.fetchone()
-
-        if user_data is None:
-            return False, "Пользователь не найден. Пожалуйста, перезапустите приложение.", 0
-
-        last_date_str = user_data['last_usage_date']
-        current_usage = user_data['usage_count']
-
-        if last_date_str != today_str:
-            current_usage = 0
-        
-        if current_usage < DAILY_LIMIT:
-            new_count = current_usage + 1
-            cursor.execute(
-                "UPDATE users SET usage_count = ?, last_usage_date = ? WHERE user_id = ?",
-                (new_count, today_str, user_id)
-            )
-            conn.commit()
-            remaining = DAILY_LIMIT - new_count
-            return True, f"Генерация разрешена. Осталось сегодня: {remaining}", remaining
-        else:
+        # fetchall, а не fetchone: выражение должно завершиться, иначе блокировка записи останется висеть
+        rows = get_connection().execute(QUOTA_UPSERT_SQL, {"user_id": user_id, "today": today_str, "limit": DAILY_LIMIT, "amount": amount}).fetchall()
+        if not rows:
             return False, f"Дневной лимит ({DAILY_LIMIT}) исчерпан. Возвращайтесь завтра!", 0
+        remaining = DAILY_LIMIT - rows[0][0]
+        return True, f"Генерация разрешена. Осталось сегодня: {remaining}", remaining
 
     except Exception as e:
         print(f"🔥 Ошибка в can_user_generate для user_id {user_id}: {e}")
         return False, "Произошла ошибка при проверке лимита.", 0
-    finally:
-        if conn:
-            conn.close()
 
 def get_total_users_count() -> int:
     """Подсчитывает общее количество пользователей в базе."""
-    conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(user_id) FROM users")
-        count = cursor.fetchone()[0]
-        return count
+        return get_connection().execute("SELECT COUNT(user_id) FROM users").fetchone()[0]
     except Exception as e:
         print(f"🔥 Ошибка при подсчете пользователей: {e}")
         return 0
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+
+def get_today_usage(user_id: int) -> int:
+    """Сколько попыток пользователь уже потратил сегодня (по данным SQLite)."""
+    today_str = datetime.date.today().isoformat()
+    row = get_connection().execute(
+        "SELECT usage_count FROM users WHERE user_id = ? AND last_usage_date = ?", (user_id, today_str)
+    ).fetchone()
+    return row[0] if row else 0
+
+def iter_user_ids(batch_size: int = 5000) -> Iterator[List[int]]:
+    """Отдает ID всех пользователей пачками (для заполнения счетчиков в Redis)."""
+    cursor = get_connection().execute("SELECT user_id FROM users")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield [row[0] for row in rows]
+
+def apply_usage_batch(usage: List[Tuple[int, str, int]]) -> None:
+    """
+    Переносит счетчики попыток из Redis в SQLite одной транзакцией (user_id, дата, usage_count).
+    Более старые данные не перезаписывают более свежий день, а за тот же день счетчик
+    только растет: попытки, списанные в SQLite при недоступном Redis, не теряются.
+    """
+    if not usage:
+        return
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            """
+            INSERT INTO users (user_id, username, first_name, usage_count, last_usage_date, first_seen_date)
+            VALUES (?, 'unknown', 'unknown', ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                usage_count = CASE WHEN users.last_usage_date = excluded.last_usage_date
+                    THEN MAX(users.usage_count, excluded.usage_count) ELSE excluded.usage_count END,
+                last_usage_date = excluded.last_usage_date
+            WHERE users.last_usage_date <= excluded.last_usage_date
+            """,
+            [(user_id, usage_count, usage_date, usage_date) for user_id, usage_date, usage_count in usage]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
@@ -0,0 +1,50 @@
+# face_detect.py
+import os
+from typing import Optional
+
+from PIL import Image
+
+# OpenCV — необязательная зависимость. Без него проверка лица отключается,
+# и фото без лица по-прежнему отсеивает PiAPI ("face not found").
+try:
+    import cv2
+    import numpy as np
+    OPENCV_AVAILABLE = True
+except ImportError:
+    OPENCV_AVAILABLE = False
+
+# --- Конфигурация детектора ---
+FACE_CHECK_ENABLED = os.getenv("FACE_CHECK_ENABLED", "true").lower() == "true" and OPENCV_AVAILABLE
+# Детектор работает на еще более уменьшенной копии фото — этого хватает для лиц на селфи
+FACE_DETECT_SIZE = int(os.getenv("FACE_DETECT_SIZE", 480))
+FACE_SCALE_FACTOR = float(os.getenv("FACE_SCALE_FACTOR", 1.1))
+FACE_MIN_NEIGHBORS = int(os.getenv("FACE_MIN_NEIGHBORS", 5))
+# Минимальный размер лица относительно меньшей стороны фото
+FACE_MIN_SIZE_RATIO = float(os.getenv("FACE_MIN_SIZE_RATIO", 0.08))
+
+_cascades = None
+
+
+def _get_cascades():
+    """Каскады Хаара загружаются один раз на процесс пула."""
+    global _cascades
+    if _cascades is None:
+        _cascades = [
+            cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, name))
+            for name in ("haarcascade_frontalface_default.xml", "haarcascade_profileface.xml")
+        ]
+    return _cascades
+
+def count_faces(img: Image.Image) -> Optional[int]:
+    """Возвращает число найденных лиц или None, если проверка отключена."""
+    if not FACE_CHECK_ENABLED:
+        return None
+    gray = img.convert("L")
+    gray.thumbnail((FACE_DETECT_SIZE, FACE_DETECT_SIZE))
+    pixels = cv2.equalizeHist(np.asarray(gray))
+    min_side = int(min(pixels.shape) * FACE_MIN_SIZE_RATIO)
+    for cascade in _get_cascades():
+        faces = cascade.detectMultiScale(pixels, scaleFactor=FACE_SCALE_FACTOR, minNeighbors=FACE_MIN_NEIGHBORS, minSize=(min_side, min_side))
+        if len(faces):
+            return len(faces)
+    return 0
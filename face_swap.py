@@ -0,0 +1,242 @@
+# face_swap.py
+import os
+import time
+import base64
+import asyncio
+import traceback
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from job_queue import (
+    update_job_status, update_variant_status, set_piapi_task_id, claim_job_result, is_job_finished,
+    record_piapi_duration, get_piapi_durations
+)
+from http_clients import get_telegram_client
+from piapi_client import submit_task, get_task_status, PiAPIError, PiAPIUnavailable
+from poll_schedule import poll_delays, DURATIONS_CACHE_TTL
+from batyr_templates import get_batyr_template, get_target_image_reference, refresh_catalogue_if_changed
+from swap_cache import store_result
+from result_images import prefetch_result_image
+from admission import piapi_slot
+from metrics import FACE_SWAP_STAGE_SECONDS, FACE_SWAP_OUTCOMES, observe_seconds
+
+load_dotenv()
+
+# --- Конфигурация ---
+PIAPI_KEY = os.getenv("PIAPI_API_KEY")
+MAX_POLLING_TIME = 120
+# Сколько опросов подряд может завершиться ошибкой, прежде чем задача считается проваленной
+MAX_CONSECUTIVE_POLL_FAILURES = int(os.getenv("PIAPI_MAX_POLL_FAILURES", 5))
+# Режим вебхука: PiAPI сам сообщает о завершении на /api/piapi/webhook, опрос остается страховкой
+PIAPI_WEBHOOK_URL = os.getenv("PIAPI_WEBHOOK_URL")
+PIAPI_WEBHOOK_SECRET = os.getenv("PIAPI_WEBHOOK_SECRET")
+WEBHOOK_ENABLED = bool(PIAPI_WEBHOOK_URL and PIAPI_WEBHOOK_SECRET)
+# Как часто воркер проверяет в Redis, не записал ли вебхук результат
+WEBHOOK_RESULT_CHECK_INTERVAL = 1.0
+
+if not PIAPI_KEY:
+    raise RuntimeError("Не найден PIAPI_API_KEY в .env файле")
+
+# --- Вспомогательные функции ---
+def photo_to_data_uri(jpeg_bytes: bytes) -> str:
+    """Фото уже уменьшено и перекодировано в JPEG на этапе загрузки (photo_preprocess.py)."""
+    encoded_string = base64.b64encode(jpeg_bytes).decode('utf-8')
+    return f"data:image/jpeg;base64,{encoded_string}"
+
+async def send_telegram_message(user_id: int, text: str):
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token:
+        print("⚠️ TELEGRAM_BOT_TOKEN не найден, сообщение не отправлено.")
+        return
+    payload = { "chat_id": user_id, "text": text, "parse_mode": "HTML" }
+    try:
+        await get_telegram_client().post(f"/bot{token}/sendMessage", json=payload)
+        print(f"✉️ Сообщение отправлено пользователю {user_id}")
+    except Exception as e:
+        print(f"🔥 Не удалось отправить сообщение пользователю {user_id}: {e}")
+
+
+# --- Финальный статус задачи ---
+def build_final_status(piapi_data: dict) -> Optional[dict]:
+    """Преобразует ответ PiAPI в финальный статус задачи или None, если задача еще идет."""
+    piapi_status = piapi_data.get("status", "Unknown").title()
+    if piapi_status == "Completed":
+        result_url = piapi_data.get("output", {}).get("image_url")
+        return {"status": "completed", "result_url": result_url, "message": "✅ Изображение готово"}
+    elif piapi_status == "Failed":
+        error_details = str(piapi_data.get("error", "Неизвестная ошибка PiAPI")).lower()
+        if "face not found" in error_details:
+            return {"status": "failed", "error": "Не удалось найти лицо на фото. Попробуйте другое.", "error_code": "face_not_found"}
+        return {"status": "failed", "error": f"PiAPI ошибка: {piapi_data.get('error', 'Неизвестная ошибка')}"}
+    elif piapi_status in ["Processing", "Pending", "Staged"]:
+        return None
+    return {"status": "failed", "error": f"Неизвестный статус PiAPI: {piapi_status}"}
+
+async def _set_status(job: dict, status_data: dict) -> Optional[dict]:
+    """
+    Обновляет статус задачи, а у варианта — еще и прогресс родительской задачи.
+    Возвращает финальный статус родителя, если этим обновлением завершился последний вариант.
+    """
+    await update_job_status(job["job_id"], status_data)
+    if job.get("parent_job_id"):
+        return await update_variant_status(job["parent_job_id"], job["job_id"], status_data)
+    return None
+
+async def finalize_job(job: dict, status_data: dict) -> bool:
+    """
+    Идемпотентно записывает финальный статус. Вызывается и вебхуком, и опросом —
+    применяется только первый вызов, повторные возвращают False.
+    job — метаданные задачи (load_job или get_job_meta).
+    """
+    job_id = job["job_id"]
+    if not await claim_job_result(job_id, status_data["status"]):
+        print(f"↩️ [Job: {job_id}] Финальный статус уже записан, пропускаю.")
+        return False
+    parent_status = await _set_status(job, status_data)
+    FACE_SWAP_OUTCOMES.labels(outcome=status_data.get("error_code") or status_data["status"]).inc()
+    if job.get("created_at"):
+        FACE_SWAP_STAGE_SECONDS.labels(stage="end_to_end").observe(time.time() - job["created_at"])
+    if job.get("submitted_at") and status_data["status"] in ("completed", "failed"):
+        # Время в PiAPI: ожидание в их очереди плюс рендер
+        FACE_SWAP_STAGE_SECONDS.labels(stage="piapi_render").observe(time.time() - job["submitted_at"])
+        await record_piapi_duration(time.time() - job["submitted_at"])
+    if status_data["status"] == "completed":
+        if status_data.get("result_url") and job.get("photo_hash") and job.get("template_sha"):
+            await store_result(job["user_id"], job["photo_hash"], job["template_sha"], status_data["result_url"])
+        # По вариантам одного фото пишем один раз — когда готов последний
+        if not job.get("parent_job_id"):
+            await send_telegram_message(job["user_id"], "<b>Ваш портрет батыра готов!</b>\n\nВозвращайтесь в приложение, чтобы скачать его.")
+        await prefetch_result_image(status_data.get("result_url"))
+    if parent_status and parent_status["status"] == "completed":
+        await send_telegram_message(job["user_id"], "<b>Ваши портреты батыра готовы!</b>\n\nВозвращайтесь в приложение, чтобы скачать их.")
+    return True
+
+
+# --- История времени выполнения PiAPI (обновляется раз в минуту) ---
+_durations_cache = {"values": [], "loaded_at": 0.0}
+
+async def _get_cached_piapi_durations() -> List[float]:
+    if time.monotonic() - _durations_cache["loaded_at"] > DURATIONS_CACHE_TTL:
+        try:
+            _durations_cache["values"] = await get_piapi_durations()
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить статистику PiAPI: {e}")
+        _durations_cache["loaded_at"] = time.monotonic()
+    return _durations_cache["values"]
+
+async def _wait_before_poll(job_id: str, delay: float) -> bool:
+    """Ждет до следующего опроса. Возвращает True, если за это время результат записал вебхук."""
+    if not WEBHOOK_ENABLED:
+        await asyncio.sleep(delay)
+        return False
+    waited = 0.0
+    while waited < delay:
+        step = min(WEBHOOK_RESULT_CHECK_INTERVAL, delay - waited)
+        await asyncio.sleep(step)
+        waited += step
+        if await is_job_finished(job_id):
+            return True
+    return False
+
+
+# --- Пайплайн замены лица (выполняется воркером) ---
+async def _report_queue_position(job: dict, position: int, estimated_wait: int):
+    await _set_status(job, {
+        "status": "queued",
+        "queue_position": position,
+        "estimated_wait": estimated_wait,
+        "message": f"⏳ Вы в очереди: {position}. Примерное ожидание — {estimated_wait} с",
+    })
+
+async def _submit_and_poll(job: dict):
+    """Отправляет задачу в PiAPI (или продолжает опрос уже отправленной) и записывает результат."""
+    job_id = job["job_id"]
+    piapi_task_id = job.get("piapi_task_id")
+    submitted_at = job.get("submitted_at") or time.time()
+    if piapi_task_id:
+        print(f"♻️ [Job: {job_id}] Возобновляю опрос PiAPI задачи {piapi_task_id}.")
+        await _set_status(job, {"status": "processing", "queue_position": 0, "message": "👨‍🎨 Нейросеть рисует..."})
+    else:
+        await _set_status(job, {"status": "processing", "queue_position": 0, "message": "⏳ Подбираю образ..."})
+        user_photo_data_uri = photo_to_data_uri(job["user_photo_bytes"])
+        # Проверка читает директории шаблонов (а иногда пересобирает каталог) — не в event loop
+        await asyncio.to_thread(refresh_catalogue_if_changed)
+        target_image_uri = await get_target_image_reference(get_batyr_template(job.get("template_sha"), job["gender"]))
+        payload = { "model": "Qubico/image-toolkit", "task_type": "face-swap", "input": {"target_image": target_image_uri, "swap_image": user_photo_data_uri} }
+        if WEBHOOK_ENABLED:
+            payload["config"] = {"webhook_config": {"endpoint": PIAPI_WEBHOOK_URL, "secret": PIAPI_WEBHOOK_SECRET}}
+        await _set_status(job, {"status": "sending", "message": "🛰️ Отправляю данные в нейросеть..."})
+        # Повтор только если запрос не дошел до PiAPI, быстрый отказ при недоступности — в piapi_client.py
+        with observe_seconds(FACE_SWAP_STAGE_SECONDS, stage="piapi_submit"):
+            piapi_task_id = await submit_task(payload)
+        await set_piapi_task_id(job_id, piapi_task_id)
+        submitted_at = time.time()
+        job["submitted_at"] = submitted_at
+
+    # Опрашиваем хотя бы один раз, даже если задача была возобновлена после дедлайна
+    deadline = max(submitted_at + MAX_POLLING_TIME, time.time() + 1)
+    durations = await _get_cached_piapi_durations()
+    poll_failures = 0
+    for delay in poll_delays(submitted_at, durations, WEBHOOK_ENABLED):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        if await _wait_before_poll(job_id, min(delay, remaining)):
+            return
+        try:
+            status_code, piapi_data = await get_task_status(piapi_task_id)
+        except PiAPIUnavailable:
+            # Цепь разомкнута и запрос не отправлялся: задача в PiAPI уже создана,
+            # поэтому просто ждем следующего опроса (ограничены общим дедлайном)
+            print(f"🔌 [Job: {job_id}] PiAPI временно недоступен, опрос отложен.")
+            continue
+        except PiAPIError as e:
+            status_code, piapi_data = None, {}
+            print(f"⚠️ [Job: {job_id}] Ошибка опроса PiAPI: {e}")
+        if status_code != 200:
+            # Не ждем общего таймаута, если PiAPI стабильно не отвечает на опрос
+            poll_failures += 1
+            if poll_failures >= MAX_CONSECUTIVE_POLL_FAILURES:
+                await finalize_job(job, {"status": "failed", "error": f"PiAPI не отвечает на запросы статуса ({poll_failures} раз подряд)"})
+                return
+            continue
+        poll_failures = 0
+        final_status = build_final_status(piapi_data)
+        if final_status:
+            await finalize_job(job, final_status)
+            return
+        piapi_status = piapi_data.get("status", "Unknown").title()
+        # Если финальный статус только что записал вебхук, update_job_status промежуточный не запишет
+        await _set_status(job, {"status": "processing", "message": f"👨‍🎨 Нейросеть рисует... (статус: {piapi_status})"})
+    await finalize_job(job, {"status": "timeout", "error": f"Превышено время ожидания ({MAX_POLLING_TIME}с)"})
+
+async def run_face_swap_job(job: dict):
+    """
+    Выполняет одну задачу из очереди. Если у задачи уже есть piapi_task_id
+    (воркер был перезапущен), повторно в PiAPI не отправляем — продолжаем опрос.
+    Отправка и опрос идут только под слотом PiAPI (admission.py), чтобы всплеск
+    нагрузки не упирался в ограничения PiAPI и не замедлял все задачи сразу.
+    """
+    job_id = job["job_id"]
+    try:
+        if await is_job_finished(job_id):
+            return
+        async def on_wait(position: int, estimated_wait: int):
+            await _report_queue_position(job, position, estimated_wait)
+        waiting_since = time.perf_counter()
+        async with piapi_slot(job_id, on_wait=on_wait):
+            FACE_SWAP_STAGE_SECONDS.labels(stage="admission_wait").observe(time.perf_counter() - waiting_since)
+            await _submit_and_poll(job)
+    except PiAPIUnavailable:
+        print(f"🔌 [Job: {job_id}] PiAPI недоступен, задача отклонена сразу.")
+        await finalize_job(job, {"status": "failed", "error": "Сервис генерации временно недоступен. Попробуйте позже."})
+    except asyncio.CancelledError:
+        # Воркер останавливается: задача останется в списке обработки и будет возобновлена
+        raise
+    except Exception as e:
+        error_msg = f"Критическая ошибка в фоновой задаче: {str(e)}"
+        traceback.print_exc()
+        # Через finalize_job: заявка на финальный статус не даст вебхуку или опросу его перезаписать,
+        # родитель варианта и пользователь узнают о результате, исход считается там же
+        await finalize_job(job, {"status": "failed", "error": error_msg})
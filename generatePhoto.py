@@ -1,97 +1,70 @@
 # main.py
 import os
-import httpx
-import base64
-import traceback
-import random
 import uuid
 import json
-import time
+import asyncio
 from datetime import datetime
+from contextlib import asynccontextmanager
 from typing import List, Dict, Optional
-import asyncio
 import hmac
+import time
 import hashlib
-from urllib.parse import unquote
-
-from PIL import Image
-import io
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, status, BackgroundTasks, Header, Depends, Security
+from fastapi import FastAPI, HTTPException, status, Header, Depends, Security, Request, Query, WebSocket, WebSocketDisconnect
 from fastapi.security import APIKeyHeader
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse, Response, JSONResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-import redis
 
 from pydantic import BaseModel
-from database import init_db, get_or_create_user, can_user_generate, get_total_users_count
+from database import init_db, register_users_batch
+from quota import consume_quota, mark_user_seen, seed_users_set, get_total_users, run_reconciler
+from telegram_auth import validate_init_data, InitDataError, UserRegistrar
+from face_swap import build_final_status, finalize_job, PIAPI_WEBHOOK_SECRET
+from batyr_templates import batyr_images_caches, ensure_catalogue_loaded, get_catalogue_status, get_random_batyr_templates, find_batyr_template
+from swap_cache import get_cached_result, get_cache_stats
+from admission import get_admission_stats, estimate_wait, ADMISSION_MAX_BACKLOG
+from result_images import get_cached_result_image, build_etag, RESULT_CACHE_ACCEL_PREFIX
+from job_queue import (
+    enqueue_face_swap_job, get_queue_length, get_job_id_by_piapi_task, get_job_meta,
+    update_job_status, claim_job_result, get_job_status, get_job_statuses, subscribe_job_events,
+    create_parent_job, update_variant_status
+)
+from redis_conn import redis_async, close_redis, REDIS_HOST, REDIS_PORT
+from http_clients import get_telegram_client, get_download_client, close_http_clients
+from photo_preprocess import preprocess_photo_async, shutdown_preprocess_pool
+from upload_ingest import ingest_upload, UploadRejected, IngestedUpload
+from metrics import FACE_SWAP_STAGE_SECONDS, FACE_SWAP_OUTCOMES, observe_seconds, render_metrics
 
 load_dotenv()
 
-# --- Конфигурация ---
-PIAPI_KEY = os.getenv("PIAPI_API_KEY")
-# Определяем директории для обоих полов
-MALE_IMAGE_DIR = "/app/batyr-images"
-FEMALE_IMAGE_DIR = "/app/batyrKyz-images"
-REDIS_HOST = os.getenv("REDIS_HOST", "redis")
-REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
-MAX_POLLING_TIME = 120
-POLLING_INTERVAL = 2
-
-if not PIAPI_KEY:
-    raise RuntimeError("Не найден PIAPI_API_KEY в .env файле")
-
-# --- Подключение к Redis ---
-try:
-    redis_pool = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
-    redis_client = redis.Redis(connection_pool=redis_pool)
-    redis_client.ping()
-    print(f"✅ Подключено к Redis по адресу: {REDIS_HOST}:{REDIS_PORT}")
-except redis.exceptions.ConnectionError as e:
-    print(f"❌ Не удалось подключиться к Redis: {e}")
-    redis_client = None
-
-# --- Кэш изображений батыров ---
-# Теперь это словарь, где ключ - пол, а значение - список изображений
-batyr_images_caches: Dict[str, List[Dict[str, str]]] = {
-    "male": [],
-    "female": []
-}
-
-def _load_images_from_dir(directory_path: str) -> List[Dict[str, str]]:
-    """Вспомогательная функция для загрузки изображений из одной директории."""
-    images = []
-    print(f"⏳ Загрузка изображений из {directory_path}...")
+# --- Приложение FastAPI ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    # Под gunicorn каталог уже загружен в мастере (gunicorn.conf.py) — здесь только проверка
+    ensure_catalogue_loaded()
     try:
-        if not os.path.exists(directory_path):
-            print(f"⚠️ Директория {directory_path} не найдена.")
-            return images
-        for filename in os.listdir(directory_path):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                image_path = os.path.join(directory_path, filename)
-                try:
-                    with open(image_path, "rb") as image_file:
-                        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                        mime_type = f"image/{filename.split('.')[-1].lower().replace('jpg', 'jpeg')}"
-                        data_uri = f"data:{mime_type};base64,{encoded_string}"
-                        images.append({"name": filename, "data_uri": data_uri})
-                except Exception as e:
-                    print(f"⚠️ Не удалось обработать файл {filename}: {e}")
-        if images:
-            print(f"✅ Успешно закэшировано {len(images)} изображений из {directory_path}.")
-        else:
-            print(f"❌ Изображения для кэширования в {directory_path} не найдены.")
+        await redis_async.ping()
+        print(f"✅ Подключено к Redis по адресу: {REDIS_HOST}:{REDIS_PORT}")
     except Exception as e:
-        print(f"🔥 Критическая ошибка при кэшировании изображений из {directory_path}: {e}")
-    return images
-
-def load_all_batyr_images_to_cache():
-    """Главная функция для загрузки всех изображений в кэши по полам."""
-    batyr_images_caches["male"] = _load_images_from_dir(MALE_IMAGE_DIR)
-    batyr_images_caches["female"] = _load_images_from_dir(FEMALE_IMAGE_DIR)
+        print(f"❌ Не удалось подключиться к Redis: {e}")
+        raise RuntimeError("Не удалось установить соединение с Redis.")
+    await seed_users_set()
+    reconciler_task = asyncio.create_task(run_reconciler())
+    yield
+    # Общие HTTP-клиенты и пулы Redis живут столько же, сколько приложение
+    reconciler_task.cancel()
+    try:
+        await reconciler_task
+    except asyncio.CancelledError:
+        pass
+    user_registrar.stop()
+    await close_http_clients()
+    await close_redis()
+    shutdown_preprocess_pool()
 
-# --- Приложение FastAPI ---
 ENVIRONMENT = os.getenv("ENVIRONMENT", "development")
 fastapi_kwargs = {"title": "Batyr AI API", "description": "API для замены лиц на изображениях батыров."}
 if ENVIRONMENT == "production":
@@ -99,14 +72,7 @@ if ENVIRONMENT == "production":
     print("Main: 'production' mode. API docs disabled.")
 else:
     print("Main: 'development' mode. API docs available.")
-app = FastAPI(**fastapi_kwargs)
-
-
-@app.on_event("startup")
-def on_startup():
-    init_db()
-    load_all_batyr_images_to_cache()
-    if not redis_client: raise RuntimeError("Не удалось установить соединение с Redis.")
+app = FastAPI(lifespan=lifespan, **fastapi_kwargs)
 
 # --- Middleware для CORS ---
 origins = ["http://localhost:3000", "https://batyrai.com", "https://www.batyrai.com", "https://batyr-ai.vercel.app", "https://batyr-ai-madis-projects-f57aa02c.vercel.app"]
@@ -120,42 +86,59 @@ if not BOT_TOKEN:
 
 telegram_init_data_header = APIKeyHeader(name="X-Telegram-Init-Data", auto_error=False)
 
+# Новые пользователи записываются в БД пачками в фоне, а не на каждый запрос
+user_registrar = UserRegistrar(register_users_batch)
+
 async def get_validated_telegram_data(init_data: str = Security(telegram_init_data_header)):
     if not init_data:
         raise HTTPException(status_code=401, detail="X-Telegram-Init-Data header is missing")
     try:
-        unquoted_init_data = unquote(init_data)
-        data_check_string, hash_from_telegram = [], ''
-        for item in sorted(unquoted_init_data.split('&')):
-            key, value = item.split('=', 1)
-            if key == 'hash':
-                hash_from_telegram = value
-            else:
-                data_check_string.append(f"{key}={value}")
-        data_check_string = "\n".join(data_check_string)
-        secret_key = hmac.new("WebAppData".encode(), BOT_TOKEN.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-
-        if calculated_hash != hash_from_telegram:
-            raise HTTPException(status_code=403, detail="Invalid data signature")
-
-        user_data_dict = dict(kv.split('=') for kv in unquoted_init_data.split('&'))
-        user_data = json.loads(user_data_dict.get('user', '{}'))
-        user_id = user_data.get('id')
-        if not user_id:
-            raise ValueError("User ID not found in validated data")
-
-        # Создаем пользователя в БД, если его там нет
-        get_or_create_user(
-            user_id=user_id,
-            username=user_data.get('username', 'unknown'),
-            first_name=user_data.get('first_name', 'unknown')
-        )
-        
-        return user_data
-    except Exception as e:
+        user_data = validate_init_data(init_data)
+    except InitDataError as e:
         print(f"Ошибка валидации Telegram initData: {e}")
         raise HTTPException(status_code=403, detail="Could not validate Telegram credentials.")
+    if not user_data.get('id'):
+        print("Ошибка валидации Telegram initData: User ID not found in validated data")
+        raise HTTPException(status_code=403, detail="Could not validate Telegram credentials.")
+    if user_registrar.register(user_data):
+        # Новый для этого процесса пользователь — учитываем в счетчике (SADD идемпотентен)
+        try:
+            await mark_user_seen(user_data['id'])
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить счетчик пользователей: {e}")
+    return user_data
+
+
+# --- Токен потока статуса ---
+# EventSource и WebSocket в браузере не умеют слать заголовки, а initData в query попала бы
+# в логи nginx. Поэтому поток открывается по короткоживущему токену, привязанному к одной задаче:
+# "{истекает}.{HMAC(job_id:истекает)}". Он выдается вместе с job_id и дает только чтение статуса.
+STREAM_TOKEN_TTL = int(os.getenv("STREAM_TOKEN_TTL", 900))
+_STREAM_TOKEN_KEY = hmac.new(b"BatyrStreamToken", BOT_TOKEN.encode(), hashlib.sha256).digest()
+
+def _stream_token_signature(job_id: str, expires_at: int) -> str:
+    return hmac.new(_STREAM_TOKEN_KEY, f"{job_id}:{expires_at}".encode(), hashlib.sha256).hexdigest()
+
+def issue_stream_token(job_id: str) -> str:
+    expires_at = int(time.time()) + STREAM_TOKEN_TTL
+    return f"{expires_at}.{_stream_token_signature(job_id, expires_at)}"
+
+def is_valid_stream_token(job_id: str, token: Optional[str]) -> bool:
+    try:
+        expires_part, signature = (token or "").split(".", 1)
+        expires_at = int(expires_part)
+    except ValueError:
+        return False
+    return expires_at > time.time() and hmac.compare_digest(signature, _stream_token_signature(job_id, expires_at))
+
+async def authorize_task_stream(job_id: str, token: Optional[str], header_init_data: Optional[str]):
+    """Поток статуса: токен задачи (query) или initData в заголовке — для клиентов, которые его умеют слать."""
+    if is_valid_stream_token(job_id, token):
+        return
+    if header_init_data:
+        await get_validated_telegram_data(header_init_data)
+        return
+    raise HTTPException(status_code=403, detail="Недействительный или истекший токен потока.")
 
 
 # --- Модели данных ---
@@ -163,133 +146,232 @@ class PhotoSendRequest(BaseModel):
     imageUrl: str
 
 
-# --- Вспомогательные функции ---
-def get_random_batyr_image_uri(gender: str = "male") -> str:
-    # Выбираем кэш в зависимости от пола, по умолчанию 'male'
-    cache_key = gender if gender in batyr_images_caches and batyr_images_caches[gender] else "male"
-    
-    image_cache = batyr_images_caches[cache_key]
-    if not image_cache:
-        # Если для выбранного пола нет картинок, пробуем другой
-        fallback_key = "female" if cache_key == "male" else "male"
-        image_cache = batyr_images_caches.get(fallback_key, [])
-        if not image_cache:
-            raise ValueError("Кэш изображений батыров пуст для обоих полов.")
-    
-    return random.choice(image_cache)['data_uri']
-
-def update_job_status(job_id: str, status_data: dict):
-    try:
-        redis_client.set(job_id, json.dumps(status_data), ex=3600)
-        print(f"📝 [Job: {job_id}] Статус обновлен: {status_data.get('status', 'N/A')}")
-    except Exception as e:
-        print(f"❌ [Job: {job_id}] Ошибка обновления статуса в Redis: {e}")
-
-def resize_image_to_base64(image_bytes: bytes, max_size: int = 1024) -> str:
-    try:
-        img = Image.open(io.BytesIO(image_bytes))
-        if img.mode in ("RGBA", "P"): img = img.convert("RGB")
-        img.thumbnail((max_size, max_size))
-        buffer = io.BytesIO()
-        img.save(buffer, format="JPEG", quality=85)
-        encoded_string = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return f"data:image/jpeg;base64,{encoded_string}"
-    except Exception as e:
-        print(f"🔥 Ошибка при уменьшении изображения: {e}")
-        raise ValueError("Не удалось обработать изображение.") from e
-
-async def send_telegram_message(user_id: int, text: str):
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not token:
-        print("⚠️ TELEGRAM_BOT_TOKEN не найден, сообщение не отправлено.")
+# --- Главные эндпоинты с новой безопасной логикой ---
+# Сколько портретов можно заказать по одному фото за раз
+MAX_VARIANTS = int(os.getenv("MAX_VARIANTS", 4))
+
+async def _start_swap_job(job_id: str, template, processed_photo: dict, user_id: int, gender: str, cached_result_url: Optional[str], parent_job_id: Optional[str] = None):
+    """Отдает результат из кэша (cached_result_url) или ставит задачу в очередь воркера."""
+    # То же селфи с тем же шаблоном уже обрабатывалось — отдаем готовый результат без PiAPI
+    if cached_result_url:
+        await claim_job_result(job_id, "completed")
+        cached_status = {"status": "completed", "job_id": job_id, "result_url": cached_result_url, "message": "✅ Изображение готово", "cached": True}
+        await update_job_status(job_id, cached_status)
+        if parent_job_id:
+            await update_variant_status(parent_job_id, job_id, cached_status)
+        FACE_SWAP_OUTCOMES.labels(outcome="cached").inc()
+        print(f"⚡ [Job: {job_id}] Результат взят из кэша для пользователя {user_id}.")
         return
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    payload = { "chat_id": user_id, "text": text, "parse_mode": "HTML" }
-    try:
-        async with httpx.AsyncClient() as client:
-            await client.post(url, json=payload)
-        print(f"✉️ Сообщение отправлено пользователю {user_id}")
-    except Exception as e:
-        print(f"🔥 Не удалось отправить сообщение пользователю {user_id}: {e}")
+    # Задачу выполняет отдельный процесс worker.py, API только ставит её в очередь Redis
+    await enqueue_face_swap_job(job_id, processed_photo["jpeg_bytes"], user_id, gender, template.sha256, processed_photo["photo_hash"], parent_job_id=parent_job_id)
 
-def run_face_swap_in_background(job_id: str, user_photo_bytes: bytes, user_id: int, gender: str):
-    try:
-        update_job_status(job_id, {"status": "processing", "message": "⏳ Уменьшаю ваше фото и подбираю образ..."})
-        user_photo_data_uri = resize_image_to_base64(user_photo_bytes)
-        target_image_uri = get_random_batyr_image_uri(gender)
-        headers = {"x-api-key": PIAPI_KEY, "Content-Type": "application/json"}
-        payload = { "model": "Qubico/image-toolkit", "task_type": "face-swap", "input": {"target_image": target_image_uri, "swap_image": user_photo_data_uri} }
-        update_job_status(job_id, {"status": "sending", "message": "🛰️ Отправляю данные в нейросеть..."})
-        with httpx.Client(timeout=30.0) as client:
-            response = client.post("https://api.piapi.ai/api/v1/task", headers=headers, json=payload)
-            response.raise_for_status()
-            task_response = response.json()
-        piapi_task_id = task_response.get("data", {}).get("task_id")
-        if not piapi_task_id:
-            raise ValueError(f"Не получен task_id от PiAPI: {task_response}")
-        start_time = time.monotonic()
-        while time.monotonic() - start_time < MAX_POLLING_TIME:
-            time.sleep(POLLING_INTERVAL)
-            with httpx.Client(timeout=15.0) as client:
-                res = client.get(f"https://api.piapi.ai/api/v1/task/{piapi_task_id}", headers=headers)
-            if res.status_code == 200:
-                piapi_data = res.json().get("data", {})
-                piapi_status = piapi_data.get("status", "Unknown").title()
-                if piapi_status == "Completed":
-                    result_url = piapi_data.get("output", {}).get("image_url")
-                    update_job_status(job_id, {"status": "completed", "result_url": result_url, "message": "✅ Изображение готово"})
-                    asyncio.run(send_telegram_message(user_id, "<b>Ваш портрет батыра готов!</b>\n\nВозвращайтесь в приложение, чтобы скачать его."))
-                    return
-                elif piapi_status == "Failed":
-                    error_details = piapi_data.get("error", "Неизвестная ошибка PiAPI").lower()
-                    user_message = "Не удалось найти лицо на фото. Попробуйте другое." if "face not found" in error_details else f"PiAPI ошибка: {piapi_data.get('error', 'Неизвестная ошибка')}"
-                    update_job_status(job_id, {"status": "failed", "error": user_message})
-                    return
-                elif piapi_status in ["Processing", "Pending", "Staged"]:
-                    update_job_status(job_id, {"status": "processing", "message": f"👨‍🎨 Нейросеть рисует... (статус: {piapi_status})"})
-                else:
-                    update_job_status(job_id, {"status": "failed", "error": f"Неизвестный статус PiAPI: {piapi_status}"})
-                    return
-        update_job_status(job_id, {"status": "timeout", "error": f"Превышено время ожидания ({MAX_POLLING_TIME}с)"})
-    except Exception as e:
-        error_msg = f"Критическая ошибка в фоновой задаче: {str(e)}"
-        traceback.print_exc()
-        update_job_status(job_id, {"status": "failed", "error": error_msg})
 
-# --- Главные эндпоинты с новой безопасной логикой ---
 @app.post("/api/start-face-swap", status_code=status.HTTP_202_ACCEPTED)
-async def start_face_swap_task(
-    background_tasks: BackgroundTasks,
-    user_photo: UploadFile = File(...),
-    gender: str = Form("male"),
-    validated_user: dict = Depends(get_validated_telegram_data)
-):
+async def start_face_swap_task(request: Request, validated_user: dict = Depends(get_validated_telegram_data)):
+    """
+    Одно фото — один или несколько портретов. Форма multipart: user_photo, gender,
+    variants (сколько случайных шаблонов) или templates (через запятую: sha256 или имя файла шаблона).
+    Фото обрабатывается один раз, варианты выполняются воркерами параллельно под общей родительской задачей.
+    """
     user_id = validated_user.get('id')
     if not user_id:
         raise HTTPException(status_code=403, detail="Invalid user data from Telegram.")
 
-    can_generate, message, remaining_attempts = can_user_generate(user_id=user_id)
+    # Тело читается потоком: не-картинки и слишком большие файлы отклоняются по первым
+    # килобайтам, а крупные загрузки пишутся во временный файл, а не в память
+    try:
+        upload = await ingest_upload(request, "user_photo")
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    try:
+        return await _start_face_swap(upload, user_id, validated_user)
+    finally:
+        upload.close()
+
+
+async def _start_face_swap(upload: IngestedUpload, user_id: int, validated_user: dict):
+    gender = upload.fields.get("gender", "male")
+    templates = upload.fields.get("templates")
+    try:
+        variants = int(upload.fields.get("variants", 1))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректное количество вариантов.")
+
+    # Шаблоны проверяем до обработки фото: неверный запрос не тратит время пула
+    if templates:
+        template_refs = [template_ref.strip() for template_ref in templates.split(",") if template_ref.strip()]
+        if not 1 <= len(template_refs) <= MAX_VARIANTS:
+            raise HTTPException(status_code=400, detail=f"Можно выбрать от 1 до {MAX_VARIANTS} шаблонов.")
+        selected_templates = [find_batyr_template(template_ref) for template_ref in template_refs]
+        if any(template is None for template in selected_templates):
+            raise HTTPException(status_code=400, detail="Шаблон не найден.")
+    else:
+        if not 1 <= variants <= MAX_VARIANTS:
+            raise HTTPException(status_code=400, detail=f"Количество вариантов — от 1 до {MAX_VARIANTS}.")
+        selected_templates = get_random_batyr_templates(gender, variants)
+
+    # Фото уменьшаем сразу, в пуле процессов: битый файл не списывает попытку,
+    # а в очередь уходит компактный JPEG вместо исходного файла
+    try:
+        with observe_seconds(FACE_SWAP_STAGE_SECONDS, stage="preprocess"):
+            processed_photo = await preprocess_photo_async(upload.source)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Фото без лица отклоняем сразу: без платной задачи в PiAPI и без списания попытки
+    if processed_photo["faces"] == 0:
+        FACE_SWAP_OUTCOMES.labels(outcome="face_not_found").inc()
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="На фото не найдено лицо. Загрузите фото, где лицо видно чётко, анфас и при хорошем освещении.")
+
+    # Кэш проверяем до лимитов: готовые портреты не ждут очереди и не списывают попыток
+    cached_result_urls = await asyncio.gather(*[
+        get_cached_result(user_id, processed_photo["photo_hash"], template.sha256) for template in selected_templates
+    ])
+    new_jobs_count = sum(1 for cached_result_url in cached_result_urls if not cached_result_url)
+
+    # Очередь перед PiAPI переполнена — отказываем сразу, не списывая попытку
+    backlog = 0
+    if new_jobs_count:
+        backlog = await get_queue_length() + (await get_admission_stats())["waiting"]
+    if backlog >= ADMISSION_MAX_BACKLOG:
+        retry_after = max(await estimate_wait(backlog), 1)
+        FACE_SWAP_OUTCOMES.labels(outcome="rejected").inc()
+        print(f"🚦 Очередь переполнена ({backlog}), запрос пользователя {user_id} отклонен.")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Сейчас слишком много желающих. Попробуйте через {retry_after} с.",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    # Пользователь мог быть еще в буфере регистрации — записываем его раньше,
+    # чем сверка лимитов создаст строку без имени
+    await asyncio.to_thread(user_registrar.flush)
+    # Каждый новый вариант — отдельная попытка; результат из кэша попытку не тратит
+    # (amount=0 только возвращает остаток)
+    can_generate, message, remaining_attempts = await consume_quota(user_id, amount=new_jobs_count)
     if not can_generate:
         raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=message)
 
     job_id = str(uuid.uuid4())
-    if not user_photo.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Недопустимый тип файла.")
-    
-    user_photo_bytes = await user_photo.read()
-    update_job_status(job_id, {"status": "accepted", "job_id": job_id, "message": "⏳ Генерация изображения..."})
-    background_tasks.add_task(run_face_swap_in_background, job_id, user_photo_bytes, user_id, gender)
-    
-    print(f"👍 [Job: {job_id}] Задача принята для пользователя {user_id} ({validated_user.get('first_name', '')}, пол: {gender}).")
-    return { "job_id": job_id, "status": "accepted", "message": "Задача принята в обработку.", "remaining_attempts": remaining_attempts }
+    if len(selected_templates) == 1:
+        await _start_swap_job(job_id, selected_templates[0], processed_photo, user_id, gender, cached_result_urls[0])
+        print(f"👍 [Job: {job_id}] Задача принята для пользователя {user_id} ({validated_user.get('first_name', '')}, пол: {gender}).")
+        # Ответ один и тот же и для кэша, и для новой задачи: при попадании в кэш мини-апп получит completed на первом опросе
+        return { "job_id": job_id, "status": "accepted", "message": "Задача принята в обработку.", "remaining_attempts": remaining_attempts, "stream_token": issue_stream_token(job_id) }
+
+    variant_jobs = [{"job_id": str(uuid.uuid4()), "template": template.name} for template in selected_templates]
+    await create_parent_job(job_id, variant_jobs)
+    await asyncio.gather(*[
+        _start_swap_job(variant["job_id"], template, processed_photo, user_id, gender, cached_result_url, parent_job_id=job_id)
+        for variant, template, cached_result_url in zip(variant_jobs, selected_templates, cached_result_urls)
+    ])
+    print(f"👍 [Job: {job_id}] Принято вариантов: {len(variant_jobs)} для пользователя {user_id} ({validated_user.get('first_name', '')}, пол: {gender}).")
+    return {
+        "job_id": job_id,
+        "status": "accepted",
+        "message": "Задача принята в обработку.",
+        "remaining_attempts": remaining_attempts,
+        "variant_job_ids": [variant["job_id"] for variant in variant_jobs],
+        "stream_token": issue_stream_token(job_id),
+    }
 
 
 @app.get("/api/task-status/{job_id}", dependencies=[Depends(get_validated_telegram_data)])
 async def get_task_status(job_id: str):
-    task_data_str = redis_client.get(job_id)
-    if not task_data_str:
+    task_data = await get_job_status(job_id)
+    if task_data is None:
         raise HTTPException(status_code=404, detail="Задача не найдена.")
-    return json.loads(task_data_str)
+    return task_data
+
+
+# Для истории генераций в мини-аппе: статусы нескольких задач одним запросом
+MAX_BULK_STATUS_IDS = 50
+
+@app.get("/api/task-status", dependencies=[Depends(get_validated_telegram_data)])
+async def get_task_statuses(ids: str = Query(..., description="ID задач через запятую")):
+    job_ids = list(dict.fromkeys(job_id.strip() for job_id in ids.split(",") if job_id.strip()))
+    if not job_ids:
+        raise HTTPException(status_code=400, detail="Не переданы ID задач.")
+    if len(job_ids) > MAX_BULK_STATUS_IDS:
+        raise HTTPException(status_code=400, detail=f"Можно запросить не больше {MAX_BULK_STATUS_IDS} задач за раз.")
+    statuses = await get_job_statuses(job_ids)
+    # Истекшие и неизвестные задачи отдаем как not_found, чтобы ответ содержал все запрошенные ID
+    return {"jobs": {job_id: task_data if task_data is not None else {"status": "not_found"} for job_id, task_data in statuses.items()}}
+
+
+# --- Поток статуса задачи (SSE и WebSocket) вместо частых опросов ---
+STREAM_KEEPALIVE_INTERVAL = 15.0
+STREAM_MAX_DURATION = 300.0
+
+@app.post("/api/task-events/{job_id}/token", dependencies=[Depends(get_validated_telegram_data)])
+async def create_stream_token(job_id: str):
+    """Новый токен потока: если выданный при создании задачи истек (например, мини-апп открыт заново)."""
+    if await get_job_status(job_id) is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена.")
+    return {"job_id": job_id, "stream_token": issue_stream_token(job_id), "expires_in": STREAM_TOKEN_TTL}
+
+
+@app.get("/api/task-events/{job_id}")
+async def stream_task_events(job_id: str, token: Optional[str] = Query(None), header_init_data: Optional[str] = Security(telegram_init_data_header)):
+    """Server-Sent Events: статус задачи приходит сразу при изменении, соединение закрывается на финальном статусе."""
+    await authorize_task_stream(job_id, token, header_init_data)
+    if await get_job_status(job_id) is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена.")
+
+    async def event_stream():
+        async for status_data in subscribe_job_events(job_id, STREAM_KEEPALIVE_INTERVAL, STREAM_MAX_DURATION):
+            if status_data is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: status\ndata: {json.dumps(status_data, ensure_ascii=False)}\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
+
+
+@app.websocket("/ws/task-status/{job_id}")
+async def websocket_task_status(websocket: WebSocket, job_id: str, token: Optional[str] = Query(None)):
+    try:
+        await authorize_task_stream(job_id, token, websocket.headers.get("X-Telegram-Init-Data"))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    try:
+        found = False
+        async for status_data in subscribe_job_events(job_id, STREAM_KEEPALIVE_INTERVAL, STREAM_MAX_DURATION):
+            found = True
+            # keep-alive заодно показывает, что клиент еще подключен
+            await websocket.send_json(status_data if status_data is not None else {"status": "keep-alive"})
+        if not found:
+            await websocket.send_json({"status": "not_found", "error": "Задача не найдена."})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
+@app.post("/api/piapi/webhook")
+async def piapi_webhook(request: Request, x_webhook_secret: Optional[str] = Header(None)):
+    """Вебхук PiAPI о завершении задачи. Повторные вызовы для той же задачи ничего не меняют."""
+    if not PIAPI_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_webhook_secret or not hmac.compare_digest(x_webhook_secret, PIAPI_WEBHOOK_SECRET):
+        raise HTTPException(status_code=401, detail="Invalid webhook secret")
+    try:
+        body = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    piapi_data = body.get("data") or {}
+    piapi_task_id = piapi_data.get("task_id")
+    job_id = await get_job_id_by_piapi_task(piapi_task_id) if piapi_task_id else None
+    if not job_id:
+        return {"status": "ignored"}
+    final_status = build_final_status(piapi_data)
+    job_meta = await get_job_meta(job_id)
+    if final_status is None or job_meta is None:
+        return {"status": "ignored"}
+    applied = await finalize_job(job_meta, final_status)
+    print(f"🪝 [Job: {job_id}] Вебхук PiAPI: {final_status['status']} ({'применен' if applied else 'повтор'}).")
+    return {"status": "ok" if applied else "duplicate"}
 
 
 @app.post("/api/send-photo-to-chat")
@@ -305,28 +387,44 @@ async def send_photo_to_chat(
     if not token:
         raise HTTPException(status_code=500, detail="Токен бота не настроен на сервере.")
     
-    url = f"https://api.telegram.org/bot{token}/sendPhoto"
     payload = { "chat_id": user_id, "photo": request.imageUrl, "caption": "Ваш портрет Батыра готов! ✨\n\nСоздано в @BatyrAI_bot" }
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload, timeout=30.0)
-            response.raise_for_status()
+        response = await get_telegram_client().post(f"/bot{token}/sendPhoto", json=payload)
+        response.raise_for_status()
         return {"status": "ok", "message": "Фото успешно отправлено в ваш чат."}
     except Exception as e:
         raise HTTPException(status_code=500, detail="Произошла внутренняя ошибка сервера.")
 
 
 @app.get("/api/download-image", dependencies=[Depends(get_validated_telegram_data)])
-async def download_image_proxy(url: str):
+async def download_image_proxy(url: str, request: Request):
     if not url:
         raise HTTPException(status_code=400, detail="URL не указан.")
+
+    # Результат уже скачан воркером — отдаем с диска, с поддержкой условных запросов и Range
+    cached = get_cached_result_image(url)
+    if cached:
+        path, content_type = cached
+        etag = build_etag(path)
+        cache_headers = {"ETag": etag, "Cache-Control": "private, max-age=86400"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+        if RESULT_CACHE_ACCEL_PREFIX:
+            # nginx отдаст файл сам (sendfile), включая Range и Last-Modified; ETag — этот же (nginx.conf)
+            accel_headers = {**cache_headers, "X-Accel-Redirect": f"{RESULT_CACHE_ACCEL_PREFIX}{os.path.basename(path)}"}
+            return Response(media_type=content_type, headers=accel_headers)
+        return FileResponse(path, media_type=content_type, headers=cache_headers)
+
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, follow_redirects=True, timeout=30.0)
+        client = get_download_client()
+        response = await client.send(client.build_request("GET", url), stream=True)
+        if response.is_error:
+            await response.aclose()
             response.raise_for_status()
-            content_type = response.headers.get('content-type', 'application/octet-stream')
-            return StreamingResponse(response.iter_bytes(), media_type=content_type)
+        content_type = response.headers.get('content-type', 'application/octet-stream')
+        # Соединение возвращается в пул после того, как ответ полностью отдан клиенту
+        return StreamingResponse(response.aiter_bytes(), media_type=content_type, background=BackgroundTask(response.aclose))
     except Exception as e:
         raise HTTPException(status_code=500, detail="Произошла внутренняя ошибка при скачивании файла.")
 
@@ -334,20 +432,48 @@ async def download_image_proxy(url: str):
 # --- Открытые эндпоинты для мониторинга ---
 @app.get("/api/stats")
 async def get_app_stats():
-    total_users = get_total_users_count()
+    total_users = await get_total_users()
     return { "total_unique_users": total_users, "timestamp": datetime.now().isoformat() }
 
+@app.get("/api/ready")
+async def readiness_check():
+    """Готовность воркера принимать трафик: каталог шаблонов загружен, Redis отвечает."""
+    catalogue = get_catalogue_status()
+    redis_ready = False
+    try:
+        redis_ready = bool(await redis_async.ping())
+    except Exception:
+        pass
+    ready = redis_ready and any(catalogue.values())
+    body = {"ready": ready, "pid": os.getpid(), "redis": redis_ready, "templates": catalogue}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """Метрики Prometheus со всех процессов gunicorn. Наружу nginx его не отдает."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/api/health")
 async def health_check():
     redis_status = "disconnected"
+    queue_length = None
+    result_cache = None
+    admission = None
     try:
-        if redis_client and redis_client.ping():
+        if await redis_async.ping():
             redis_status = "connected"
+            queue_length = await get_queue_length()
+            result_cache = await get_cache_stats()
+            admission = await get_admission_stats()
     except Exception:
         pass
     return { 
         "status": "healthy" if redis_status == "connected" else "unhealthy", 
         "redis": redis_status, 
+        "queue_length": queue_length,
+        "result_cache": result_cache,
+        "piapi_admission": admission,
         "male_images_cached": len(batyr_images_caches.get("male", [])),
         "female_images_cached": len(batyr_images_caches.get("female", [])),
         "timestamp": datetime.now().isoformat() 
@@ -0,0 +1,34 @@
+# gunicorn.conf.py
+# Продакшен-запуск API: несколько процессов uvicorn под gunicorn.
+# preload_app: приложение импортируется в мастере до fork, поэтому каталог шаблонов
+# собирается и загружается один раз, а воркеры делят его память (copy-on-write).
+import os
+import multiprocessing
+
+# Метрики Prometheus: воркеры пишут значения в общую директорию, /metrics собирает их все.
+# Задаем до загрузки приложения (preload), чтобы metrics.py увидел её при импорте
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-backend")
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+
+def on_starting(server):
+    from metrics import reset_multiprocess_dir
+    reset_multiprocess_dir()
+    # Сборка ассетов пишет файлы на диск — делаем её в мастере, а не в каждом воркере наперегонки
+    from database import init_db
+    from batyr_templates import load_all_batyr_images_to_cache
+    init_db()
+    load_all_batyr_images_to_cache()
+
+def child_exit(server, worker):
+    # Счетчики умершего воркера остаются в сумме, его live-gauge файлы убираются
+    from metrics import mark_worker_dead
+    mark_worker_dead(worker.pid)
@@ -0,0 +1,75 @@
+# http_clients.py
+import os
+from typing import Dict
+
+import httpx
+
+# --- Долгоживущие HTTP-клиенты по одному на внешний сервис ---
+# Клиент держит пул keep-alive соединений (и HTTP/2), поэтому TLS-рукопожатие
+# с api.piapi.ai / api.telegram.org происходит один раз, а не на каждый запрос.
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+
+# Настройки для каждого внешнего сервиса: таймауты (сек) и лимиты пула соединений
+UPSTREAM_SETTINGS = {
+    "piapi": {
+        "base_url": "https://api.piapi.ai",
+        "timeout": httpx.Timeout(float(os.getenv("PIAPI_TIMEOUT", 30)), connect=float(os.getenv("PIAPI_CONNECT_TIMEOUT", 5))),
+        "max_connections": int(os.getenv("PIAPI_MAX_CONNECTIONS", 50)),
+        "max_keepalive": int(os.getenv("PIAPI_MAX_KEEPALIVE", 20)),
+    },
+    "telegram": {
+        "base_url": "https://api.telegram.org",
+        "timeout": httpx.Timeout(float(os.getenv("TELEGRAM_TIMEOUT", 30)), connect=float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", 5))),
+        "max_connections": int(os.getenv("TELEGRAM_MAX_CONNECTIONS", 20)),
+        "max_keepalive": int(os.getenv("TELEGRAM_MAX_KEEPALIVE", 10)),
+    },
+    # Скачивание готовых картинок с CDN PiAPI (адрес приходит полным URL)
+    "downloads": {
+        "base_url": "",
+        "timeout": httpx.Timeout(float(os.getenv("DOWNLOAD_TIMEOUT", 30)), connect=float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", 5))),
+        "max_connections": int(os.getenv("DOWNLOAD_MAX_CONNECTIONS", 50)),
+        "max_keepalive": int(os.getenv("DOWNLOAD_MAX_KEEPALIVE", 20)),
+    },
+}
+KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _create_client(upstream: str) -> httpx.AsyncClient:
+    settings = UPSTREAM_SETTINGS[upstream]
+    limits = httpx.Limits(
+        max_connections=settings["max_connections"],
+        max_keepalive_connections=settings["max_keepalive"],
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        base_url=settings["base_url"],
+        timeout=settings["timeout"],
+        limits=limits,
+        http2=HTTP2_ENABLED,
+        follow_redirects=True,
+    )
+
+def get_http_client(upstream: str) -> httpx.AsyncClient:
+    """Возвращает общий клиент для сервиса, создавая его при первом обращении."""
+    client = _clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _create_client(upstream)
+        _clients[upstream] = client
+    return client
+
+def get_piapi_client() -> httpx.AsyncClient:
+    return get_http_client("piapi")
+
+def get_telegram_client() -> httpx.AsyncClient:
+    return get_http_client("telegram")
+
+def get_download_client() -> httpx.AsyncClient:
+    return get_http_client("downloads")
+
+async def close_http_clients():
+    """Закрывает все клиенты. Вызывается при остановке приложения или воркера."""
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
@@ -0,0 +1,391 @@
+# job_queue.py
+import os
+import json
+import time
+import socket
+from typing import Optional, Dict, Any, List, AsyncIterator
+
+from redis_conn import redis_async, redis_async_raw
+
+# --- Конфигурация очереди ---
+JOB_TTL = 3600
+PENDING_QUEUE = "facejobs:pending"
+PROCESSING_QUEUE_PREFIX = "facejobs:processing:"
+WORKER_HEARTBEAT_PREFIX = "facejobs:worker:"
+WORKER_HEARTBEAT_TTL = int(os.getenv("WORKER_HEARTBEAT_TTL", 30))
+JOB_EVENTS_PREFIX = "jobevents:"
+# Поле статуса родительской задачи с прогрессом одного варианта: variant:{job_id варианта}
+VARIANT_FIELD_PREFIX = "variant:"
+# Какие поля статуса варианта попадают в статус родительской задачи
+VARIANT_STATUS_FIELDS = ("status", "message", "error", "result_url", "queue_position", "estimated_wait", "cached")
+TERMINAL_STATUSES = ("completed", "failed", "timeout")
+PIAPI_DURATIONS_KEY = "piapi:completion_times"
+PIAPI_DURATIONS_MAX_SAMPLES = 500
+
+
+def get_worker_id() -> str:
+    """ID воркера стабилен между перезапусками контейнера (имя хоста), чтобы он забрал свои же задачи."""
+    return os.getenv("WORKER_ID") or socket.gethostname()
+
+def _job_meta_key(job_id: str) -> str:
+    return f"facejob:{job_id}"
+
+def _job_photo_key(job_id: str) -> str:
+    return f"facejob:{job_id}:photo"
+
+def _job_result_claim_key(job_id: str) -> str:
+    return f"facejob:{job_id}:final"
+
+def _variants_finished_key(parent_job_id: str) -> str:
+    return f"facejob:{parent_job_id}:variants_finished"
+
+def _piapi_task_key(piapi_task_id: str) -> str:
+    return f"piapi:task:{piapi_task_id}"
+
+def _processing_queue(worker_id: str) -> str:
+    return f"{PROCESSING_QUEUE_PREFIX}{worker_id}"
+
+
+# --- Статус задачи (читается фронтендом через /api/task-status и поток событий) ---
+# Статус хранится хэшем: промежуточное обновление пишет только переданные поля.
+# Значения полей закодированы в JSON, чтобы числа и флаги читались с тем же типом.
+# Финальный статус заменяет хэш целиком, чтобы не осталось полей промежуточных шагов.
+def _job_status_key(job_id: str) -> str:
+    return f"facejob:{job_id}:status"
+
+def _encode_status_fields(status_data: dict) -> Dict[str, str]:
+    return {field: json.dumps(value, ensure_ascii=False) for field, value in status_data.items()}
+
+def _decode_status_fields(fields: Dict[str, str]) -> Optional[dict]:
+    if not fields:
+        return None
+    return {field: json.loads(value) for field, value in fields.items()}
+
+def _fold_variants(status_data: Optional[dict]) -> Optional[dict]:
+    """У родительской задачи поля variant:{job_id} собирает в список variants (в порядке постановки)."""
+    if not status_data or "variant_jobs" not in status_data:
+        return status_data
+    folded = {field: value for field, value in status_data.items() if not field.startswith(VARIANT_FIELD_PREFIX) and field != "variant_jobs"}
+    folded["variants"] = [
+        {**variant, **status_data.get(f"{VARIANT_FIELD_PREFIX}{variant['job_id']}", {})}
+        for variant in status_data["variant_jobs"]
+    ]
+    return folded
+
+def _is_replacing_update(status_data: dict) -> bool:
+    return status_data.get("status") in TERMINAL_STATUSES
+
+def apply_status_update(current: Optional[dict], status_data: dict) -> dict:
+    """Применяет обновление к статусу так же, как update_job_status применяет его к хэшу."""
+    if current is None or _is_replacing_update(status_data):
+        return dict(status_data)
+    return {**current, **status_data}
+
+# Промежуточный статус пишется, только пока финальный не заявлен (claim_job_result):
+# проверка и запись в одном шаге, поэтому опрос не затрет результат, записанный вебхуком.
+STATUS_PROGRESS_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('PUBLISH', ARGV[2], ARGV[3])
+return 1
+"""
+
+_status_progress_script = redis_async.register_script(STATUS_PROGRESS_SCRIPT)
+
+
+async def update_job_status(job_id: str, status_data: dict):
+    """
+    Записывает изменившиеся поля статуса и публикует их подписчикам потока событий задачи.
+    Промежуточный статус после финального не записывается.
+    """
+    try:
+        key = _job_status_key(job_id)
+        if not _is_replacing_update(status_data):
+            fields = [item for field_value in _encode_status_fields(status_data).items() for item in field_value]
+            written = await _status_progress_script(
+                keys=[key, _job_result_claim_key(job_id)],
+                args=[JOB_TTL, f"{JOB_EVENTS_PREFIX}{job_id}", json.dumps(status_data), *fields]
+            )
+            if not written:
+                print(f"↩️ [Job: {job_id}] Финальный статус уже записан, промежуточный пропущен.")
+                return
+        else:
+            async with redis_async.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.hset(key, mapping=_encode_status_fields(status_data))
+                pipe.expire(key, JOB_TTL)
+                pipe.publish(f"{JOB_EVENTS_PREFIX}{job_id}", json.dumps(status_data))
+                await pipe.execute()
+        print(f"📝 [Job: {job_id}] Статус обновлен: {status_data.get('status', 'N/A')}")
+    except Exception as e:
+        print(f"❌ [Job: {job_id}] Ошибка обновления статуса в Redis: {e}")
+
+async def _get_raw_job_status(job_id: str) -> Optional[dict]:
+    return _decode_status_fields(await redis_async.hgetall(_job_status_key(job_id)))
+
+async def get_job_status(job_id: str) -> Optional[dict]:
+    return _fold_variants(await _get_raw_job_status(job_id))
+
+async def get_job_statuses(job_ids: List[str]) -> Dict[str, Optional[dict]]:
+    """Статусы нескольких задач за один проход по сети."""
+    async with redis_async.pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hgetall(_job_status_key(job_id))
+        results = await pipe.execute()
+    return {job_id: _fold_variants(_decode_status_fields(fields)) for job_id, fields in zip(job_ids, results)}
+
+async def subscribe_job_events(job_id: str, keepalive_interval: float, max_duration: float) -> AsyncIterator[Optional[dict]]:
+    """
+    Отдает текущий статус задачи, затем каждое обновление до финального статуса.
+    Если обновлений нет keepalive_interval секунд, отдает None (для keep-alive клиенту).
+    """
+    pubsub = redis_async.pubsub()
+    # Подписываемся до чтения текущего статуса, чтобы не пропустить обновление между ними
+    await pubsub.subscribe(f"{JOB_EVENTS_PREFIX}{job_id}")
+    try:
+        current = await _get_raw_job_status(job_id)
+        if current is None:
+            return
+        yield _fold_variants(dict(current))
+        if current.get("status") in TERMINAL_STATUSES:
+            return
+        deadline = time.monotonic() + max_duration
+        while time.monotonic() < deadline:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=keepalive_interval)
+            if message is None:
+                yield None
+                continue
+            # В канал публикуются только изменившиеся поля — собираем полный статус
+            current = apply_status_update(current, json.loads(message["data"]))
+            yield _fold_variants(dict(current))
+            if current.get("status") in TERMINAL_STATUSES:
+                return
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+
+
+# --- Постановка в очередь (API) ---
+async def enqueue_face_swap_job(job_id: str, user_photo_bytes: bytes, user_id: int, gender: str, template_sha: str, photo_hash: str, parent_job_id: Optional[str] = None):
+    """Атомарно сохраняет статус, метаданные и фото задачи и ставит её в очередь."""
+    status_data = {"status": "accepted", "job_id": job_id, "message": "⏳ Генерация изображения..."}
+    meta = {"user_id": user_id, "gender": gender, "template_sha": template_sha, "photo_hash": photo_hash, "created_at": time.time()}
+    if parent_job_id:
+        meta["parent_job_id"] = parent_job_id
+    async with redis_async_raw.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_status_key(job_id), mapping=_encode_status_fields(status_data))
+        pipe.expire(_job_status_key(job_id), JOB_TTL)
+        pipe.hset(_job_meta_key(job_id), mapping=meta)
+        pipe.expire(_job_meta_key(job_id), JOB_TTL)
+        pipe.set(_job_photo_key(job_id), user_photo_bytes, ex=JOB_TTL)
+        pipe.lpush(PENDING_QUEUE, job_id)
+        await pipe.execute()
+    print(f"📥 [Job: {job_id}] Задача поставлена в очередь.")
+
+async def create_parent_job(parent_job_id: str, variant_jobs: List[Dict[str, str]]):
+    """
+    Родительская задача для нескольких вариантов одного фото. Сама в очередь не попадает:
+    её статус собирается из статусов вариантов (update_variant_status).
+    variant_jobs — [{"job_id": ..., "template": ...}] в порядке вариантов.
+    """
+    status_data = {
+        "status": "accepted",
+        "job_id": parent_job_id,
+        "message": "⏳ Генерация изображений...",
+        "variants_total": len(variant_jobs),
+        "variants_done": 0,
+        "variant_jobs": variant_jobs,
+    }
+    async with redis_async.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_status_key(parent_job_id), mapping=_encode_status_fields(status_data))
+        pipe.expire(_job_status_key(parent_job_id), JOB_TTL)
+        await pipe.execute()
+
+# Запись прогресса варианта в родителя одним атомарным шагом: поле варианта, множество
+# завершенных и их число меняются вместе, поэтому последний вариант видит поля всех остальных.
+# Возвращает {завершено, всего} или {-1, 0}, если писать нечего: родитель истек или уже получил
+# финальный статус, либо пришел промежуточный статус уже завершенного варианта.
+VARIANT_UPDATE_SCRIPT = """
+local total = redis.call('HGET', KEYS[1], 'variants_total')
+if not total or redis.call('EXISTS', KEYS[3]) == 1 then
+    return {-1, 0}
+end
+if ARGV[3] == '1' then
+    redis.call('SADD', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+elseif redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+    -- Запоздавший промежуточный статус уже завершенного варианта
+    return {-1, 0}
+end
+local done = redis.call('SCARD', KEYS[2])
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2], 'variants_done', done)
+if ARGV[4] ~= '' and done < tonumber(total) then
+    redis.call('HSET', KEYS[1], 'status', ARGV[4])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return {done, tonumber(total)}
+"""
+
+_variant_update_script = redis_async.register_script(VARIANT_UPDATE_SCRIPT)
+
+
+async def update_variant_status(parent_job_id: str, job_id: str, status_data: dict) -> Optional[dict]:
+    """
+    Переносит статус варианта в родительскую задачу. Когда завершается последний вариант,
+    записывает финальный статус родителя и возвращает его (ровно одному вызывающему), иначе None.
+    """
+    variant_status = {field: status_data[field] for field in VARIANT_STATUS_FIELDS if field in status_data}
+    variant_field = f"{VARIANT_FIELD_PREFIX}{job_id}"
+    finished = status_data.get("status") in TERMINAL_STATUSES
+    parent_status_update = "processing" if status_data.get("status") not in ("accepted", "queued") else None
+    # Множество, а не счетчик: повторный финальный статус варианта не засчитывается дважды
+    variants_done, variants_total = await _variant_update_script(
+        keys=[_job_status_key(parent_job_id), _variants_finished_key(parent_job_id), _job_result_claim_key(parent_job_id)],
+        args=[
+            variant_field, json.dumps(variant_status, ensure_ascii=False), int(finished),
+            json.dumps(parent_status_update) if parent_status_update else "", JOB_TTL,
+        ]
+    )
+    if variants_done < 0:
+        # Родительская задача истекла или уже завершена
+        return None
+    delta = {variant_field: variant_status, "variants_done": variants_done}
+    is_last = finished and variants_done >= variants_total
+    if not is_last:
+        if parent_status_update:
+            delta["status"] = parent_status_update
+        await redis_async.publish(f"{JOB_EVENTS_PREFIX}{parent_job_id}", json.dumps(delta))
+        return None
+    if not await claim_job_result(parent_job_id, "completed"):
+        return None
+
+    parent_status = await _get_raw_job_status(parent_job_id) or {}
+    variants = _fold_variants(parent_status)["variants"]
+    result_urls = [variant["result_url"] for variant in variants if variant.get("status") == "completed" and variant.get("result_url")]
+    if result_urls:
+        parent_status.update({"status": "completed", "result_url": result_urls[0], "message": f"✅ Готово изображений: {len(result_urls)} из {variants_total}"})
+    else:
+        parent_status.update({"status": "failed", "error": "Не удалось создать ни одного изображения."})
+    await update_job_status(parent_job_id, parent_status)
+    return parent_status
+
+async def get_queue_length() -> int:
+    return await redis_async.llen(PENDING_QUEUE)
+
+
+# --- Разбор очереди (воркер) ---
+async def claim_next_job(worker_id: str, timeout: int = 5) -> Optional[str]:
+    """
+    Забирает следующую задачу, перекладывая её в список обработки воркера.
+    Задача остается там до ack_job, поэтому не теряется при падении воркера.
+    """
+    return await redis_async.blmove(PENDING_QUEUE, _processing_queue(worker_id), timeout, "RIGHT", "LEFT")
+
+async def load_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Возвращает метаданные задачи вместе с фото или None, если задача истекла."""
+    meta = await redis_async.hgetall(_job_meta_key(job_id))
+    user_photo_bytes = await redis_async_raw.get(_job_photo_key(job_id))
+    if not meta or user_photo_bytes is None:
+        return None
+    return {
+        "job_id": job_id,
+        "user_id": int(meta["user_id"]),
+        "gender": meta.get("gender", "male"),
+        "template_sha": meta.get("template_sha"),
+        "photo_hash": meta.get("photo_hash"),
+        "parent_job_id": meta.get("parent_job_id"),
+        "piapi_task_id": meta.get("piapi_task_id"),
+        "created_at": float(meta["created_at"]) if meta.get("created_at") else None,
+        "submitted_at": float(meta["submitted_at"]) if meta.get("submitted_at") else None,
+        "user_photo_bytes": user_photo_bytes,
+    }
+
+async def set_piapi_task_id(job_id: str, piapi_task_id: str):
+    """
+    Запоминает task_id PiAPI, чтобы после перезапуска продолжить опрос, а не платить повторно.
+    Обратная ссылка task_id -> job_id нужна вебхуку PiAPI.
+    """
+    async with redis_async.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_meta_key(job_id), mapping={"piapi_task_id": piapi_task_id, "submitted_at": time.time()})
+        pipe.set(_piapi_task_key(piapi_task_id), job_id, ex=JOB_TTL)
+        await pipe.execute()
+
+async def get_job_id_by_piapi_task(piapi_task_id: str) -> Optional[str]:
+    return await redis_async.get(_piapi_task_key(piapi_task_id))
+
+async def get_job_meta(job_id: str) -> Optional[Dict[str, Any]]:
+    """Метаданные задачи без фото (для вебхука PiAPI)."""
+    meta = await redis_async.hgetall(_job_meta_key(job_id))
+    if not meta:
+        return None
+    return {
+        "job_id": job_id,
+        "user_id": int(meta["user_id"]),
+        "template_sha": meta.get("template_sha"),
+        "photo_hash": meta.get("photo_hash"),
+        "parent_job_id": meta.get("parent_job_id"),
+        "created_at": float(meta["created_at"]) if meta.get("created_at") else None,
+        "submitted_at": float(meta["submitted_at"]) if meta.get("submitted_at") else None,
+    }
+
+
+# --- Финальный результат (вебхук и опрос пишут его не более одного раза) ---
+async def claim_job_result(job_id: str, final_status: str) -> bool:
+    """Возвращает True только первому, кто записывает финальный статус задачи."""
+    return bool(await redis_async.set(_job_result_claim_key(job_id), final_status, nx=True, ex=JOB_TTL))
+
+async def is_job_finished(job_id: str) -> bool:
+    return bool(await redis_async.exists(_job_result_claim_key(job_id)))
+
+
+# --- Статистика времени выполнения задач в PiAPI (для адаптивного опроса) ---
+async def record_piapi_duration(seconds: float):
+    async with redis_async.pipeline(transaction=False) as pipe:
+        pipe.lpush(PIAPI_DURATIONS_KEY, round(seconds, 2))
+        pipe.ltrim(PIAPI_DURATIONS_KEY, 0, PIAPI_DURATIONS_MAX_SAMPLES - 1)
+        await pipe.execute()
+
+async def get_piapi_durations() -> List[float]:
+    return [float(value) for value in await redis_async.lrange(PIAPI_DURATIONS_KEY, 0, -1)]
+
+async def ack_job(worker_id: str, job_id: str):
+    """Убирает завершенную задачу из списка обработки и удаляет фото."""
+    async with redis_async.pipeline(transaction=True) as pipe:
+        pipe.lrem(_processing_queue(worker_id), 1, job_id)
+        pipe.delete(_job_photo_key(job_id))
+        await pipe.execute()
+
+
+# --- Восстановление после падений ---
+async def send_worker_heartbeat(worker_id: str):
+    await redis_async.set(f"{WORKER_HEARTBEAT_PREFIX}{worker_id}", int(time.time()), ex=WORKER_HEARTBEAT_TTL)
+
+async def _requeue_processing_list(processing_queue: str) -> int:
+    # Возвращаем задачи в голову очереди (справа), чтобы их забрали первыми
+    moved = 0
+    while await redis_async.lmove(processing_queue, PENDING_QUEUE, "RIGHT", "RIGHT"):
+        moved += 1
+    return moved
+
+async def requeue_orphaned_jobs(worker_id: str, include_own: bool = False) -> int:
+    """
+    Возвращает в очередь задачи воркеров, которые перестали слать heartbeat.
+    При старте воркер также забирает свои же незавершенные задачи (include_own=True).
+    """
+    moved = 0
+    async for key in redis_async.scan_iter(match=f"{PROCESSING_QUEUE_PREFIX}*"):
+        owner = key[len(PROCESSING_QUEUE_PREFIX):]
+        if owner == worker_id:
+            if include_own:
+                moved += await _requeue_processing_list(key)
+            continue
+        if not await redis_async.exists(f"{WORKER_HEARTBEAT_PREFIX}{owner}"):
+            moved += await _requeue_processing_list(key)
+    if moved:
+        print(f"♻️ Возвращено в очередь незавершенных задач: {moved}")
+    return moved
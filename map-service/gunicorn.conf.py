@@ -0,0 +1,36 @@
+# gunicorn.conf.py
+# Продакшен-запуск сервиса карты вместо встроенного сервера Flask.
+# preload_app: mapBatyr импортируется в мастере до fork, поэтому DB_DATA из batyrs_data.json
+# читается один раз, а воркеры делят эту память (copy-on-write).
+import os
+import multiprocessing
+
+# Метрики Prometheus: воркеры пишут значения в общую директорию, /metrics собирает их все.
+# Задаем до загрузки приложения (preload), чтобы metrics.py увидел её при импорте
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-map")
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Потоки: пока воркер ждет Azure Speech/OpenAI, он обслуживает другие запросы
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+
+def on_starting(server):
+    from metrics import reset_multiprocess_dir
+    reset_multiprocess_dir()
+
+def post_fork(server, worker):
+    # Синтезаторы Azure Speech создаются в каждом воркере: соединения SDK не переживают fork
+    from speech_pool import warm_up_pools_in_background
+    warm_up_pools_in_background()
+
+def child_exit(server, worker):
+    # Счетчики умершего воркера остаются в сумме, его live-gauge файлы убираются
+    from metrics import mark_worker_dead
+    mark_worker_dead(worker.pid)
@@ -1,22 +1,25 @@
 # app.py
 
 import os
-import io
 import json
 import base64
 import logging
-import hmac
-import hashlib
-from urllib.parse import unquote
 from datetime import datetime
 
 from flask import Flask, jsonify, abort, request, Response
 from flask_cors import CORS
 from dotenv import load_dotenv
-from pydub import AudioSegment
 import azure.cognitiveservices.speech as speechsdk
 from openai import AzureOpenAI
 
+from telegram_auth import validate_init_data, InitDataError
+from speech_pool import SynthesizerPool, SpeechPoolTimeout, get_pool_stats, SPEECH_POOL_TIMEOUT
+from speech_audio import recognize_once
+from tts_cache import TTSCache
+from metrics import (
+    ASSISTANT_STAGE_SECONDS, ASSISTANT_OUTCOMES, MAP_STAGE_SECONDS, MAP_OUTCOMES, observe_seconds, render_metrics
+)
+
 # --- 1. Настройка и загрузка переменных ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 load_dotenv()
@@ -46,6 +49,13 @@ try:
 except Exception as e:
     logging.error(f"Не удалось инициализировать клиент Azure OpenAI: {e}")
 
+# Синтезаторы с открытым соединением общие для /api/tts и ассистента (speech_pool.py);
+# по одному на поток gthread, чтобы запросы не ждали синтезатора
+SYNTHESIZER_POOL = SynthesizerPool(service="map", voice=SPEECH_VOICE_NAME, size=int(os.getenv("GUNICORN_THREADS", 4)))
+# Тексты карты статичны — озвучка кэшируется в памяти и на диске (tts_cache.py)
+TTS_CACHE = TTSCache(service="map")
+TTS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
 app = Flask(__name__)
 CORS(app)
 
@@ -59,61 +69,83 @@ except Exception as e:
     logging.critical(f"❌ КРИТИЧЕСКАЯ ОШИБКА при загрузке данных: {e}", exc_info=True)
     DB_DATA = {}
 
+# --- Готовность воркера (для healthcheck контейнера) ---
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    ready = bool(DB_DATA)
+    return jsonify({"ready": ready, "pid": os.getpid(), "regions": len(DB_DATA), "speech_pool": get_pool_stats()}), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
 # --- 4. Эндпоинты для карты (без изменений) ---
 @app.route('/api/region/<string:region_id>', methods=['GET'])
 def get_region_info(region_id):
     logging.info(f"🐌 Запрос на данные региона: {region_id}")
-    region_data = DB_DATA.get(region_id)
+    with observe_seconds(MAP_STAGE_SECONDS, stage="region_lookup"):
+        region_data = DB_DATA.get(region_id)
     if not region_data:
+        MAP_OUTCOMES.labels(stage="region_lookup", outcome="not_found").inc()
         return abort(404, description=f"Регион с ID '{region_id}' не найден.")
+    MAP_OUTCOMES.labels(stage="region_lookup", outcome="ok").inc()
     return jsonify(region_data)
 
-@app.route('/api/tts', methods=['POST'])
+@app.route('/api/tts', methods=['GET', 'POST'])
 def text_to_speech_azure():
     if not all([SPEECH_KEY, SPEECH_REGION]):
         logging.error("❌ [TTS] Ключи или регион не найдены.")
         return jsonify({"error": "Azure TTS service is not configured."}), 500
     
-    data = request.get_json()
-    text_to_speak = data.get('text')
+    # GET /api/tts?text=... кэшируется браузером и прокси; POST с JSON оставлен для старых клиентов
+    if request.method == 'GET':
+        text_to_speak = request.args.get('text')
+    else:
+        data = request.get_json(silent=True) or {}
+        text_to_speak = data.get('text')
     if not text_to_speak:
         return jsonify({"error": "No text provided."}), 400
 
-    logging.info(f"🔊 [TTS] Запрос на озвучку текста: {text_to_speak[:50]}...")
+    # ETag — ключ кэша: совпал у клиента — аудио не передаем и не озвучиваем
+    etag = f'"{TTSCache.cache_key(text_to_speak, SYNTHESIZER_POOL.voice, SYNTHESIZER_POOL.output_format)[:32]}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers={"ETag": etag, "Cache-Control": TTS_CACHE_CONTROL})
+
     try:
-        speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
-        speech_config.speech_synthesis_voice_name = SPEECH_VOICE_NAME
-        # Используем MP3 для лучшего сжатия
-        speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3)
-        synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-        result = synthesizer.speak_text_async(text_to_speak).get()
-
-        if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-            logging.info("✅ [TTS] Аудио успешно сгенерировано.")
-            return Response(result.audio_data, mimetype='audio/mp3')
-        else:
-            logging.error(f"❌ [TTS] Ошибка синтеза: {result.cancellation_details}")
-            return jsonify({"error": "Speech synthesis failed."}), 500
+        # MP3 для лучшего сжатия; синтезатор берется из пула с уже открытым соединением
+        with observe_seconds(MAP_STAGE_SECONDS, stage="tts"):
+            cached = TTS_CACHE.get_or_synthesize(text_to_speak, SYNTHESIZER_POOL.voice, SYNTHESIZER_POOL.output_format, SYNTHESIZER_POOL.synthesize)
+        if cached.tier == "miss":
+            logging.info(f"🔊 [TTS] Озвучен новый текст: {text_to_speak[:50]}...")
+        MAP_OUTCOMES.labels(stage="tts", outcome="ok").inc()
+        return Response(cached.audio, mimetype='audio/mp3', headers={"ETag": cached.etag, "Cache-Control": TTS_CACHE_CONTROL, "X-TTS-Cache": cached.tier})
+    except SpeechPoolTimeout as e:
+        logging.warning(f"⏳ [TTS] {e}")
+        MAP_OUTCOMES.labels(stage="tts", outcome="busy").inc()
+        return jsonify({"error": "Speech synthesis is busy, try again later."}), 503, {"Retry-After": str(int(SPEECH_POOL_TIMEOUT))}
+    except RuntimeError as e:
+        logging.error(f"❌ [TTS] {e}")
+        MAP_OUTCOMES.labels(stage="tts", outcome="error").inc()
+        return jsonify({"error": "Speech synthesis failed."}), 500
     except Exception as e:
+        MAP_OUTCOMES.labels(stage="tts", outcome="error").inc()
         logging.error(f"❌ [TTS] Внутренняя ошибка: {e}", exc_info=True)
         return jsonify({"error": "Internal server error during TTS."}), 500
 
 
+@app.route('/api/tts/stats', methods=['GET'])
+def tts_cache_stats():
+    """Попадания в кэш озвучки этого процесса (memory/disk/miss) и доля попаданий."""
+    return jsonify({"pid": os.getpid(), **TTS_CACHE.stats()})
+
+
 # ✅↓↓↓ НОВЫЙ ЭНДПОИНТ И ЛОГИКА ДЛЯ ГОЛОСОВОГО АССИСТЕНТА ↓↓↓✅
 
 # --- 5. Вспомогательные функции для ассистента ---
 def recognize_speech_from_bytes(audio_bytes: bytes) -> str:
-    audio_segment = AudioSegment.from_file(io.BytesIO(audio_bytes))
-    audio_segment = audio_segment.set_channels(1).set_frame_rate(16000)
-    wav_buffer = io.BytesIO()
-    audio_segment.export(wav_buffer, format="wav")
-    wav_buffer.seek(0)
-
-    speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION, speech_recognition_language=SPEECH_RECOGNITION_LANGUAGE)
-    stream = speechsdk.audio.PullAudioInputStream(wav_buffer.read())
-    audio_config = speechsdk.audio.AudioConfig(stream=stream)
-    recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
-    result = recognizer.recognize_once_async().get()
+    # Без pydub и временных WAV: аудио подается в распознавание из памяти (speech_audio.py)
+    result = recognize_once(audio_bytes, SPEECH_RECOGNITION_LANGUAGE, service="map")
 
     if result.reason == speechsdk.ResultReason.RecognizedSpeech:
         if not result.text or result.text.isspace(): raise ValueError("Распознан пустой текст.")
@@ -125,32 +157,32 @@ def recognize_speech_from_bytes(audio_bytes: bytes) -> str:
     logging.error(f"Ошибка распознавания: {cancellation_details.reason}. Детали: {cancellation_details.error_details}")
     raise RuntimeError(f"Ошибка сервиса распознавания: {cancellation_details.reason}")
 
+# Готовые ответы повторяются — их озвучка берется из кэша; свободный текст LLM каждый раз новый
+ANSWER_FILTERED_REPLY = "Кешіріңіз, менің жауабым мазмұн саясатына байланысты бұғатталды."
+REQUEST_FILTERED_REPLY = "Кешіріңіз, сұранысыңыз мазмұн саясатына байланысты өңделмеді."
+CACHED_REPLIES = frozenset({ANSWER_FILTERED_REPLY, REQUEST_FILTERED_REPLY})
+
 def get_answer_from_llm(question: str, history: list) -> str:
     messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history + [{"role": "user", "content": question}]
     try:
         response = AZURE_OPENAI_CLIENT.chat.completions.create(model=AZURE_OPENAI_DEPLOYMENT_NAME, messages=messages, temperature=0.7, max_tokens=150)
         if not response.choices or not response.choices[0].message.content:
             logging.warning("Ответ от LLM был отфильтрован.")
-            return "Кешіріңіз, менің жауабым мазмұн саясатына байланысты бұғатталды."
+            return ANSWER_FILTERED_REPLY
         answer = response.choices[0].message.content
         logging.info(f"✅ [Assistant] Ответ от LLM получен: '{answer[:50]}...'")
         return answer
     except Exception as e:
         if "content_filter" in str(e):
              logging.warning(f"Запрос заблокирован фильтром содержимого: {e}")
-             return "Кешіріңіз, сұранысыңыз мазмұн саясатына байланысты өңделмеді."
+             return REQUEST_FILTERED_REPLY
         logging.error(f"🔥 [Assistant] Ошибка при обращении к OpenAI: {e}", exc_info=True)
         raise RuntimeError("Ошибка при обращении к сервису OpenAI.")
 
 def synthesize_speech_for_assistant(text: str) -> bytes:
-    speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
-    speech_config.speech_synthesis_voice_name = SPEECH_VOICE_NAME
-    speech_config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3)
-    synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-    result = synthesizer.speak_text_async(text).get()
-    if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-        return result.audio_data
-    raise RuntimeError(f"Ошибка синтеза речи: {result.cancellation_details.reason}")
+    if text in CACHED_REPLIES:
+        return TTS_CACHE.get_or_synthesize(text, SYNTHESIZER_POOL.voice, SYNTHESIZER_POOL.output_format, SYNTHESIZER_POOL.synthesize).audio
+    return SYNTHESIZER_POOL.synthesize(text)
 
 
 # --- 6. Основной эндпоинт для ассистента ---
@@ -160,18 +192,8 @@ def ask_assistant():
     if not init_data or not BOT_TOKEN:
         return jsonify({"error": "Auth data is missing or server is not configured"}), 401
     try:
-        unquoted_init_data = unquote(init_data)
-        data_check_string, hash_from_telegram = [], ''
-        for item in sorted(unquoted_init_data.split('&')):
-            key, value = item.split('=', 1)
-            if key == 'hash': hash_from_telegram = value
-            else: data_check_string.append(f"{key}={value}")
-        data_check_string = "\n".join(data_check_string)
-        secret_key = hmac.new("WebAppData".encode(), BOT_TOKEN.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        if calculated_hash != hash_from_telegram:
-            return jsonify({"error": "Invalid data signature"}), 403
-    except Exception as e:
+        validate_init_data(init_data)
+    except InitDataError as e:
         logging.warning(f"Ошибка валидации Telegram initData: {e}")
         return jsonify({"error": "Could not validate Telegram credentials."}), 403
     
@@ -184,18 +206,30 @@ def ask_assistant():
         
         logging.info(f"✅ [Assistant] Получен аудиофайл: {len(audio_bytes)} байт.")
 
-        recognized_text = recognize_speech_from_bytes(audio_bytes)
-        answer_text = get_answer_from_llm(recognized_text, history)
-        answer_audio_bytes = synthesize_speech_for_assistant(answer_text)
+        with observe_seconds(ASSISTANT_STAGE_SECONDS, service="map", stage="total"):
+            recognized_text = recognize_speech_from_bytes(audio_bytes)
+            with observe_seconds(ASSISTANT_STAGE_SECONDS, service="map", stage="llm"):
+                answer_text = get_answer_from_llm(recognized_text, history)
+            with observe_seconds(ASSISTANT_STAGE_SECONDS, service="map", stage="tts"):
+                answer_audio_bytes = synthesize_speech_for_assistant(answer_text)
         audio_base64 = base64.b64encode(answer_audio_bytes).decode('utf-8')
         
+        ASSISTANT_OUTCOMES.labels(service="map", outcome="ok").inc()
         return jsonify({"userText": recognized_text, "assistantText": answer_text, "audioBase64": audio_base64})
     except ValueError as e:
         logging.warning(f"Ошибка данных от клиента (400): {e}")
+        ASSISTANT_OUTCOMES.labels(service="map", outcome="bad_request").inc()
         return jsonify({"detail": str(e)}), 400
+    except SpeechPoolTimeout as e:
+        # Все синтезаторы заняты — "занят", как и в /api/tts, а не внутренняя ошибка
+        logging.warning(f"⏳ [Assistant] {e}")
+        ASSISTANT_OUTCOMES.labels(service="map", outcome="busy").inc()
+        return jsonify({"detail": "Ассистент сейчас занят, попробуйте через несколько секунд."}), 503, {"Retry-After": str(int(SPEECH_POOL_TIMEOUT))}
     except Exception as e:
         logging.error("Непредвиденная ошибка в /api/ask-assistant", exc_info=True)
+        ASSISTANT_OUTCOMES.labels(service="map", outcome="error").inc()
         return jsonify({"detail": "Произошла непредвиденная внутренняя ошибка ассистента."}), 500
 
+# Для локальной разработки; в контейнере сервис запускается через gunicorn (gunicorn.conf.py)
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
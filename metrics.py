@@ -0,0 +1,93 @@
+# metrics.py
+"""
+Метрики Prometheus для всех сервисов (бэкенд, воркер, ассистент, карта).
+
+Под gunicorn каждый воркер — отдельный процесс, поэтому при заданной
+PROMETHEUS_MULTIPROC_DIR значения пишутся в общие файлы в этой директории,
+а /metrics собирает их со всех процессов. Без неё — обычный реестр процесса.
+"""
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Iterator, Tuple
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+)
+from prometheus_client import multiprocess
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+# Один набор корзин от десятков миллисекунд (обработка фото) до минут (рендер PiAPI)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# --- Замена лица ---
+# stage: preprocess, piapi_submit, admission_wait, piapi_render, end_to_end
+FACE_SWAP_STAGE_SECONDS = Histogram(
+    "batyr_face_swap_stage_seconds", "Длительность этапов замены лица", ["stage"], buckets=LATENCY_BUCKETS
+)
+# outcome: completed, cached, failed, timeout, face_not_found, rejected
+FACE_SWAP_OUTCOMES = Counter("batyr_face_swap_outcomes_total", "Итоги задач замены лица", ["outcome"])
+# Аренда слота PiAPI (admission.py): lost — истекла до продления, reacquired — слот взят снова,
+# over_limit — задача работает с PiAPI без слота (лимит одновременных задач превышен)
+ADMISSION_LEASE_EVENTS = Counter("batyr_piapi_admission_lease_events_total", "События аренды слота PiAPI", ["event"])
+
+# --- Голосовой ассистент ---
+# stage: audio_decode, stt, llm, tts, total; first_audio — до первой озвученной фразы (потоковый ответ)
+ASSISTANT_STAGE_SECONDS = Histogram(
+    "batyr_assistant_stage_seconds", "Длительность этапов ответа ассистента", ["service", "stage"], buckets=LATENCY_BUCKETS
+)
+# outcome: ok, bad_request, busy, error
+ASSISTANT_OUTCOMES = Counter("batyr_assistant_requests_total", "Итоги запросов к ассистенту", ["service", "outcome"])
+
+# --- Карта ---
+# stage: region_lookup, tts; outcome: ok, not_found, busy, error
+MAP_STAGE_SECONDS = Histogram(
+    "batyr_map_stage_seconds", "Длительность запросов карты", ["stage"], buckets=LATENCY_BUCKETS
+)
+MAP_OUTCOMES = Counter("batyr_map_requests_total", "Итоги запросов карты", ["stage", "outcome"])
+
+# --- Azure Speech (speech_pool.py) ---
+SPEECH_POOL_WAIT_SECONDS = Histogram(
+    "batyr_speech_pool_wait_seconds", "Ожидание синтезатора из пула", ["service", "pool"], buckets=LATENCY_BUCKETS
+)
+SPEECH_CONNECT_SECONDS = Histogram(
+    "batyr_speech_connect_seconds", "Время открытия соединения с Azure Speech", ["service"], buckets=LATENCY_BUCKETS
+)
+# tier: memory, disk, miss (tts_cache.py)
+TTS_CACHE_REQUESTS = Counter("batyr_tts_cache_requests_total", "Обращения к кэшу озвучки", ["service", "tier"])
+
+
+@contextmanager
+def observe_seconds(histogram: Histogram, **labels) -> Iterator[None]:
+    """Замеряет блок и записывает длительность в гистограмму (в том числе при исключении)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - started)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Тело и Content-Type ответа /metrics."""
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+# --- Хуки gunicorn ---
+def reset_multiprocess_dir():
+    """Очищает файлы метрик прошлого запуска. Вызывается в мастере gunicorn до запуска воркеров."""
+    if not MULTIPROC_DIR:
+        return
+    shutil.rmtree(MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+def mark_worker_dead(pid: int):
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
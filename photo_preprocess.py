@@ -0,0 +1,122 @@
+# photo_preprocess.py
+import os
+import io
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Optional, Union
+
+from PIL import Image, ImageOps
+
+from face_detect import count_faces
+
+# HEIC/HEIF с iPhone открываем через pillow-heif, если он установлен
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    HEIF_SUPPORTED = True
+except ImportError:
+    HEIF_SUPPORTED = False
+
+# --- Конфигурация ---
+PHOTO_MAX_SIZE = int(os.getenv("PHOTO_MAX_SIZE", 1024))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", 85))
+# Число процессов для обработки фото и сколько задач может ждать своей очереди
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+PREPROCESS_MAX_PENDING = int(os.getenv("PREPROCESS_MAX_PENDING", PREPROCESS_WORKERS * 4))
+# Размер dHash: 16 -> 256 бит, чтобы разные люди практически не давали одинаковый хэш
+PHOTO_HASH_SIZE = 16
+
+
+def photo_hash(img: Image.Image, hash_size: int = PHOTO_HASH_SIZE) -> str:
+    """
+    Перцептивный хэш (dHash): сравниваем яркость соседних пикселей уменьшенной копии.
+    Устойчив к пережатию и небольшому изменению размера одного и того же фото.
+    """
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def preprocess_photo(image_source: Union[bytes, str], max_size: int = PHOTO_MAX_SIZE) -> Dict[str, Any]:
+    """
+    Уменьшает фото пользователя до max_size и кодирует в JPEG.
+    JPEG декодируется сразу в уменьшенном масштабе (draft mode: 1/2, 1/4, 1/8),
+    поэтому 12 МП фото не разжимается целиком. Ориентация берется из EXIF.
+    Заодно на уменьшенном фото ищем лицо. Выполняется в дочернем процессе.
+    image_source — байты фото или путь к временному файлу (большие загрузки, upload_ingest.py).
+    """
+    started = time.perf_counter()
+    try:
+        img = Image.open(image_source if isinstance(image_source, str) else io.BytesIO(image_source))
+        source_format = img.format
+        source_size = img.size
+        if source_format == "JPEG":
+            # draft выбирает наименьший масштаб, который всё еще не меньше запрошенного
+            img.draft("RGB", (max_size, max_size))
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        # reducing_gap: сначала быстрое целочисленное уменьшение, затем точный ресемплинг
+        img.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=2.0)
+        decoded = time.perf_counter()
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=PHOTO_JPEG_QUALITY)
+        encoded = time.perf_counter()
+    except Exception as e:
+        raise ValueError("Не удалось обработать изображение.") from e
+    faces = count_faces(img)
+    detected = time.perf_counter()
+    hash_hex = photo_hash(img)
+    return {
+        "jpeg_bytes": buffer.getvalue(),
+        "width": img.width,
+        "height": img.height,
+        "source_format": source_format,
+        "source_size": source_size,
+        "decode_ms": round((decoded - started) * 1000, 1),
+        "encode_ms": round((encoded - decoded) * 1000, 1),
+        # None — проверка лица отключена (нет OpenCV или FACE_CHECK_ENABLED=false)
+        "faces": faces,
+        "face_detect_ms": round((detected - encoded) * 1000, 1),
+        "photo_hash": hash_hex,
+    }
+
+
+# --- Пул процессов ---
+# Создается лениво, уже в процессе-воркере uvicorn, через spawn:
+# дочерние процессы не наследуют event loop и соединения родителя.
+_executor: Optional[ProcessPoolExecutor] = None
+_pending: Optional[asyncio.Semaphore] = None
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        print(f"🧵 Пул обработки фото запущен: {PREPROCESS_WORKERS} процессов.")
+    return _executor
+
+async def preprocess_photo_async(image_source: Union[bytes, str]) -> Dict[str, Any]:
+    """Обрабатывает фото в пуле процессов, не занимая GIL процесса API. Файл на диске читает сам дочерний процесс."""
+    global _pending
+    if _pending is None:
+        _pending = asyncio.Semaphore(PREPROCESS_MAX_PENDING)
+    async with _pending:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(_get_executor(), preprocess_photo, image_source)
+    print(f"🖼️ Фото {result['source_format']} {result['source_size'][0]}x{result['source_size'][1]} -> "
+          f"{result['width']}x{result['height']}: декодирование {result['decode_ms']} мс, кодирование {result['encode_ms']} мс, "
+          f"поиск лица {result['face_detect_ms']} мс (лиц: {result['faces']})")
+    return result
+
+def shutdown_preprocess_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
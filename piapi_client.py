@@ -0,0 +1,245 @@
+# piapi_client.py
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Optional, Tuple
+
+import httpx
+
+from http_clients import get_piapi_client
+
+# --- Устойчивый клиент PiAPI ---
+# Повторы с джиттером, ограниченные бюджетом (повторы не больше доли от обычных запросов),
+# автомат-выключатель (circuit breaker), который при недоступности PiAPI сразу отказывает,
+# и "подстраховочные" (hedged) запросы статуса, если ответ задерживается.
+PIAPI_KEY = os.getenv("PIAPI_API_KEY")
+PIAPI_MAX_RETRIES = int(os.getenv("PIAPI_MAX_RETRIES", 3))
+PIAPI_RETRY_BASE_DELAY = float(os.getenv("PIAPI_RETRY_BASE_DELAY", 0.5))
+PIAPI_RETRY_MAX_DELAY = float(os.getenv("PIAPI_RETRY_MAX_DELAY", 8.0))
+# Каждый запрос пополняет бюджет на RETRY_BUDGET_RATIO повтора, запас не больше RETRY_BUDGET_MAX
+RETRY_BUDGET_RATIO = float(os.getenv("PIAPI_RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_MAX = float(os.getenv("PIAPI_RETRY_BUDGET_MAX", 10))
+# Подряд неудачных запросов до размыкания и время, на которое цепь размыкается
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("PIAPI_BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv("PIAPI_BREAKER_RESET_TIMEOUT", 30))
+# Второй запрос статуса отправляем, если первый дольше p95 недавних ответов (но не раньше минимума)
+HEDGE_MIN_DELAY = float(os.getenv("PIAPI_HEDGE_MIN_DELAY", 1.0))
+HEDGE_LATENCY_SAMPLES = 200
+STATUS_REQUEST_TIMEOUT = 15.0
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# Ошибки, при которых запрос гарантированно не ушел в PiAPI
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class PiAPIError(Exception):
+    """PiAPI ответил ошибкой или не ответил после всех повторов."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class PiAPIUnavailable(PiAPIError):
+    """Цепь разомкнута: PiAPI считается недоступным, запрос не отправлялся."""
+
+
+class RetryBudget:
+    """Ограничивает повторы долей от обычного трафика, чтобы повторы не добивали упавший сервис."""
+
+    def __init__(self, ratio: float, max_tokens: float):
+        self._ratio = ratio
+        self._max_tokens = max_tokens
+        self._tokens = max_tokens
+
+    def record_request(self):
+        self._tokens = min(self._max_tokens, self._tokens + self._ratio)
+
+    def try_spend(self) -> bool:
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    closed — запросы идут как обычно; после failure_threshold ошибок подряд — open:
+    запросы сразу отклоняются. Через reset_timeout — half-open: пропускаем один пробный запрос.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self._reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._probe_in_flight = False
+        if self._opened_at is not None or self._failures >= self._failure_threshold:
+            if self._opened_at is None:
+                print(f"🔌 PiAPI: {self._failures} ошибок подряд, цепь разомкнута на {self._reset_timeout:.0f} с.")
+            self._opened_at = time.monotonic()
+
+
+_retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+_status_latencies: "deque[float]" = deque(maxlen=HEDGE_LATENCY_SAMPLES)
+
+
+def get_breaker_state() -> str:
+    return _breaker.state
+
+def _headers() -> dict:
+    return {"x-api-key": PIAPI_KEY, "Content-Type": "application/json"}
+
+def _retry_delay(attempt: int, retry_after: Optional[str]) -> float:
+    if retry_after:
+        try:
+            return min(float(retry_after), PIAPI_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    # Full jitter: случайная пауза от 0 до экспоненциальной границы
+    return random.uniform(0, min(PIAPI_RETRY_MAX_DELAY, PIAPI_RETRY_BASE_DELAY * 2 ** attempt))
+
+async def _send(method: str, url: str, **kwargs) -> httpx.Response:
+    """Один запрос через автомат-выключатель. 5xx/429 и сетевые ошибки считаются отказом PiAPI."""
+    if not _breaker.allow_request():
+        raise PiAPIUnavailable("PiAPI временно недоступен")
+    try:
+        response = await get_piapi_client().request(method, url, headers=_headers(), **kwargs)
+    except httpx.TransportError:
+        _breaker.record_failure()
+        raise
+    except BaseException:
+        # Отмена (остановка воркера) не говорит о состоянии PiAPI — просто освобождаем пробу
+        _breaker.release_probe()
+        raise
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        _breaker.record_failure()
+    else:
+        _breaker.record_success()
+    return response
+
+def _never_reached_piapi(response: Optional[httpx.Response], error: Optional[Exception]) -> bool:
+    """
+    Запрос точно не был обработан PiAPI: соединение не установлено или явный отказ
+    с Retry-After (429/503). После таймаута чтения или 5xx задача могла быть уже создана.
+    """
+    if error is not None:
+        return isinstance(error, NOT_SENT_ERRORS)
+    return response.status_code in (429, 503) and "retry-after" in response.headers
+
+async def _request_with_retries(method: str, url: str, idempotent: bool = True, **kwargs) -> httpx.Response:
+    """
+    Запрос с повторами. Для неидемпотентного запроса (idempotent=False — создание платной
+    задачи) повторяем только то, что до PiAPI точно не дошло; иначе сразу ошибка.
+    """
+    _retry_budget.record_request()
+    attempt = 0
+    while True:
+        retry_after = None
+        response, transport_error = None, None
+        try:
+            response = await _send(method, url, **kwargs)
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+            retry_after = response.headers.get("retry-after")
+            error: Exception = PiAPIError(f"PiAPI вернул {response.status_code}", response.status_code)
+        except PiAPIUnavailable:
+            raise
+        except httpx.TransportError as e:
+            transport_error = e
+            error = PiAPIError(f"Сетевая ошибка PiAPI: {e!r}")
+        if not idempotent and not _never_reached_piapi(response, transport_error):
+            raise error
+        if attempt >= PIAPI_MAX_RETRIES or not _retry_budget.try_spend():
+            raise error
+        delay = _retry_delay(attempt, retry_after)
+        attempt += 1
+        print(f"🔁 PiAPI {method} {url}: {error}, повтор {attempt}/{PIAPI_MAX_RETRIES} через {delay:.1f} с.")
+        await asyncio.sleep(delay)
+
+
+# --- Операции PiAPI ---
+async def submit_task(payload: dict) -> str:
+    """
+    Создает задачу PiAPI и возвращает её task_id. Задача платная, поэтому повторная
+    отправка — только если первая точно не дошла до PiAPI (см. _request_with_retries).
+    """
+    response = await _request_with_retries("POST", "/api/v1/task", idempotent=False, json=payload)
+    if response.status_code >= 400:
+        raise PiAPIError(f"PiAPI отклонил задачу ({response.status_code}): {response.text[:200]}", response.status_code)
+    task_response = response.json()
+    piapi_task_id = task_response.get("data", {}).get("task_id")
+    if not piapi_task_id:
+        raise PiAPIError(f"Не получен task_id от PiAPI: {task_response}")
+    return piapi_task_id
+
+def _hedge_delay() -> float:
+    if len(_status_latencies) < 20:
+        return max(HEDGE_MIN_DELAY, STATUS_REQUEST_TIMEOUT / 3)
+    ordered = sorted(_status_latencies)
+    return max(HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+async def _timed_status_request(piapi_task_id: str) -> httpx.Response:
+    started = time.monotonic()
+    response = await _send("GET", f"/api/v1/task/{piapi_task_id}", timeout=STATUS_REQUEST_TIMEOUT)
+    _status_latencies.append(time.monotonic() - started)
+    return response
+
+async def get_task_status(piapi_task_id: str) -> Tuple[int, dict]:
+    """
+    Запрашивает статус задачи. Если ответа нет дольше обычного (p95), отправляет второй
+    такой же запрос и берет первый пришедший ответ. Возвращает (HTTP-код, data).
+    """
+    _retry_budget.record_request()
+    primary = asyncio.create_task(_timed_status_request(piapi_task_id))
+    done, _ = await asyncio.wait({primary}, timeout=_hedge_delay())
+    pending = {primary}
+    if not done and _breaker.state == "closed" and _retry_budget.try_spend():
+        pending.add(asyncio.create_task(_timed_status_request(piapi_task_id)))
+    last_error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    response = task.result()
+                    data = response.json().get("data", {}) if response.status_code == 200 else {}
+                    return response.status_code, data
+                last_error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+    if isinstance(last_error, PiAPIError):
+        raise last_error
+    raise PiAPIError(f"Сетевая ошибка PiAPI: {last_error!r}")
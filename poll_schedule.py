@@ -0,0 +1,64 @@
+# poll_schedule.py
+import os
+import time
+import random
+from typing import List, Iterator
+
+# --- Адаптивный график опроса статуса PiAPI ---
+# Вместо фиксированного интервала опрашиваем в моменты, когда задачи PiAPI
+# обычно завершаются (квантили наблюдаемого времени выполнения), затем — с
+# экспоненциальной задержкой. Джиттер разносит опросы разных задач во времени.
+MIN_POLL_INTERVAL = float(os.getenv("PIAPI_MIN_POLL_INTERVAL", 1.0))
+MAX_POLL_INTERVAL = float(os.getenv("PIAPI_MAX_POLL_INTERVAL", 15.0))
+POLL_BACKOFF_FACTOR = 1.5
+POLL_JITTER = 0.15
+# Пока статистики мало, начинаем с консервативного экспоненциального графика
+MIN_SAMPLES_FOR_QUANTILES = 20
+DEFAULT_FIRST_POLL = 2.0
+# Квантили времени выполнения, в которые делаем опрос
+POLL_QUANTILES = (0.25, 0.5, 0.75, 0.9, 0.95)
+# В режиме вебхука опрос — только страховка: первый опрос после p90
+WEBHOOK_FALLBACK_QUANTILE = 0.9
+DURATIONS_CACHE_TTL = 60
+
+
+def _quantile(sorted_values: List[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+def _jitter(delay: float) -> float:
+    return max(MIN_POLL_INTERVAL, delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER))
+
+def build_poll_offsets(durations: List[float], webhook_enabled: bool = False) -> List[float]:
+    """Возвращает опорные моменты опроса (секунды от отправки задачи) по истории выполнения."""
+    if len(durations) < MIN_SAMPLES_FOR_QUANTILES:
+        first = DEFAULT_FIRST_POLL * (4 if webhook_enabled else 1)
+        return [first]
+    sorted_durations = sorted(durations)
+    quantiles = [q for q in POLL_QUANTILES if not webhook_enabled or q >= WEBHOOK_FALLBACK_QUANTILE]
+    offsets: List[float] = []
+    for q in quantiles:
+        offset = _quantile(sorted_durations, q)
+        if not offsets or offset - offsets[-1] >= MIN_POLL_INTERVAL:
+            offsets.append(max(offset, MIN_POLL_INTERVAL))
+    return offsets
+
+def poll_delays(started_at: float, durations: List[float], webhook_enabled: bool = False) -> Iterator[float]:
+    """
+    Бесконечный генератор пауз перед очередным опросом.
+    Сначала идём по квантилям, затем увеличиваем интервал в POLL_BACKOFF_FACTOR раз.
+    """
+    offsets = build_poll_offsets(durations, webhook_enabled)
+    last_interval = DEFAULT_FIRST_POLL
+    previous_offset = 0.0
+    for offset in offsets:
+        elapsed = time.time() - started_at
+        # Задача возобновлена после перезапуска — пропущенные квантили не ждём
+        if offset <= elapsed:
+            continue
+        last_interval = max(offset - previous_offset, MIN_POLL_INTERVAL)
+        previous_offset = offset
+        yield _jitter(offset - elapsed)
+    while True:
+        last_interval = min(last_interval * POLL_BACKOFF_FACTOR, MAX_POLL_INTERVAL)
+        yield _jitter(last_interval)
@@ -0,0 +1,202 @@
+# quota.py
+import os
+import asyncio
+import secrets
+import datetime
+from typing import Tuple, List, Set
+
+import database
+from database import DAILY_LIMIT, ADMIN_ID
+from redis_conn import redis_async
+
+# --- Дневные лимиты и счетчики пользователей в Redis ---
+# Проверка лимита — один атомарный Lua-скрипт на счетчике quota:{user_id}:{дата}.
+# SQLite остается долговременной копией: фоновая сверка переносит туда
+# изменившиеся счетчики пачками, а не на каждую генерацию.
+QUOTA_KEY_PREFIX = "quota:"
+# Счетчик живет дольше суток, чтобы сверка успела перенести его в SQLite
+QUOTA_KEY_TTL = 2 * 24 * 3600
+# Счетчики, которые изменились после последней сверки (элементы "user_id:дата")
+QUOTA_DIRTY_SET = "quota:dirty"
+QUOTA_RECONCILE_LOCK = "quota:reconcile:lock"
+QUOTA_RECONCILE_INTERVAL = float(os.getenv("QUOTA_RECONCILE_INTERVAL", 30))
+QUOTA_RECONCILE_BATCH = int(os.getenv("QUOTA_RECONCILE_BATCH", 500))
+# Все известные пользователи: SCARD вместо COUNT(*) по таблице на каждый /api/stats
+USERS_SET = "users:all"
+USERS_SET_SEEDED = "users:all:seeded"
+
+# -2 — счетчика на сегодня еще нет (нужно заполнить из SQLite), -1 — лимит исчерпан
+QUOTA_CONSUME_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -2
+end
+local amount = tonumber(ARGV[1])
+local used = tonumber(redis.call('GET', KEYS[1]))
+if used + amount > tonumber(ARGV[2]) then
+    return -1
+end
+used = redis.call('INCRBY', KEYS[1], amount)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[4])
+return used
+"""
+
+_consume_script = redis_async.register_script(QUOTA_CONSUME_SCRIPT)
+
+# Блокировку снимает только её владелец: если сверка шла дольше TTL и блокировку уже
+# взял другой процесс, чужую не удаляем
+LOCK_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_release_lock_script = redis_async.register_script(LOCK_RELEASE_SCRIPT)
+
+# Поднимает счетчик до значения из SQLite, если тот ушел вперед (списания при недоступном Redis).
+# Отсутствующий счетчик не создаем: его заполнит _seed_counter при следующем списании
+QUOTA_RAISE_SCRIPT = """
+local used = redis.call('GET', KEYS[1])
+if used and tonumber(used) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+return 1
+"""
+
+_raise_script = redis_async.register_script(QUOTA_RAISE_SCRIPT)
+
+# Пользователи, у которых этот процесс списал попытки в SQLite в обход Redis: (user_id, дата)
+_fallback_charges: Set[Tuple[int, str]] = set()
+
+
+def _quota_key(user_id: int, day: str) -> str:
+    return f"{QUOTA_KEY_PREFIX}{user_id}:{day}"
+
+async def _seed_counter(user_id: int, day: str):
+    # После перезапуска Redis или в первый раз за день берем уже потраченное из SQLite
+    used = await asyncio.to_thread(database.get_today_usage, user_id)
+    await redis_async.set(_quota_key(user_id, day), used, ex=QUOTA_KEY_TTL, nx=True)
+
+async def consume_quota(user_id: int, amount: int = 1) -> Tuple[bool, str, int]:
+    """
+    Проверяет дневной лимит и списывает amount попыток одним атомарным вызовом.
+    Возвращает (разрешено, сообщение, осталось попыток) — как database.can_user_generate.
+    """
+    if user_id == ADMIN_ID:
+        return True, "👑 Админу можно всё!", 999
+
+    today_str = datetime.date.today().isoformat()
+    key = _quota_key(user_id, today_str)
+    try:
+        used = await _consume_script(keys=[key, QUOTA_DIRTY_SET], args=[amount, DAILY_LIMIT, QUOTA_KEY_TTL, f"{user_id}:{today_str}"])
+        if used == -2:
+            await _seed_counter(user_id, today_str)
+            used = await _consume_script(keys=[key, QUOTA_DIRTY_SET], args=[amount, DAILY_LIMIT, QUOTA_KEY_TTL, f"{user_id}:{today_str}"])
+    except Exception as e:
+        # Redis недоступен — проверяем лимит по SQLite, как раньше
+        print(f"⚠️ Лимит в Redis недоступен, проверяем по SQLite: {e}")
+        # Счетчик в Redis об этом списании не знает — поднимем его после восстановления (sync_fallback_charges)
+        _fallback_charges.add((user_id, today_str))
+        return await asyncio.to_thread(database.can_user_generate, user_id, amount)
+
+    if used < 0:
+        return False, f"Дневной лимит ({DAILY_LIMIT}) исчерпан. Возвращайтесь завтра!", 0
+    remaining = DAILY_LIMIT - used
+    return True, f"Генерация разрешена. Осталось сегодня: {remaining}", remaining
+
+
+# --- Счетчик пользователей ---
+async def mark_user_seen(user_id: int):
+    await redis_async.sadd(USERS_SET, user_id)
+
+async def seed_users_set():
+    """Один раз заполняет множество пользователей из SQLite (делает первый запустившийся процесс)."""
+    if not await redis_async.set(USERS_SET_SEEDED, 1, nx=True):
+        return
+
+    def _load():
+        return list(database.iter_user_ids())
+
+    try:
+        batches = await asyncio.to_thread(_load)
+        for user_ids in batches:
+            await redis_async.sadd(USERS_SET, *user_ids)
+        print(f"✅ Счетчик пользователей в Redis заполнен: {sum(len(batch) for batch in batches)}")
+    except Exception:
+        await redis_async.delete(USERS_SET_SEEDED)
+        raise
+
+async def get_total_users() -> int:
+    try:
+        return await redis_async.scard(USERS_SET)
+    except Exception as e:
+        print(f"⚠️ Счетчик пользователей в Redis недоступен, считаем по SQLite: {e}")
+        return await asyncio.to_thread(database.get_total_users_count)
+
+
+# --- Сверка с SQLite ---
+async def reconcile_usage() -> int:
+    """Переносит изменившиеся счетчики в SQLite. Возвращает число записанных строк."""
+    # Сверку в каждый момент делает только один процесс API
+    lock_token = secrets.token_hex(16)
+    if not await redis_async.set(QUOTA_RECONCILE_LOCK, lock_token, nx=True, ex=max(int(QUOTA_RECONCILE_INTERVAL), 5)):
+        return 0
+    written = 0
+    try:
+        while True:
+            members: List[str] = await redis_async.spop(QUOTA_DIRTY_SET, QUOTA_RECONCILE_BATCH)
+            if not members:
+                break
+            parsed = [member.split(":", 1) for member in members]
+            async with redis_async.pipeline(transaction=False) as pipe:
+                for user_id, day in parsed:
+                    pipe.get(_quota_key(int(user_id), day))
+                counters = await pipe.execute()
+            usage = [(int(user_id), day, int(counter)) for (user_id, day), counter in zip(parsed, counters) if counter is not None]
+            try:
+                await asyncio.to_thread(database.apply_usage_batch, usage)
+            except Exception:
+                # Не записали — возвращаем в очередь на следующую сверку
+                await redis_async.sadd(QUOTA_DIRTY_SET, *members)
+                raise
+            written += len(usage)
+            if len(members) < QUOTA_RECONCILE_BATCH:
+                break
+    finally:
+        await _release_lock_script(keys=[QUOTA_RECONCILE_LOCK], args=[lock_token])
+    return written
+
+async def sync_fallback_charges():
+    """
+    Переносит в Redis списания, сделанные этим процессом по SQLite, пока Redis был недоступен.
+    Иначе устаревший счетчик в Redis разрешил бы пользователю лишние попытки.
+    """
+    today_str = datetime.date.today().isoformat()
+    for user_id, day in list(_fallback_charges):
+        if day == today_str:
+            used = await asyncio.to_thread(database.get_today_usage, user_id)
+            await _raise_script(keys=[_quota_key(user_id, day)], args=[used, QUOTA_KEY_TTL])
+        # Счетчики прошлых дней больше не проверяются, а SQLite их не потеряет (apply_usage_batch)
+        _fallback_charges.discard((user_id, day))
+
+async def run_reconciler():
+    """Фоновая задача процесса API: периодическая сверка лимитов с SQLite."""
+    try:
+        while True:
+            await asyncio.sleep(QUOTA_RECONCILE_INTERVAL)
+            try:
+                # Каждый процесс — свои списания в обход Redis; сверку делает один процесс
+                await sync_fallback_charges()
+                written = await reconcile_usage()
+                if written:
+                    print(f"💾 Лимиты сверены с SQLite: {written} записей.")
+            except Exception as e:
+                print(f"🔥 Ошибка сверки лимитов с SQLite: {e}")
+    except asyncio.CancelledError:
+        # При остановке переносим то, что накопилось
+        try:
+            await reconcile_usage()
+        except Exception as e:
+            print(f"🔥 Ошибка финальной сверки лимитов: {e}")
+        raise
@@ -0,0 +1,21 @@
+# redis_conn.py
+import os
+
+import redis.asyncio as aioredis
+
+# --- Конфигурация ---
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+
+# --- Асинхронные клиенты Redis ---
+# Соединения открываются лениво, при первом запросе внутри event loop.
+# redis_async — для строк (статусы, метаданные задач),
+# redis_async_raw — для бинарных данных (фото пользователя).
+redis_async = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+redis_async_raw = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=False)
+
+
+async def close_redis():
+    """Закрывает пулы соединений асинхронных клиентов."""
+    await redis_async.aclose()
+    await redis_async_raw.aclose()
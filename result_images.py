@@ -0,0 +1,95 @@
+# result_images.py
+import os
+import time
+import asyncio
+import hashlib
+import tempfile
+import mimetypes
+from typing import Optional, Tuple
+
+from http_clients import get_download_client
+
+# --- Дисковый кэш готовых портретов ---
+# Воркер скачивает результат с CDN PiAPI сразу после завершения задачи,
+# а /api/download-image отдает его с диска (ETag/Last-Modified/Range).
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "/app/storage/results")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# Если задан (например "/_cached-results/"), файл отдает nginx через X-Accel-Redirect (sendfile)
+RESULT_CACHE_ACCEL_PREFIX = os.getenv("RESULT_CACHE_ACCEL_PREFIX", "")
+RESULT_CONTENT_TYPES = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
+# Очистку по размеру запускаем не чаще, чем раз в столько секунд
+EVICTION_CHECK_INTERVAL = 60
+
+_last_eviction_check = 0.0
+
+
+def _url_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+def get_cached_result_image(url: str) -> Optional[Tuple[str, str]]:
+    """Возвращает (путь, content-type) закэшированного результата или None."""
+    key = _url_key(url)
+    for extension in RESULT_CONTENT_TYPES.values():
+        path = os.path.join(RESULT_CACHE_DIR, f"{key}{extension}")
+        if os.path.exists(path):
+            # Обновляем atime вручную: том может быть смонтирован с noatime
+            try:
+                os.utime(path, (time.time(), os.stat(path).st_mtime))
+            except OSError:
+                pass
+            return path, mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return None
+
+def build_etag(path: str) -> str:
+    stat = os.stat(path)
+    return f'"{os.path.basename(path).split(".")[0][:16]}-{stat.st_size}"'
+
+async def prefetch_result_image(url: str):
+    """Скачивает результат в кэш. Ошибки не критичны: скачивание просто пойдет через прокси."""
+    if not url or get_cached_result_image(url):
+        return
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=RESULT_CACHE_DIR, prefix=".tmp-")
+    # Файловый объект сразу: дескриптор закроется и при ошибке до начала записи
+    tmp_file = os.fdopen(fd, "wb")
+    try:
+        with tmp_file:
+            async with get_download_client().stream("GET", url) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", "").split(";")[0].strip()
+                extension = RESULT_CONTENT_TYPES.get(content_type, ".png")
+                async for chunk in response.aiter_bytes():
+                    tmp_file.write(chunk)
+        os.replace(tmp_path, os.path.join(RESULT_CACHE_DIR, f"{_url_key(url)}{extension}"))
+        print(f"💾 Результат сохранен в кэш: {url[:80]}")
+    except Exception as e:
+        print(f"⚠️ Не удалось закэшировать результат {url[:80]}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    await evict_result_images_if_needed()
+
+def _evict_oldest(max_bytes: int):
+    entries = []
+    with os.scandir(RESULT_CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.startswith(".tmp-"):
+                stat = entry.stat()
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    # Сначала удаляем то, что дольше всего не скачивали
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+async def evict_result_images_if_needed():
+    global _last_eviction_check
+    if time.monotonic() - _last_eviction_check < EVICTION_CHECK_INTERVAL:
+        return
+    _last_eviction_check = time.monotonic()
+    await asyncio.to_thread(_evict_oldest, RESULT_CACHE_MAX_BYTES)
@@ -0,0 +1,165 @@
+# speech_audio.py
+"""
+Подача аудио пользователя в распознавание Azure Speech без временных файлов.
+
+Распознаватель читает из PushAudioInputStream (16 кГц, 16 бит, моно) и стартует сразу,
+а аудио дописывается в поток по мере готовности. WAV, который уже в нужном формате,
+передается как есть, без ffmpeg. Остальное (Opus/WebM из Telegram WebApp, OGG, MP4)
+декодирует один процесс ffmpeg через pipe: PCM уходит в распознавание кусками,
+пока ffmpeg еще работает.
+"""
+import os
+import time
+import struct
+import logging
+import threading
+import subprocess
+from typing import Callable, Optional
+
+import azure.cognitiveservices.speech as speechsdk
+
+from speech_pool import create_recognizer
+from metrics import ASSISTANT_STAGE_SECONDS
+
+SAMPLE_RATE = 16000
+PCM_CHUNK_BYTES = 32 * 1024
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", 30))
+# Сколько последних байт stderr ffmpeg сохранять для лога ошибки
+FFMPEG_STDERR_TAIL = 2000
+# cache:pipe:0 — ffmpeg кэширует прочитанное и может вернуться назад: MP4, у которого
+# moov-атом в конце файла (так пишут многие телефоны), тоже декодируется из pipe
+FFMPEG_COMMAND = [
+    "ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "cache:pipe:0",
+    "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1",
+]
+PCM_FORMAT = speechsdk.audio.AudioStreamFormat(samples_per_second=SAMPLE_RATE, bits_per_sample=16, channels=1)
+
+
+def wav_pcm_offset(audio_bytes: bytes) -> Optional[int]:
+    """Смещение PCM-данных, если это WAV 16 кГц / 16 бит / моно; иначе None (нужен ffmpeg)."""
+    if len(audio_bytes) < 12 or audio_bytes[:4] != b"RIFF" or audio_bytes[8:12] != b"WAVE":
+        return None
+    position = 12
+    format_ok = False
+    while position + 8 <= len(audio_bytes):
+        chunk_id = audio_bytes[position:position + 4]
+        chunk_size = struct.unpack_from("<I", audio_bytes, position + 4)[0]
+        body = position + 8
+        if chunk_id == b"fmt ":
+            if chunk_size < 16 or body + 16 > len(audio_bytes):
+                return None
+            audio_format, channels, sample_rate = struct.unpack_from("<HHI", audio_bytes, body)
+            bits_per_sample = struct.unpack_from("<H", audio_bytes, body + 14)[0]
+            format_ok = audio_format == 1 and channels == 1 and sample_rate == SAMPLE_RATE and bits_per_sample == 16
+        elif chunk_id == b"data":
+            return body if format_ok else None
+        # Чанки RIFF выровнены по двум байтам
+        position = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+def _decode_with_ffmpeg(audio_bytes: bytes, on_pcm: Callable[[bytes], None]) -> int:
+    """
+    Декодирует аудио в PCM 16 кГц моно, отдавая его кусками по мере чтения. Возвращает число байт PCM.
+    Весь разбор ограничен FFMPEG_TIMEOUT: по истечении сторожевой таймер убивает ffmpeg.
+    """
+    try:
+        process = subprocess.Popen(FFMPEG_COMMAND, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise RuntimeError(f"Не удалось запустить ffmpeg: {e}")
+
+    def feed():
+        try:
+            process.stdin.write(audio_bytes)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg завершился раньше (битый файл) — причина будет в stderr
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    stderr_tail = bytearray()
+
+    def drain_stderr():
+        # Читаем stderr постоянно, иначе ffmpeg встанет на заполненном pipe; храним только хвост
+        for chunk in iter(lambda: process.stderr.read(4096), b""):
+            stderr_tail.extend(chunk)
+            del stderr_tail[:-FFMPEG_STDERR_TAIL]
+
+    timed_out = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        process.kill()
+
+    threads = [
+        threading.Thread(target=feed, name="ffmpeg-feed", daemon=True),
+        threading.Thread(target=drain_stderr, name="ffmpeg-stderr", daemon=True),
+    ]
+    watchdog = threading.Timer(FFMPEG_TIMEOUT, kill_on_timeout)
+    watchdog.daemon = True
+    for thread in threads:
+        thread.start()
+    watchdog.start()
+    decoded = 0
+    try:
+        while True:
+            chunk = process.stdout.read(PCM_CHUNK_BYTES)
+            if not chunk:
+                break
+            decoded += len(chunk)
+            on_pcm(chunk)
+        process.wait()
+    finally:
+        watchdog.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        for thread in threads:
+            thread.join(timeout=1)
+        process.stdout.close()
+    if timed_out.is_set():
+        logging.error(f"🔥 ffmpeg не уложился в {FFMPEG_TIMEOUT:.0f} с и был остановлен")
+        raise ValueError("Не удалось обработать аудиофайл.")
+    if process.returncode != 0 or not decoded:
+        logging.error(f"🔥 ffmpeg не смог декодировать аудио (код {process.returncode}): {bytes(stderr_tail)!r}")
+        raise ValueError("Не удалось обработать аудиофайл.")
+    return decoded
+
+
+def recognize_once(audio_bytes: bytes, language: str, service: str) -> speechsdk.SpeechRecognitionResult:
+    """
+    Распознает одну фразу. Блокирующий вызов — запускать в потоке.
+    Битое или не поддерживаемое аудио — ValueError.
+    """
+    stream = speechsdk.audio.PushAudioInputStream(stream_format=PCM_FORMAT)
+    recognizer, _connection = create_recognizer(language, speechsdk.audio.AudioConfig(stream=stream), service)
+    started = time.perf_counter()
+    future = recognizer.recognize_once_async()
+    try:
+        decode_started = time.perf_counter()
+        pcm_offset = wav_pcm_offset(audio_bytes)
+        if pcm_offset is not None:
+            pcm = memoryview(audio_bytes)[pcm_offset:]
+            if not len(pcm):
+                raise ValueError("Не удалось обработать аудиофайл.")
+            for start in range(0, len(pcm), PCM_CHUNK_BYTES):
+                stream.write(pcm[start:start + PCM_CHUNK_BYTES].tobytes())
+        else:
+            _decode_with_ffmpeg(audio_bytes, stream.write)
+        ASSISTANT_STAGE_SECONDS.labels(service=service, stage="audio_decode").observe(time.perf_counter() - decode_started)
+    except BaseException:
+        stream.close()
+        # Дожидаемся распознавателя, чтобы не оставлять его работать с оборванным потоком
+        try:
+            future.get()
+        except Exception:
+            pass
+        raise
+    stream.close()
+    result = future.get()
+    # Распознавание идет параллельно с декодированием: stt — от старта до результата
+    ASSISTANT_STAGE_SECONDS.labels(service=service, stage="stt").observe(time.perf_counter() - started)
+    return result
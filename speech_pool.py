@@ -0,0 +1,225 @@
+# speech_pool.py
+"""
+Общие для ассистента и карты объекты Azure Speech.
+
+SpeechConfig кэшируется по языку/голосу/формату, а синтезаторы переиспользуются из пула
+с заранее открытым соединением: запрос не платит за создание синтезатора и websocket
+к Speech. Распознаватель привязан к своему AudioConfig (входу с аудио запроса), поэтому
+его создаем на каждый запрос из кэшированного SpeechConfig; соединение он открывает
+сам при старте распознавания, которое идет параллельно с декодированием аудио (speech_audio.py).
+
+Пулы создаются при импорте, а сами синтезаторы — только в воркере (после fork gunicorn):
+соединения SDK не переживают fork.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import azure.cognitiveservices.speech as speechsdk
+
+from metrics import SPEECH_POOL_WAIT_SECONDS, SPEECH_CONNECT_SECONDS
+
+# Синтезаторов на голос в одном процессе (если сервис не задал размер пула сам)
+# и сколько из них открывать сразу при старте воркера
+SPEECH_POOL_SIZE = int(os.getenv("SPEECH_POOL_SIZE", 4))
+SPEECH_POOL_WARM = int(os.getenv("SPEECH_POOL_WARM", 2))
+SPEECH_POOL_TIMEOUT = float(os.getenv("SPEECH_POOL_TIMEOUT", 10))
+# Azure закрывает простаивающий websocket; после такой паузы соединение открываем заново до запроса
+SPEECH_IDLE_REOPEN = float(os.getenv("SPEECH_IDLE_REOPEN", 240))
+
+MP3_FORMAT = speechsdk.SpeechSynthesisOutputFormat.Audio16Khz32KBitRateMonoMp3
+
+_configs: Dict[Tuple, speechsdk.SpeechConfig] = {}
+_configs_lock = threading.Lock()
+
+
+class SpeechPoolTimeout(RuntimeError):
+    """Все синтезаторы пула заняты дольше SPEECH_POOL_TIMEOUT."""
+
+
+def get_speech_config(language: Optional[str] = None, voice: Optional[str] = None, output_format=None) -> speechsdk.SpeechConfig:
+    """Один SpeechConfig на набор параметров. Менять возвращенный объект нельзя — он общий."""
+    key = (language, voice, output_format)
+    with _configs_lock:
+        config = _configs.get(key)
+        if config is None:
+            # Ключи читаем здесь, а не при импорте: сервисы вызывают load_dotenv() после импортов
+            config = speechsdk.SpeechConfig(subscription=os.getenv("SPEECH_KEY"), region=os.getenv("SPEECH_REGION"))
+            if language:
+                config.speech_recognition_language = language
+            if voice:
+                config.speech_synthesis_voice_name = voice
+            if output_format is not None:
+                config.set_speech_synthesis_output_format(output_format)
+            _configs[key] = config
+        return config
+
+
+def _observe_connect(connection: speechsdk.Connection, service: str):
+    """Пишет в метрику время от создания распознавателя до подключения к Speech."""
+    started = time.perf_counter()
+
+    def on_connected(_):
+        SPEECH_CONNECT_SECONDS.labels(service=service).observe(time.perf_counter() - started)
+
+    connection.connected.connect(on_connected)
+
+
+class _PooledSynthesizer:
+    def __init__(self, config: speechsdk.SpeechConfig, service: str):
+        self.synthesizer = speechsdk.SpeechSynthesizer(speech_config=config, audio_config=None)
+        self.connection = speechsdk.Connection.from_speech_synthesizer(self.synthesizer)
+        self.connected = False
+        self.last_used = 0.0
+        self._service = service
+        self._connect_started: Optional[float] = None
+        self.connection.connected.connect(self._on_connected)
+        self.connection.disconnected.connect(self._on_disconnected)
+
+    def _on_connected(self, _):
+        self.connected = True
+        if self._connect_started is not None:
+            SPEECH_CONNECT_SECONDS.labels(service=self._service).observe(time.perf_counter() - self._connect_started)
+            self._connect_started = None
+
+    def _on_disconnected(self, _):
+        self.connected = False
+
+    def ensure_connected(self):
+        """Переоткрывает соединение, если оно закрыто или долго простаивало."""
+        if not self.connected or time.monotonic() - self.last_used > SPEECH_IDLE_REOPEN:
+            self._connect_started = time.perf_counter()
+            self.connection.open(False)
+
+
+class SynthesizerPool:
+    """Ограниченный пул синтезаторов одного голоса. Потокобезопасен (пул потоков, gthread)."""
+
+    def __init__(self, service: str, voice: str, output_format=MP3_FORMAT, size: int = SPEECH_POOL_SIZE):
+        self.service = service
+        self.voice = voice
+        self.output_format = output_format
+        self.size = size
+        self._idle: "queue.LifoQueue[_PooledSynthesizer]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        _pools.append(self)
+
+    def _create(self) -> _PooledSynthesizer:
+        config = get_speech_config(voice=self.voice, output_format=self.output_format)
+        return _PooledSynthesizer(config, self.service)
+
+    def _acquire(self) -> _PooledSynthesizer:
+        started = time.perf_counter()
+        try:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return self._create()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                return self._idle.get(timeout=SPEECH_POOL_TIMEOUT)
+            except queue.Empty:
+                raise SpeechPoolTimeout(f"Нет свободного синтезатора ({self.voice}) за {SPEECH_POOL_TIMEOUT:.0f} с.")
+        finally:
+            SPEECH_POOL_WAIT_SECONDS.labels(service=self.service, pool=self.voice).observe(time.perf_counter() - started)
+
+    def _release(self, pooled: _PooledSynthesizer, healthy: bool):
+        if healthy:
+            pooled.last_used = time.monotonic()
+            self._idle.put(pooled)
+            return
+        # Сломанный синтезатор выбрасываем; вместо него при нужде создастся новый
+        with self._lock:
+            self._created -= 1
+
+    def synthesize(self, text: str) -> bytes:
+        """Озвучивает текст синтезатором из пула. Блокирующий вызов — запускать в потоке."""
+        pooled = self._acquire()
+        healthy = False
+        try:
+            pooled.ensure_connected()
+            result = pooled.synthesizer.speak_text_async(text).get()
+            if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+                healthy = True
+                return result.audio_data
+            details = result.cancellation_details
+            # Ошибка запроса (например, пустой текст) не говорит о поломке соединения
+            healthy = details.reason != speechsdk.CancellationReason.Error
+            raise RuntimeError(f"Ошибка синтеза речи: {details.reason} {details.error_details or ''}".strip())
+        finally:
+            self._release(pooled, healthy)
+
+    def warm_up(self, count: int = SPEECH_POOL_WARM):
+        """Создает до count синтезаторов и открывает их соединения."""
+        warmed = []
+        try:
+            for _ in range(min(count, self.size)):
+                with self._lock:
+                    if self._created >= self.size:
+                        break
+                    self._created += 1
+                try:
+                    pooled = self._create()
+                    pooled.ensure_connected()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+                warmed.append(pooled)
+        finally:
+            for pooled in warmed:
+                self._release(pooled, True)
+
+    def stats(self) -> Dict[str, int]:
+        idle = self._idle.qsize()
+        return {"size": self.size, "created": self._created, "idle": idle, "in_use": self._created - idle}
+
+
+_pools: List[SynthesizerPool] = []
+
+
+def create_recognizer(language: str, audio_config: speechsdk.audio.AudioConfig, service: str) -> Tuple[speechsdk.SpeechRecognizer, Optional[speechsdk.Connection]]:
+    """
+    Распознаватель из кэшированного SpeechConfig. Отдельно соединение не открываем:
+    распознавание стартует сразу, до декодирования аудио, и подключается само.
+    Connection (для метрики подключения) нужно держать до конца распознавания.
+    """
+    recognizer = speechsdk.SpeechRecognizer(speech_config=get_speech_config(language=language), audio_config=audio_config)
+    connection = None
+    try:
+        connection = speechsdk.Connection.from_recognizer(recognizer)
+        _observe_connect(connection, service)
+    except Exception as e:
+        # Не критично: без метрики подключения
+        logging.warning(f"Не удалось подписаться на подключение распознавателя: {e}")
+    return recognizer, connection
+
+
+def warm_up_pools():
+    """Прогрев всех пулов процесса. Вызывается из post_fork gunicorn в фоновом потоке."""
+    for pool in _pools:
+        try:
+            pool.warm_up()
+            logging.info(f"🔥 Пул синтеза {pool.voice} прогрет: {pool.stats()}")
+        except Exception as e:
+            logging.warning(f"Не удалось прогреть пул синтеза {pool.voice}: {e}")
+
+def warm_up_pools_in_background():
+    threading.Thread(target=warm_up_pools, name="speech-warmup", daemon=True).start()
+
+def get_pool_stats() -> Dict[str, Dict[str, int]]:
+    return {pool.voice: pool.stats() for pool in _pools}
@@ -0,0 +1,60 @@
+# swap_cache.py
+import os
+import time
+from typing import Optional, Dict
+
+from redis_conn import redis_async
+
+# --- Кэш готовых результатов замены лица ---
+# Ключ — пользователь + перцептивный хэш уменьшенного фото + шаблон батыра.
+# Повторная загрузка того же селфи с тем же шаблоном не создает новую платную задачу PiAPI.
+# Пользователь в ключе обязателен: перцептивный хэш похожих фото разных людей может
+# совпасть, и без него один пользователь получил бы портрет другого.
+SWAP_CACHE_TTL = int(os.getenv("SWAP_CACHE_TTL", 24 * 3600))
+SWAP_CACHE_MAX_ENTRIES = int(os.getenv("SWAP_CACHE_MAX_ENTRIES", 50000))
+SWAP_CACHE_PREFIX = "swapcache:"
+# Индекс по времени последнего обращения — для вытеснения самых старых записей (LRU)
+SWAP_CACHE_INDEX = "swapcache:index"
+SWAP_CACHE_HITS = "swapcache:stats:hits"
+SWAP_CACHE_MISSES = "swapcache:stats:misses"
+
+
+def _cache_key(user_id: int, photo_hash: str, template_sha: str) -> str:
+    return f"{SWAP_CACHE_PREFIX}{user_id}:{photo_hash}:{template_sha[:16]}"
+
+async def get_cached_result(user_id: int, photo_hash: str, template_sha: str) -> Optional[str]:
+    """Возвращает result_url из кэша и обновляет счетчики попаданий/промахов."""
+    key = _cache_key(user_id, photo_hash, template_sha)
+    result_url = await redis_async.get(key)
+    async with redis_async.pipeline(transaction=False) as pipe:
+        if result_url:
+            pipe.incr(SWAP_CACHE_HITS)
+            pipe.zadd(SWAP_CACHE_INDEX, {key: time.time()})
+        else:
+            pipe.incr(SWAP_CACHE_MISSES)
+        await pipe.execute()
+    return result_url
+
+async def store_result(user_id: int, photo_hash: str, template_sha: str, result_url: str):
+    """Сохраняет результат и вытесняет самые старые записи сверх SWAP_CACHE_MAX_ENTRIES."""
+    key = _cache_key(user_id, photo_hash, template_sha)
+    async with redis_async.pipeline(transaction=True) as pipe:
+        pipe.set(key, result_url, ex=SWAP_CACHE_TTL)
+        pipe.zadd(SWAP_CACHE_INDEX, {key: time.time()})
+        # Записи, истекшие по TTL, тоже убираем из индекса
+        pipe.zremrangebyscore(SWAP_CACHE_INDEX, 0, time.time() - SWAP_CACHE_TTL)
+        pipe.zcard(SWAP_CACHE_INDEX)
+        results = await pipe.execute()
+    overflow = results[-1] - SWAP_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        evicted = await redis_async.zpopmin(SWAP_CACHE_INDEX, overflow)
+        if evicted:
+            await redis_async.delete(*[evicted_key for evicted_key, _ in evicted])
+
+async def get_cache_stats() -> Dict[str, int]:
+    async with redis_async.pipeline(transaction=False) as pipe:
+        pipe.get(SWAP_CACHE_HITS)
+        pipe.get(SWAP_CACHE_MISSES)
+        pipe.zcard(SWAP_CACHE_INDEX)
+        hits, misses, entries = await pipe.execute()
+    return {"hits": int(hits or 0), "misses": int(misses or 0), "entries": entries}
@@ -0,0 +1,164 @@
+# telegram_auth.py
+"""
+Общая проверка Telegram WebApp initData для всех сервисов (бэкенд, ассистент, карта).
+
+Секретный ключ вычисляется один раз. Успешно проверенные initData кэшируются
+в LRU до истечения auth_date + INIT_DATA_MAX_AGE, поэтому частые опросы статуса
+не пересчитывают HMAC. Регистрация новых пользователей в БД идет пачками
+в фоновом потоке (UserRegistrar), а не на каждый запрос.
+"""
+import os
+import json
+import hmac
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote
+from typing import Callable, Dict, List, Optional, Tuple
+
+# --- Конфигурация ---
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", 24 * 3600))
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", 10000))
+
+
+class InitDataError(Exception):
+    """initData отсутствует, повреждена или подпись не сошлась."""
+
+
+_secret_key: Optional[bytes] = None
+_cache: "OrderedDict[bytes, Tuple[dict, float]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _get_secret_key() -> bytes:
+    global _secret_key
+    if _secret_key is None:
+        bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+        if not bot_token:
+            raise InitDataError("TELEGRAM_BOT_TOKEN не задан")
+        _secret_key = hmac.new("WebAppData".encode(), bot_token.encode(), hashlib.sha256).digest()
+    return _secret_key
+
+def _cache_get(cache_key: bytes) -> Optional[dict]:
+    with _cache_lock:
+        cached = _cache.get(cache_key)
+        if cached is None:
+            return None
+        user_data, expires_at = cached
+        if expires_at <= time.time():
+            del _cache[cache_key]
+            return None
+        _cache.move_to_end(cache_key)
+        return dict(user_data)
+
+def _cache_put(cache_key: bytes, user_data: dict, expires_at: float):
+    with _cache_lock:
+        _cache[cache_key] = (user_data, expires_at)
+        _cache.move_to_end(cache_key)
+        while len(_cache) > INIT_DATA_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def validate_init_data(init_data: Optional[str]) -> dict:
+    """Проверяет подпись initData и возвращает данные пользователя (поле user)."""
+    if not init_data:
+        raise InitDataError("initData отсутствует")
+    cache_key = hashlib.sha256(init_data.encode()).digest()
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        unquoted_init_data = unquote(init_data)
+        pairs = [item.split('=', 1) for item in unquoted_init_data.split('&')]
+        fields = dict(pairs)
+        data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(pairs) if key != 'hash')
+    except ValueError as e:
+        raise InitDataError("Некорректный формат initData") from e
+    calculated_hash = hmac.new(_get_secret_key(), data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(calculated_hash, fields.get('hash', '')):
+        raise InitDataError("Invalid data signature")
+
+    try:
+        user_data = json.loads(fields.get('user', '{}'))
+        auth_date = int(fields.get('auth_date', 0))
+    except ValueError as e:
+        raise InitDataError("Некорректные данные пользователя") from e
+
+    # Кэшируем только до истечения срока initData; старые initData просто проверяются каждый раз
+    expires_at = auth_date + INIT_DATA_MAX_AGE
+    if expires_at > time.time():
+        _cache_put(cache_key, user_data, expires_at)
+    return dict(user_data)
+
+
+class UserRegistrar:
+    """
+    Отложенная пакетная регистрация пользователей.
+    register() только кладет пользователя в буфер; фоновый поток раз в
+    flush_interval секунд передает накопленное в flush_fn одним вызовом.
+    """
+
+    def __init__(self, flush_fn: Callable[[List[Tuple[int, str, str]]], None], flush_interval: float = 2.0, known_cache_size: int = 100000):
+        self._flush_fn = flush_fn
+        self._flush_interval = flush_interval
+        self._known_cache_size = known_cache_size
+        self._pending: Dict[int, Tuple[int, str, str]] = {}
+        # Пользователи, которые уже отправлены в БД этим процессом
+        self._known: "OrderedDict[int, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def register(self, user_data: dict) -> bool:
+        """Возвращает True, если пользователь новый для этого процесса и поставлен в буфер."""
+        user_id = user_data.get('id')
+        if not user_id:
+            return False
+        with self._lock:
+            if user_id in self._known or user_id in self._pending:
+                return False
+            self._pending[user_id] = (user_id, user_data.get('username', 'unknown'), user_data.get('first_name', 'unknown'))
+            self._ensure_thread()
+        return True
+
+    def flush(self):
+        """Записывает буфер немедленно (например, перед проверкой лимита нового пользователя)."""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending.values())
+                self._pending.clear()
+            if not batch:
+                return
+            try:
+                self._flush_fn(batch)
+            except Exception as e:
+                print(f"🔥 Ошибка пакетной регистрации пользователей: {e}")
+                with self._lock:
+                    for user in batch:
+                        self._pending.setdefault(user[0], user)
+                return
+            with self._lock:
+                for user in batch:
+                    self._known[user[0]] = None
+                while len(self._known) > self._known_cache_size:
+                    self._known.popitem(last=False)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+
+    def _ensure_thread(self):
+        # Поток стартует лениво — уже в рабочем процессе, а не в мастере до fork
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="user-registrar", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self.flush()
@@ -0,0 +1,71 @@
+# tests/test_job_queue_variants.py
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+import job_queue
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(job_queue, "redis_async", client)
+    monkeypatch.setattr(job_queue, "_variant_update_script", client.register_script(job_queue.VARIANT_UPDATE_SCRIPT))
+    monkeypatch.setattr(job_queue, "_status_progress_script", client.register_script(job_queue.STATUS_PROGRESS_SCRIPT))
+    return client
+
+
+def _run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def _parent_with_variants(count):
+    variant_jobs = [{"job_id": f"v{i}", "template": f"t{i}"} for i in range(count)]
+    await job_queue.create_parent_job("parent", variant_jobs)
+    return variant_jobs
+
+
+def test_interleaved_terminal_variants_finish_parent_once(redis):
+    async def scenario():
+        await _parent_with_variants(2)
+        results = await asyncio.gather(
+            job_queue.update_variant_status("parent", "v0", {"status": "completed", "result_url": "/r/0.jpg"}),
+            job_queue.update_variant_status("parent", "v1", {"status": "completed", "result_url": "/r/1.jpg"}),
+        )
+        return results, await job_queue.get_job_status("parent")
+
+    results, parent = _run(scenario())
+    finals = [result for result in results if result is not None]
+    assert len(finals) == 1
+    assert parent["status"] == "completed"
+    assert parent["variants_done"] == 2
+    assert sorted(variant["result_url"] for variant in parent["variants"]) == ["/r/0.jpg", "/r/1.jpg"]
+
+
+def test_late_progress_does_not_touch_finished_parent(redis):
+    async def scenario():
+        await _parent_with_variants(2)
+        await job_queue.update_variant_status("parent", "v0", {"status": "completed", "result_url": "/r/0.jpg"})
+        # Промежуточный статус v0 пришел после финального
+        await job_queue.update_variant_status("parent", "v0", {"status": "processing", "message": "..."})
+        await job_queue.update_variant_status("parent", "v1", {"status": "failed", "error": "нет лица"})
+        await job_queue.update_variant_status("parent", "v1", {"status": "processing", "message": "..."})
+        return await job_queue.get_job_status("parent")
+
+    parent = _run(scenario())
+    assert parent["status"] == "completed"
+    assert parent["result_url"] == "/r/0.jpg"
+    assert [variant["status"] for variant in parent["variants"]] == ["completed", "failed"]
+
+
+def test_progress_after_final_status_is_skipped(redis):
+    async def scenario():
+        await job_queue.claim_job_result("job", "completed")
+        await job_queue.update_job_status("job", {"status": "completed", "result_url": "/r/job.jpg"})
+        await job_queue.update_job_status("job", {"status": "processing", "message": "..."})
+        return await job_queue.get_job_status("job")
+
+    assert _run(scenario()) == {"status": "completed", "result_url": "/r/job.jpg"}
@@ -0,0 +1,161 @@
+# tts_cache.py
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple
+
+from metrics import TTS_CACHE_REQUESTS
+
+# --- Кэш озвучки (TTS) ---
+# Ключ — sha256 от голоса, формата и текста: тексты карты из batyrs_data.json и готовые
+# фразы ассистента озвучиваются в Azure один раз. Два уровня: LRU в памяти процесса
+# и файлы на диске, общие для всех процессов и сервисов, смонтировавших TTS_CACHE_DIR.
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "/app/storage/tts-cache")
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("TTS_CACHE_MEMORY_BYTES", 32 * 1024 ** 2))
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", 512 * 1024 ** 2))
+# Очистку диска по размеру запускаем не чаще, чем раз в столько секунд
+EVICTION_CHECK_INTERVAL = 60
+
+
+class CachedAudio(NamedTuple):
+    key: str
+    audio: bytes
+    tier: str  # memory, disk или miss (только что озвучено)
+
+    @property
+    def etag(self) -> str:
+        # Содержимое однозначно определяется ключом, поэтому ETag — сам ключ
+        return f'"{self.key[:32]}"'
+
+
+class TTSCache:
+    def __init__(self, service: str):
+        self.service = service
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        # Один синтез на ключ: параллельные запросы того же текста ждут первый
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._stats = {"memory": 0, "disk": 0, "miss": 0}
+        self._last_eviction_check = 0.0
+
+    @staticmethod
+    def cache_key(text: str, voice: str, output_format) -> str:
+        return hashlib.sha256(f"{voice}\0{output_format}\0{text}".encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+
+    def _remember(self, key: str, audio: bytes):
+        if len(audio) > TTS_CACHE_MEMORY_BYTES:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = audio
+            self._memory_bytes += len(audio)
+            while self._memory_bytes > TTS_CACHE_MEMORY_BYTES:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _from_memory(self, key: str):
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+            return audio
+
+    def _from_disk(self, key: str):
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            # Обновляем atime вручную: том может быть смонтирован с noatime
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            return None
+        return audio or None
+
+    def _store_on_disk(self, key: str, audio: bytes):
+        try:
+            os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(audio)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить озвучку в кэш: {e}")
+            return
+        self._evict_disk_if_needed()
+
+    def _count(self, tier: str):
+        with self._lock:
+            self._stats[tier] += 1
+        TTS_CACHE_REQUESTS.labels(service=self.service, tier=tier).inc()
+
+    def get_or_synthesize(self, text: str, voice: str, output_format, synthesize: Callable[[str], bytes]) -> CachedAudio:
+        """Озвучка из кэша или через synthesize(text) с сохранением. Блокирующий вызов."""
+        key = self.cache_key(text, voice, output_format)
+        audio = self._from_memory(key)
+        if audio is not None:
+            self._count("memory")
+            return CachedAudio(key, audio, "memory")
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                audio = self._from_memory(key)
+                if audio is not None:
+                    self._count("memory")
+                    return CachedAudio(key, audio, "memory")
+                audio = self._from_disk(key)
+                if audio is not None:
+                    self._remember(key, audio)
+                    self._count("disk")
+                    return CachedAudio(key, audio, "disk")
+                audio = synthesize(text)
+                self._remember(key, audio)
+                self._store_on_disk(key, audio)
+                self._count("miss")
+                return CachedAudio(key, audio, "miss")
+        finally:
+            with self._lock:
+                if self._key_locks.get(key) is key_lock and not key_lock.locked():
+                    del self._key_locks[key]
+
+    def _evict_disk_if_needed(self):
+        if time.monotonic() - self._last_eviction_check < EVICTION_CHECK_INTERVAL:
+            return
+        self._last_eviction_check = time.monotonic()
+        entries = []
+        try:
+            with os.scandir(TTS_CACHE_DIR) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.startswith(".tmp-"):
+                        stat = entry.stat()
+                        entries.append((stat.st_atime, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        # Сначала удаляем то, что дольше всего не запрашивали
+        for _, size, path in sorted(entries):
+            if total <= TTS_CACHE_DISK_BYTES:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({"memory_entries": len(self._memory), "memory_bytes": self._memory_bytes})
+        requests = stats["memory"] + stats["disk"] + stats["miss"]
+        stats["hit_rate"] = round((stats["memory"] + stats["disk"]) / requests, 3) if requests else 0.0
+        return stats
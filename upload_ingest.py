@@ -0,0 +1,216 @@
+# upload_ingest.py
+import os
+import io
+import tempfile
+from typing import Dict, Optional
+
+from PIL import Image, ImageFile
+from fastapi import Request
+
+# python-multipart >= 0.0.13 переименован в python_multipart
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# --- Потоковый прием фото пользователя ---
+# Тело multipart читается по кускам: сигнатура и размеры картинки проверяются по первым
+# килобайтам, лишнее отклоняется до того, как тело прочитано целиком, а большие файлы
+# сразу пишутся на диск, а не держатся в памяти процесса API.
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 15 * 1024 * 1024))
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", 50_000_000))
+# До этого размера файл держим в памяти, дальше — во временном файле
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", 1024 * 1024))
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR") or None
+# Сколько байт начала файла отдаем парсеру PIL, чтобы узнать размеры
+SNIFF_MAX_BYTES = 256 * 1024
+MAX_FIELD_BYTES = 4096
+# Запас на заголовки multipart и текстовые поля формы
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"heim", b"heis", b"mif1", b"msf1")
+
+
+class UploadRejected(Exception):
+    """Загрузка отклонена; status_code и detail уходят клиенту как HTTPException."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def sniff_image_format(head: bytes) -> Optional[str]:
+    """Формат по сигнатуре первых байт, без доверия к Content-Type клиента."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    if head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+        return "HEIF"
+    return None
+
+
+class IngestedUpload:
+    """Принятый файл: в памяти (bytes) или на диске (path), плюс текстовые поля формы."""
+
+    def __init__(self):
+        self.fields: Dict[str, str] = {}
+        self.image_format: Optional[str] = None
+        self.width: Optional[int] = None
+        self.height: Optional[int] = None
+        self.size = 0
+        self._buffer: Optional[io.BytesIO] = io.BytesIO()
+        self._file = None
+        self.path: Optional[str] = None
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self._buffer is not None and self._buffer.tell() + len(data) > UPLOAD_SPOOL_BYTES:
+            self._file = tempfile.NamedTemporaryFile(prefix="upload-", suffix=".img", dir=UPLOAD_TMP_DIR, delete=False)
+            self.path = self._file.name
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+        if self._buffer is not None:
+            self._buffer.write(data)
+        else:
+            self._file.write(data)
+
+    def finish(self):
+        if self._file is not None:
+            self._file.close()
+
+    @property
+    def source(self):
+        """Что передавать в preprocess_photo: путь к файлу на диске или байты из памяти."""
+        return self.path if self.path else self._buffer.getvalue()
+
+    def close(self):
+        self.finish()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self._buffer = None
+
+
+async def ingest_upload(request: Request, file_field: str = "user_photo") -> IngestedUpload:
+    """
+    Читает multipart/form-data из потока запроса. Файл file_field проверяется
+    на лету: не картинка — 415, больше UPLOAD_MAX_BYTES или UPLOAD_MAX_PIXELS — 413.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD_BYTES:
+        raise UploadRejected(413, f"Файл слишком большой. Максимум — {UPLOAD_MAX_BYTES // (1024 * 1024)} МБ.")
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadRejected(400, "Ожидается multipart/form-data.")
+
+    upload = IngestedUpload()
+    state = {"headers": {}, "header_field": b"", "header_value": b"", "name": None, "is_file": False, "field_value": b"", "head": b""}
+    image_parser = ImageFile.Parser()
+
+    def check_head(data: bytes):
+        # Сигнатуру и размеры ищем только в начале файла
+        if state["head"] is None:
+            return
+        state["head"] += data
+        if upload.image_format is None:
+            if len(state["head"]) < 16:
+                return
+            upload.image_format = sniff_image_format(state["head"])
+            if upload.image_format is None:
+                raise UploadRejected(415, "Недопустимый тип файла. Поддерживаются JPEG, PNG, WEBP и HEIC.")
+            # Формат определился только сейчас — парсер еще не видел накопленное начало файла
+            data = state["head"]
+        if upload.image_format == "HEIF":
+            # Размер HEIC становится известен только после разбора всего контейнера
+            state["head"] = None
+            return
+        try:
+            image_parser.feed(data)
+        except Image.DecompressionBombError:
+            raise UploadRejected(413, "Слишком большое разрешение фото.")
+        if image_parser.image is not None:
+            upload.width, upload.height = image_parser.image.size
+            if upload.width * upload.height > UPLOAD_MAX_PIXELS:
+                raise UploadRejected(413, "Слишком большое разрешение фото.")
+            state["head"] = None
+        elif len(state["head"]) >= SNIFF_MAX_BYTES:
+            # Размер не нашелся в начале файла (например, большой EXIF) — проверит обработка фото
+            state["head"] = None
+
+    def on_part_begin():
+        state.update({"headers": {}, "name": None, "is_file": False, "field_value": b""})
+
+    def on_header_field(data: bytes, start: int, end: int):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = b""
+        state["header_value"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        name = disposition.get(b"name", b"").decode("utf-8", "replace")
+        state["name"] = name
+        state["is_file"] = name == file_field
+        if state["is_file"] and upload.size:
+            raise UploadRejected(400, "Можно загрузить только одно фото.")
+
+    def on_part_data(data: bytes, start: int, end: int):
+        chunk = data[start:end]
+        if state["is_file"]:
+            if upload.size + len(chunk) > UPLOAD_MAX_BYTES:
+                raise UploadRejected(413, f"Файл слишком большой. Максимум — {UPLOAD_MAX_BYTES // (1024 * 1024)} МБ.")
+            check_head(chunk)
+            upload.write(chunk)
+        else:
+            state["field_value"] += chunk
+            if len(state["field_value"]) > MAX_FIELD_BYTES:
+                raise UploadRejected(400, f"Поле {state['name']} слишком длинное.")
+
+    def on_part_end():
+        if not state["is_file"] and state["name"]:
+            upload.fields[state["name"]] = state["field_value"].decode("utf-8", "replace")
+
+    callbacks = {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    }
+    parser = MultipartParser(boundary, callbacks)
+    received = 0
+    try:
+        async for chunk in request.stream():
+            # Content-Length может не быть (chunked), поэтому считаем и сами
+            received += len(chunk)
+            if received > UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD_BYTES:
+                raise UploadRejected(413, f"Файл слишком большой. Максимум — {UPLOAD_MAX_BYTES // (1024 * 1024)} МБ.")
+            if chunk:
+                parser.write(chunk)
+        parser.finalize()
+        upload.finish()
+    except UploadRejected:
+        upload.close()
+        raise
+    except Exception as e:
+        upload.close()
+        raise UploadRejected(400, "Некорректное тело запроса.") from e
+
+    if not upload.size:
+        upload.close()
+        raise UploadRejected(400, "Фото не загружено.")
+    if upload.image_format is None:
+        upload.close()
+        raise UploadRejected(415, "Недопустимый тип файла. Поддерживаются JPEG, PNG, WEBP и HEIC.")
+    return upload
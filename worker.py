@@ -0,0 +1,105 @@
+# worker.py
+import os
+import signal
+import asyncio
+import traceback
+
+from dotenv import load_dotenv
+from prometheus_client import start_http_server
+
+load_dotenv()
+
+from face_swap import run_face_swap_job
+from batyr_templates import load_all_batyr_images_to_cache
+from job_queue import (
+    get_worker_id, claim_next_job, load_job, ack_job,
+    send_worker_heartbeat, requeue_orphaned_jobs, WORKER_HEARTBEAT_TTL
+)
+from redis_conn import close_redis
+from http_clients import close_http_clients
+
+# --- Конфигурация воркера ---
+# Сколько задач один процесс обрабатывает одновременно (почти всё время — ожидание PiAPI)
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 20))
+QUEUE_BLOCK_TIMEOUT = 5
+# Порт /metrics воркера (процесс не за gunicorn, метрики отдает сам); 0 — не поднимать
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9100))
+
+
+async def _heartbeat_loop(worker_id: str, stop_event: asyncio.Event):
+    """Поддерживает heartbeat и подбирает задачи упавших воркеров."""
+    while not stop_event.is_set():
+        try:
+            await send_worker_heartbeat(worker_id)
+            await requeue_orphaned_jobs(worker_id)
+        except Exception as e:
+            print(f"⚠️ [Worker {worker_id}] Ошибка heartbeat: {e}")
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=WORKER_HEARTBEAT_TTL / 3)
+        except asyncio.TimeoutError:
+            pass
+
+async def _consume_loop(worker_id: str, slot: int, stop_event: asyncio.Event):
+    while not stop_event.is_set():
+        try:
+            job_id = await claim_next_job(worker_id, timeout=QUEUE_BLOCK_TIMEOUT)
+        except Exception as e:
+            print(f"❌ [Worker {worker_id}/{slot}] Ошибка чтения очереди: {e}")
+            await asyncio.sleep(QUEUE_BLOCK_TIMEOUT)
+            continue
+        if not job_id:
+            continue
+        try:
+            job = await load_job(job_id)
+        except Exception as e:
+            # Задача остается в списке обработки и вернется в очередь при перезапуске воркера
+            print(f"❌ [Worker {worker_id}/{slot}] Ошибка загрузки задачи {job_id}: {e}")
+            await asyncio.sleep(QUEUE_BLOCK_TIMEOUT)
+            continue
+        if job is None:
+            print(f"⚠️ [Job: {job_id}] Данные задачи истекли, пропускаю.")
+        else:
+            try:
+                await run_face_swap_job(job)
+            except asyncio.CancelledError:
+                # Не подтверждаем задачу — после перезапуска она будет возобновлена
+                raise
+            except Exception:
+                traceback.print_exc()
+        try:
+            await ack_job(worker_id, job_id)
+        except Exception as e:
+            # Не подтвердили — задача остается в списке обработки; если она уже завершена,
+            # при возобновлении run_face_swap_job её просто пропустит
+            print(f"❌ [Worker {worker_id}/{slot}] Ошибка подтверждения задачи {job_id}: {e}")
+            await asyncio.sleep(QUEUE_BLOCK_TIMEOUT)
+
+async def main():
+    worker_id = get_worker_id()
+    load_all_batyr_images_to_cache()
+    if WORKER_METRICS_PORT:
+        start_http_server(WORKER_METRICS_PORT)
+
+    # Свои незавершенные задачи (после перезапуска контейнера) возвращаем в очередь
+    await send_worker_heartbeat(worker_id)
+    await requeue_orphaned_jobs(worker_id, include_own=True)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    tasks = [asyncio.create_task(_heartbeat_loop(worker_id, stop_event))]
+    tasks += [asyncio.create_task(_consume_loop(worker_id, slot, stop_event)) for slot in range(WORKER_CONCURRENCY)]
+    print(f"🚀 Воркер {worker_id} запущен, параллельных задач: {WORKER_CONCURRENCY}")
+
+    await stop_event.wait()
+    print(f"🛑 Воркер {worker_id} останавливается...")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await close_http_clients()
+    await close_redis()
+
+if __name__ == "__main__":
+    asyncio.run(main())